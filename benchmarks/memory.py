@@ -0,0 +1,111 @@
+import time
+import random
+import argparse
+from redis.exceptions import ResponseError
+
+from twitter.controllers import keys
+from twitter.controllers import records
+from twitter.controllers.redis import get_redis_client
+
+#
+# memory.py: redis memory used per tweet, one hash per tweet vs the tweets
+# packed into buckets (see records.py)
+#
+# usage: python -m benchmarks.memory --flush [--tweets 100000] [--buckets 100]
+#
+# it needs a real redis server (fake redis does not report its memory), which
+# is flushed before and after each mode; a bucket is only compact while it is a
+# listpack, i.e. with at most hash-max-listpack-entries tweets (--buckets) of at
+# most hash-max-listpack-value bytes (hash-max-ziplist-* before redis 7), the
+# benchmark prints the server's settings
+#
+
+BATCH_SIZE = 1000
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "redis", "tweet", "#python"]
+
+
+def tweets(num_of_tweets, image_ratio, rng):
+    start = 1600000000.0
+    for tid in range(1, num_of_tweets + 1):
+        tweet = {
+            "timestamp": start + tid * 60,
+            "uid": rng.randint(1, 10000),
+            "version": 1,
+            "tweet_text": " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+        }
+        if rng.random() < image_ratio:
+            image = f"{tweet['uid']}_{tid}.jpg"
+            tweet.update(
+                {
+                    "image": image,
+                    "image_thumb": f"{image}_image_thumb.jpg",
+                    "image_medium": f"{image}_image_medium.jpg",
+                }
+            )
+        yield str(tid), tweet
+
+
+def used_memory(client):
+    return client.conn.info("memory")["used_memory"]
+
+
+# bytes per tweet, and the seconds to read them all in pages of 20 (as
+# Tweet.load_many, without the presigned urls)
+def measure(client, buckets, args):
+    client.reset_db()
+    if buckets:
+        client.conn.set(keys.TWEET_BUCKETS, buckets)
+    client.reload_layout()
+    before = used_memory(client)
+    pipe = client.conn.pipeline(transaction=False)
+    for tid, tweet in tweets(args.tweets, args.images, random.Random(args.seed)):
+        records.write(pipe, tid, tweet, buckets)
+        if len(pipe) >= BATCH_SIZE:
+            pipe.execute()
+    pipe.execute()
+    per_tweet = (used_memory(client) - before) / args.tweets
+    encoding = client.conn.object("encoding", keys.tweet_key(1, buckets))
+    tids = [str(tid) for tid in range(1, args.tweets + 1)]
+    start = time.perf_counter()
+    for page in range(0, len(tids), 20):
+        pipe = client.conn.pipeline(transaction=False)
+        for tid in tids[page : page + 20]:
+            records.read(pipe, tid, buckets)
+        assert all(records.parse(tweet, buckets) for tweet in pipe.execute())
+    elapsed = time.perf_counter() - start
+    client.reset_db()
+    return per_tweet, encoding, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.memory")
+    parser.add_argument("--tweets", type=int, default=100000)
+    parser.add_argument(
+        "--buckets", type=int, default=100, help="number of tweets per bucket"
+    )
+    parser.add_argument(
+        "--images", type=float, default=0.1, help="ratio of tweets with an image"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--flush", action="store_true", help="confirm the database can be flushed"
+    )
+    args = parser.parse_args()
+    if not args.flush:
+        parser.error("the benchmark flushes the database, pass --flush to confirm")
+
+    client = get_redis_client()
+    try:
+        settings = client.conn.config_get("hash-max-*")
+    except ResponseError:
+        settings = {}
+    for name, value in sorted(settings.items()):
+        print(f"{name} {value}")
+    print(f"{'mode':<14} {'bytes/tweet':>12} {'encoding':>10} {'read all':>10}")
+    for name, buckets in (("hash", 0), (f"buckets:{args.buckets}", args.buckets)):
+        per_tweet, encoding, elapsed = measure(client, buckets, args)
+        print(f"{name:<14} {per_tweet:>12.1f} {encoding:>10} {elapsed:>9.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import offline
+
+#
+# modes.py: throughput of the timeline pages served by the sync app (app.py,
+# one request at a time per worker thread) and by the async app (asgi.py, the
+# requests of a worker interleaved on its event loop)
+#
+# usage: python -m benchmarks.modes [--concurrency 16] [--latency 1]
+#
+# the sync app is driven by --concurrency threads (as many gunicorn sync
+# workers), the async app by as many concurrent requests on one event loop; it
+# runs offline by default with fake redis / s3 and --latency milliseconds added
+# to every redis round trip, --live runs it against the configured redis and s3
+# (flushing both, see --flush)
+#
+
+PATHS = {
+    "home": lambda uid, uids: "/",
+    "profile": lambda uid, uids: "/profile",
+    "guest_profile": lambda uid, uids: f"/users/{random.choice(uids)}/profile",
+}
+
+
+# the session cookie of the seeded user, as set by the login
+def session_cookie(app, sid):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'sid': sid})}"
+
+
+def run_sync(app, requests, concurrency):
+    client = app.test_client(use_cookies=False)
+
+    def get(path_cookie):
+        path, cookie = path_cookie
+        start = time.perf_counter()
+        response = client.get(path, headers={"Cookie": cookie})
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"{path}: {response.status_code}")
+        return elapsed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(get, requests))
+
+
+def run_async(app, requests, concurrency):
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get(path, cookie):
+            async with semaphore:
+                start = time.perf_counter()
+                status = await _asgi_get(app, path, cookie)
+                elapsed = time.perf_counter() - start
+            if status != 200:
+                raise RuntimeError(f"{path}: {status}")
+            return elapsed
+
+        return await asyncio.gather(*(get(path, cookie) for path, cookie in requests))
+
+    return asyncio.run(run())
+
+
+def report(mode, latencies, elapsed):
+    quantiles = statistics.quantiles(
+        [latency * 1000 for latency in latencies], n=100, method="inclusive"
+    )
+    print(
+        f"{mode:<7}{len(latencies):>9}{len(latencies) / elapsed:>10.1f}"
+        f"{quantiles[49]:>9.2f}{quantiles[94]:>9.2f}{quantiles[98]:>9.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.modes")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument(
+        "--requests", type=int, default=300, help="number of requests per mode"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="requests in flight at once"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=1.0,
+        help="milliseconds added to every fake redis round trip",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--modes", nargs="+", default=["sync", "async"], choices=["sync", "async"]
+    )
+    parser.add_argument(
+        "--live", action="store_true", help="use the configured redis and s3"
+    )
+    parser.add_argument(
+        "--flush", action="store_true", help="confirm the database can be flushed"
+    )
+    args = parser.parse_args()
+    if args.live and not args.flush:
+        parser.error("the benchmark flushes the database, pass --flush to confirm")
+
+    if args.live:
+        offline.install_counter()
+    else:
+        # the dataset is seeded without the latency
+        mock = offline.install()
+
+    from twitter import asgi
+    from twitter.app import app
+    from twitter.controllers.s3 import get_s3_client
+    from twitter.controllers.redis import get_redis_client
+    from benchmarks import seed
+
+    redis_client, s3_client = get_redis_client(), get_s3_client()
+    redis_client.reset_db()
+    uids = seed.seed(
+        redis_client,
+        s3_client,
+        num_of_users=args.users,
+        num_of_tweets=args.tweets,
+        random_seed=args.seed,
+    )
+    if not args.live and args.latency:
+        offline.set_latency(args.latency / 1000)
+
+    random.seed(args.seed)
+    requests = []
+    for _ in range(args.requests):
+        uid = random.choice(uids)
+        path = PATHS[random.choice(list(PATHS))](uid, uids)
+        requests.append((path, session_cookie(app, seed.session_id(uid))))
+
+    print(
+        f"{args.concurrency} requests in flight"
+        + (f", {args.latency}ms per redis round trip" if not args.live else "")
+    )
+    print(
+        f"{'mode':<7}{'requests':>9}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    )
+    for mode in args.modes:
+        run = run_sync if mode == "sync" else run_async
+        target = app if mode == "sync" else asgi.app
+        start = time.perf_counter()
+        latencies = run(target, requests, args.concurrency)
+        report(mode, latencies, time.perf_counter() - start)
+
+    offline.set_latency(0)
+    redis_client.reset_db()
+    if args.live:
+        s3_client.reset_s3()
+    else:
+        mock.stop()
+
+
+#
+# Internal helper function
+#
+
+
+# the status of a GET of the asgi app
+async def _asgi_get(app, path, cookie):
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"cookie", cookie.encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
+
+if __name__ == "__main__":
+    main()
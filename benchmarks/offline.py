@@ -0,0 +1,161 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+from collections import Counter
+
+#
+# offline.py: in-process stand-ins for redis (fakeredis) and s3 (moto), so that
+# the benchmarks run without any server or network access
+#
+# install() must be called before twitter.app is imported, as the app creates
+# its clients (and reads its settings) at import time
+#
+
+
+# redis commands sent by the connections of the pool, a pipeline or a script
+# counts as its commands / one EVALSHA (thread safe, as the routes may be run
+# by several threads)
+class CommandCounter(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = Counter()
+
+    def add(self, commands):
+        with self._lock:
+            self._commands.update(commands)
+
+    def reset(self):
+        with self._lock:
+            commands, self._commands = self._commands, Counter()
+        return commands
+
+
+commands = CommandCounter()
+# seconds added to every round trip of the counting connections (see set_latency)
+_latency = 0
+
+
+# the round trips take seconds more, as they would over a network
+def set_latency(seconds):
+    global _latency
+    _latency = seconds
+
+
+def counting(connection_class):
+    class CountingConnection(connection_class):
+        def send_command(self, *args, **kwargs):
+            commands.add([str(args[0]).upper()])
+            return super().send_command(*args, **kwargs)
+
+        def pack_commands(self, packed):
+            packed = list(packed)
+            commands.add(str(args[0]).upper() for args in packed)
+            return super().pack_commands(packed)
+
+        def send_packed_command(self, *args, **kwargs):
+            if _latency:
+                time.sleep(_latency)
+            return super().send_packed_command(*args, **kwargs)
+
+    return CountingConnection
+
+
+# same as counting, for the connections of redis.asyncio
+def counting_async(connection_class):
+    class CountingConnection(connection_class):
+        async def send_command(self, *args, **kwargs):
+            commands.add([str(args[0]).upper()])
+            return await super().send_command(*args, **kwargs)
+
+        def pack_commands(self, packed):
+            packed = list(packed)
+            commands.add(str(args[0]).upper() for args in packed)
+            return super().pack_commands(packed)
+
+        async def send_packed_command(self, *args, **kwargs):
+            if _latency:
+                await asyncio.sleep(_latency)
+            return await super().send_packed_command(*args, **kwargs)
+
+    return CountingConnection
+
+
+# the settings the app requires, pointing at nothing real
+def _set_environment():
+    os.environ.setdefault("S3_BUCKET_NAME", "benchmark")
+    os.environ.setdefault("APP_SECRET_KEY", "benchmark")
+    os.environ.setdefault("GOOGLE_CLIENT_ID", "benchmark")
+    os.environ.setdefault("OAUTH_REDIRECT_URL", "http://localhost/callback")
+    if not os.environ.get("OAUTH_CLIENT_SECRET_PATH"):
+        path = os.path.join(tempfile.mkdtemp(), "client_secret.json")
+        with open(path, "w") as f:
+            f.write("{}")
+        os.environ["OAUTH_CLIENT_SECRET_PATH"] = path
+    # moto intercepts the requests to aws, not to a custom endpoint
+    os.environ.pop("S3_PROD_ENDPOINT_URL", None)
+    os.environ["AWS_ACCESS_KEY"] = os.environ["AWS_SECRET_KEY"] = "benchmark"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+
+# fake redis and s3, returns the moto mock (stop it when done)
+def install():
+    import fakeredis
+    import redis
+    import redis.asyncio
+    from fakeredis.aioredis import FakeAsyncRedisConnection
+    from moto import mock_aws
+
+    _set_environment()
+    mock = mock_aws()
+    mock.start()
+
+    from twitter.controllers import redis as controllers_redis
+    from twitter.controllers import aio as controllers_aio
+
+    server = fakeredis.FakeServer()
+    controllers_redis.set_connection_pool(
+        redis.ConnectionPool(
+            connection_class=counting(fakeredis.FakeRedisConnection),
+            server=server,
+            decode_responses=True,
+        )
+    )
+    controllers_aio.set_connection_pool_factory(
+        lambda: redis.asyncio.ConnectionPool(
+            connection_class=counting_async(FakeAsyncRedisConnection),
+            server=server,
+            decode_responses=True,
+        )
+    )
+    return mock
+
+
+# count the commands sent to the configured redis server
+def install_counter():
+    import redis
+    import redis.asyncio
+    from twitter.controllers import redis as controllers_redis
+    from twitter.controllers import aio as controllers_aio
+
+    controllers_redis.set_connection_pool(
+        redis.BlockingConnectionPool(
+            connection_class=counting(redis.Connection),
+            host=controllers_redis.REDIS_HOST,
+            port=controllers_redis.REDIS_PORT,
+            decode_responses=True,
+            max_connections=controllers_redis.REDIS_MAX_CONNECTIONS,
+            timeout=controllers_redis.REDIS_POOL_TIMEOUT,
+        )
+    )
+    controllers_aio.set_connection_pool_factory(
+        lambda: redis.asyncio.BlockingConnectionPool(
+            connection_class=counting_async(redis.asyncio.Connection),
+            host=controllers_redis.REDIS_HOST,
+            port=controllers_redis.REDIS_PORT,
+            decode_responses=True,
+            max_connections=controllers_redis.REDIS_MAX_CONNECTIONS,
+            timeout=controllers_redis.REDIS_POOL_TIMEOUT,
+        )
+    )
@@ -0,0 +1,237 @@
+import io
+import time
+import random
+import argparse
+import statistics
+from collections import Counter
+
+from benchmarks import offline
+from twitter.controllers import keys
+
+#
+# routes.py: latency and redis commands per request of the web routes, driven
+# through the flask test client against a seeded synthetic dataset
+#
+# usage: python -m benchmarks.routes [--users 1000] [--tweets 10000]
+#
+# it runs offline with fake redis / s3 by default, --live runs it against the
+# redis and s3 configured by the environment (flushing both, see --flush)
+#
+
+READ_ROUTES = (
+    "home",
+    "profile",
+    "guest_profile",
+    "gallery",
+    "people",
+    "search",
+    "tag",
+    "mentions",
+)
+WRITE_ROUTES = ("post", "update", "delete", "follow", "unfollow")
+
+
+class Driver(object):
+    def __init__(self, app, redis_client, uids, rng, session_id):
+        self._app = app
+        self._session_id = session_id
+        self._redis_client = redis_client
+        self._uids = uids
+        self._rng = rng
+        self._clients = {}
+        # route --> [(seconds, commands)]
+        self.samples = {}
+
+    # a request of the route by a random user
+    def request(self, route):
+        uid = self._rng.choice(self._uids)
+        method, path, data = getattr(self, f"_{route}")(uid)
+        client = self._client(uid)
+        offline.commands.reset()
+        start = time.perf_counter()
+        if method == "GET":
+            response = client.get(path)
+        else:
+            response = client.post(path, data=data, content_type="multipart/form-data")
+        elapsed = time.perf_counter() - start
+        commands = offline.commands.reset()
+        if response.status_code >= 400:
+            raise RuntimeError(f"{route} {path}: {response.status_code}")
+        self.samples.setdefault(route, []).append((elapsed, commands))
+
+    def _client(self, uid):
+        if uid not in self._clients:
+            client = self._app.test_client()
+            with client.session_transaction() as session:
+                session["sid"] = self._session_id(uid)
+            self._clients[uid] = client
+        return self._clients[uid]
+
+    def _home(self, uid):
+        return "GET", "/", None
+
+    def _profile(self, uid):
+        return "GET", "/profile", None
+
+    def _guest_profile(self, uid):
+        return "GET", f"/users/{self._rng.choice(self._uids)}/profile", None
+
+    def _gallery(self, uid):
+        return "GET", "/gallery", None
+
+    def _people(self, uid):
+        return "GET", "/people", None
+
+    # the words of the posted tweets (the seeded ones are not indexed)
+    def _search(self, uid):
+        return "GET", "/search?q=benchmark+post", None
+
+    def _tag(self, uid):
+        return "GET", "/tags/benchmark", None
+
+    def _mentions(self, uid):
+        return "GET", "/mentions", None
+
+    def _post(self, uid):
+        text = f"benchmark post #benchmark @{self._rng.choice(self._uids)}"
+        return "POST", "/tweets", _tweet_form(tweet_text=text)
+
+    def _update(self, uid):
+        tid = self._latest_tid(uid)
+        form = _tweet_form(_method="PUT", _redirect="/", tweet_text="updated")
+        return "POST", f"/tweets/{tid}", form
+
+    def _delete(self, uid):
+        tid = self._latest_tid(uid)
+        return "POST", f"/tweets/{tid}", {"_method": "DELETE", "_redirect": "/"}
+
+    def _follow(self, uid):
+        other = self._rng.choice(self._uids)
+        form = {"_method": "follow", "_redirect": "/"}
+        return "POST", f"/users/{other}/following", form
+
+    def _unfollow(self, uid):
+        form = {"_method": "unfollow", "_redirect": "/"}
+        other = self._redis_client.conn.srandmember(keys.following(uid))
+        return "POST", f"/users/{other or uid}/following", form
+
+    # the user's latest tweet (one is posted if the user has none)
+    def _latest_tid(self, uid):
+        tids = self._redis_client.conn.zrevrange(keys.user_tweets(uid), 0, 0)
+        if not tids:
+            self._client(uid).post(
+                "/tweets",
+                data=_tweet_form(tweet_text="benchmark post"),
+                content_type="multipart/form-data",
+            )
+            tids = self._redis_client.conn.zrevrange(keys.user_tweets(uid), 0, 0)
+        return tids[0]
+
+
+def report(samples):
+    print(
+        f"{'route':<14}{'requests':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'cmds/req':>10}  top commands"
+    )
+    for route, route_samples in samples.items():
+        latencies = [elapsed * 1000 for elapsed, _ in route_samples]
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        commands = Counter()
+        for _, request_commands in route_samples:
+            commands.update(request_commands)
+        top = ", ".join(
+            f"{name} {count / len(route_samples):.1f}"
+            for name, count in commands.most_common(3)
+        )
+        print(
+            f"{route:<14}{len(route_samples):>9}{quantiles[49]:>9.2f}"
+            f"{quantiles[94]:>9.2f}{quantiles[98]:>9.2f}"
+            f"{sum(commands.values()) / len(route_samples):>10.1f}  {top}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.routes")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument(
+        "--following", type=int, default=20, help="average number of followed users"
+    )
+    parser.add_argument(
+        "--alpha", type=float, default=1.2, help="exponent of the zipf distribution"
+    )
+    parser.add_argument(
+        "--images", type=float, default=0.1, help="ratio of tweets with an image"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="number of requests per route"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--routes",
+        nargs="+",
+        default=READ_ROUTES + WRITE_ROUTES,
+        choices=READ_ROUTES + WRITE_ROUTES,
+    )
+    parser.add_argument(
+        "--live", action="store_true", help="use the configured redis and s3"
+    )
+    parser.add_argument(
+        "--flush", action="store_true", help="confirm the database can be flushed"
+    )
+    args = parser.parse_args()
+    if args.live and not args.flush:
+        parser.error("the benchmark flushes the database, pass --flush to confirm")
+
+    if args.live:
+        offline.install_counter()
+    else:
+        mock = offline.install()
+
+    from twitter.app import app
+    from twitter.controllers.s3 import get_s3_client
+    from twitter.controllers.redis import get_redis_client
+    from benchmarks import seed
+
+    redis_client, s3_client = get_redis_client(), get_s3_client()
+    redis_client.reset_db()
+    start = time.perf_counter()
+    uids = seed.seed(
+        redis_client,
+        s3_client,
+        num_of_users=args.users,
+        num_of_tweets=args.tweets,
+        avg_following=args.following,
+        alpha=args.alpha,
+        image_ratio=args.images,
+        random_seed=args.seed,
+    )
+    print(
+        f"seeded {args.users} users and {args.tweets} tweets "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+    driver = Driver(app, redis_client, uids, random.Random(args.seed), seed.session_id)
+    for route in args.routes:
+        for _ in range(args.requests):
+            driver.request(route)
+    report(driver.samples)
+
+    redis_client.reset_db()
+    if args.live:
+        s3_client.reset_s3()
+    else:
+        mock.stop()
+
+
+#
+# Internal helper function
+#
+
+
+def _tweet_form(**fields):
+    return dict(fields, tweet_image=(io.BytesIO(b""), ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import time
+import random
+import argparse
+import itertools
+import statistics
+
+from twitter.controllers import keys
+from twitter.controllers import search
+from twitter.controllers.redis import get_redis_client
+
+#
+# search.py: latency of the search queries (see controllers/search.py) over a
+# large index
+#
+# usage: python -m benchmarks.search --flush [--tweets 1000000] [--shards 1]
+#
+# it needs a real redis server, which is flushed before and after the run; the
+# index of --tweets tweets of words drawn from a zipf distribution over a
+# --vocabulary of words is written directly (not the tweets themselves), then
+# each kind of query runs --queries times, its first page and its next page
+#
+
+BATCH_SIZE = 1000
+# kind of query --> the ranks its terms are drawn from (0 is the most frequent)
+QUERIES = {
+    "frequent": [(0, 10)],
+    "rare": [(1000, 10000)],
+    "frequent+rare": [(0, 10), (1000, 10000)],
+    "2 frequent": [(0, 10), (10, 100)],
+    "3 terms": [(0, 10), (10, 100), (100, 1000)],
+}
+
+
+def word(rank):
+    return f"w{rank}"
+
+
+# the index of the tweets, written in batches of terms
+def write_index(client, args, rng):
+    weights = list(
+        itertools.accumulate(
+            1 / (rank + 1) ** args.alpha for rank in range(args.vocabulary)
+        )
+    )
+    ranks = range(args.vocabulary)
+    start = 1600000000.0
+    for first in range(1, args.tweets + 1, BATCH_SIZE):
+        batch = {}
+        for tid in range(first, min(first + BATCH_SIZE, args.tweets + 1)):
+            n = tid % client.shards
+            words = rng.choices(ranks, cum_weights=weights, k=rng.randint(3, 20))
+            for term in search.get_terms(" ".join(map(word, words))):
+                batch.setdefault(keys.search_term(term, n), {})[tid] = start + tid
+        pipe = client.conn.pipeline(transaction=False)
+        for key, tids in batch.items():
+            pipe.zadd(key, tids)
+        pipe.execute()
+
+
+# ms of each query
+def timed(query, cursor, client):
+    start = time.perf_counter()
+    tids, next_cursor = search.search(query, cursor, client=client)
+    return (time.perf_counter() - start) * 1000, tids, next_cursor
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.search")
+    parser.add_argument("--tweets", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument(
+        "--alpha", type=float, default=1.0, help="exponent of the zipf distribution"
+    )
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--flush", action="store_true", help="confirm the database can be flushed"
+    )
+    args = parser.parse_args()
+    if not args.flush:
+        parser.error("the benchmark flushes the database, pass --flush to confirm")
+
+    rng = random.Random(args.seed)
+    client = get_redis_client()
+    client.reset_db()
+    client.conn.set(keys.SHARDS, args.shards)
+    client.reload_layout()
+    start = time.perf_counter()
+    write_index(client, args, rng)
+    print(f"indexed {args.tweets} tweets in {time.perf_counter() - start:.1f}s")
+    print(
+        f"{'query':<15}{'results':>9}{'first p50':>11}{'first p95':>11}"
+        f"{'next p50':>10}{'next p95':>10}"
+    )
+    for kind, ranges in QUERIES.items():
+        firsts, nexts, results = [], [], 0
+        for _ in range(args.queries):
+            query = " ".join(word(rng.randrange(*bounds)) for bounds in ranges)
+            elapsed, tids, cursor = timed(query, None, client)
+            firsts.append(elapsed)
+            results += len(tids)
+            if cursor:
+                nexts.append(timed(query, cursor, client)[0])
+        firsts = statistics.quantiles(firsts, n=100, method="inclusive")
+        line = f"{kind:<15}{results / args.queries:>9.1f}"
+        line += f"{firsts[49]:>11.2f}{firsts[94]:>11.2f}"
+        if len(nexts) > 1:
+            nexts = statistics.quantiles(nexts, n=100, method="inclusive")
+            line += f"{nexts[49]:>10.2f}{nexts[94]:>10.2f}"
+        print(line)
+    client.reset_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import random
+import tempfile
+from pathlib import Path
+
+from twitter.controllers import keys
+from twitter.controllers import records
+from twitter.controllers import users
+from twitter.controllers import timelines
+
+#
+# seed.py: synthetic users, follower graph and tweets, written directly in the
+# key layout of auth.google_login_callback and LoggedInUser.post_tweet
+#
+# the followed users are drawn from a zipf distribution (the i-th user has a
+# weight of 1 / i ** alpha), so that a few users have most of the followers
+#
+
+IMAGE = Path(__file__).parent.parent / "tests" / "test_image_supported.jpg"
+BATCH_SIZE = 1000
+
+
+# the sid of the seeded user
+def session_id(uid):
+    return f"bench-sid-{uid}"
+
+
+def seed(
+    redis_client,
+    s3_client,
+    num_of_users=1000,
+    num_of_tweets=10000,
+    avg_following=20,
+    alpha=1.2,
+    image_ratio=0.1,
+    random_seed=0,
+):
+    rng = random.Random(random_seed)
+    uids = [str(uid) for uid in range(1, num_of_users + 1)]
+    _seed_users(redis_client, uids)
+    _seed_follows(redis_client, rng, uids, avg_following, alpha)
+    _seed_tweets(redis_client, s3_client, rng, uids, num_of_tweets, image_ratio)
+    # build the timelines and counters, so that the pages are measured in their
+    # steady state
+    for uid in uids:
+        timelines.rebuild(uid, client=redis_client)
+    users.repair_all_counts(client=redis_client)
+    return uids
+
+
+def _seed_users(client, uids):
+    for batch in _batches(uids):
+        pipe = client.conn.pipeline(transaction=False)
+        for uid in batch:
+            email = f"bench{uid}@bench.com"
+            pipe.sadd(keys.shard(keys.UIDS, uid, client.shards), uid)
+            pipe.hset(
+                keys.user(uid),
+                mapping={
+                    "uid": uid,
+                    "email": email,
+                    "family_name": "bench",
+                    "given_name": f"user {uid}",
+                    "name": f"bench user {uid}",
+                    "locale": "en",
+                    "picture": "https://example.com/picture.png",
+                },
+            )
+            pipe.hset(keys.email_shard(email, client.shards), email, uid)
+            pipe.hset(session_id(uid), mapping={"email": email, "token": uid})
+        pipe.execute()
+    client.conn.set(keys.UID, len(uids))
+
+
+def _seed_follows(client, rng, uids, avg_following, alpha):
+    weights = [1 / (rank**alpha) for rank in range(1, len(uids) + 1)]
+    followers = {}
+    for batch in _batches(uids):
+        pipe = client.conn.pipeline(transaction=False)
+        for uid in batch:
+            count = min(int(rng.expovariate(1 / avg_following)) + 1, len(uids) - 1)
+            following = set(rng.choices(uids, weights=weights, k=count)) - {uid}
+            if not following:
+                continue
+            pipe.sadd(keys.following(uid), *following)
+            for other in following:
+                pipe.sadd(keys.followers(other), uid)
+                followers[other] = followers.get(other, 0) + 1
+        pipe.execute()
+    celebrities = [
+        uid
+        for uid, count in followers.items()
+        if count > timelines.FANOUT_MAX_FOLLOWERS
+    ]
+    if celebrities:
+        client.conn.sadd(keys.CELEBRITIES, *celebrities)
+        pipe = client.conn.pipeline(transaction=False)
+        for celebrity in celebrities:
+            for follower in client.conn.smembers(keys.followers(celebrity)):
+                pipe.sadd(keys.following_celebrities(follower), celebrity)
+        pipe.execute()
+
+
+def _seed_tweets(redis_client, s3_client, rng, uids, num_of_tweets, image_ratio):
+    # one image uploaded once, shared by every tweet with an image
+    iid = "1_benchmark.jpg"
+    with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+        f.write(IMAGE.read_bytes())
+        f.flush()
+        s3_client.upload_file(f.name, iid)
+    redis_client.conn.set(keys.IID, 1)
+    # the tweets of the last days, posted at regular intervals
+    start = 1600000000.0
+    tids = [str(tid) for tid in range(1, num_of_tweets + 1)]
+    shards, buckets = redis_client.shards, redis_client.tweet_buckets
+    for batch in _batches(tids):
+        pipe = redis_client.conn.pipeline(transaction=False)
+        for tid in batch:
+            uid = rng.choice(uids)
+            timestamp = start + int(tid) * 60
+            tweet = {
+                "tweet_text": f"benchmark tweet {tid}",
+                "timestamp": timestamp,
+                "uid": uid,
+            }
+            if rng.random() < image_ratio:
+                tweet.update({"image": iid})
+            records.write(pipe, tid, tweet, buckets)
+            pipe.zadd(keys.shard(keys.TIDS, tid, shards), {tid: timestamp})
+            pipe.zadd(keys.user_tweets(uid), {tid: timestamp})
+            if "image" in tweet:
+                pipe.zadd(keys.shard(keys.IMAGES, tid, shards), {tid: timestamp})
+        pipe.execute()
+    redis_client.conn.set(keys.TID, num_of_tweets)
+
+
+def _batches(items):
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start : start + BATCH_SIZE]
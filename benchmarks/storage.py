@@ -0,0 +1,159 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+from twitter.controllers import storage
+
+#
+# storage.py: the same workload against each storage backend (see
+# controllers/storage.py), writes per second and p50 / p95 latency of the reads
+#
+# usage: python -m benchmarks.storage --flush [--backend redis] [--backend sqlite]
+#   [--users 200] [--tweets 20000] [--following 50] [--reads 1000]
+#
+# the redis backend runs against the configured redis, which is flushed before
+# and after the run; the sqlite backend writes to a scratch file (--path, a
+# temporary file by default)
+#
+
+
+def open_storage(backend, path):
+    if backend == "redis":
+        return storage.RedisStorage()
+    return storage.SQLiteStorage(path)
+
+
+# ops/s of the operations
+def measure(backend, name, operations):
+    start = time.perf_counter()
+    for operation in operations:
+        operation()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{backend:<8}{name:<16}{len(operations):>8} ops"
+        f"{len(operations) / elapsed:>12.1f} ops/s"
+    )
+
+
+# p50 / p95 ms of the reads
+def latency(backend, name, reads):
+    timings = []
+    for read in reads:
+        start = time.perf_counter()
+        read()
+        timings.append((time.perf_counter() - start) * 1000)
+    quantiles = statistics.quantiles(timings, n=100, method="inclusive")
+    print(
+        f"{backend:<8}{name:<16}{len(reads):>8} ops"
+        f"{quantiles[49]:>9.3f} ms p50{quantiles[94]:>9.3f} ms p95"
+    )
+
+
+def run(backend, store, args):
+    rng = random.Random(args.seed)
+    uids = []
+    measure(
+        backend,
+        "signup",
+        [
+            lambda i=i: uids.append(
+                store.create_user({"email": f"bench{i}@bench.com", "name": f"{i}"})
+            )
+            for i in range(args.users)
+        ],
+    )
+    sids = {uid: f"bench-sid-{uid}" for uid in uids}
+    for uid, sid in sids.items():
+        store.create_session(sid, store.get_users([uid])[uid]["email"], sid)
+    measure(
+        backend,
+        "follow",
+        [
+            lambda uid=uid, other=other: store.follow(uid, other)
+            for uid in uids
+            for other in rng.sample(uids, min(args.following, len(uids)))
+        ],
+    )
+    start = time.time() - args.tweets
+    measure(
+        backend,
+        "post",
+        [
+            lambda i=i: store.post_tweet(
+                rng.choice(uids), {"tweet_text": f"benchmark {i}"}, start + i
+            )
+            for i in range(args.tweets)
+        ],
+    )
+    # the first read of a redis timeline builds it
+    for uid in uids:
+        store.get_timeline_page(uid)
+    latency(
+        backend,
+        "session",
+        [lambda: store.resolve_session(sids[rng.choice(uids)])] * args.reads,
+    )
+    latency(
+        backend,
+        "timeline",
+        [lambda: store.get_timeline_page(rng.choice(uids))] * args.reads,
+    )
+    latency(
+        backend,
+        "timeline 2 pages",
+        [lambda: two_pages(store, rng.choice(uids))] * args.reads,
+    )
+    latency(
+        backend,
+        "user tweets",
+        [lambda: store.get_user_tweets_page(rng.choice(uids))] * args.reads,
+    )
+    latency(
+        backend,
+        "load tweets",
+        [lambda: store.get_tweets(store.get_tweets_page()[0])] * args.reads,
+    )
+
+
+# the first 2 pages of the timeline (the second one from the cursor of the first)
+def two_pages(store, uid):
+    _, cursor = store.get_timeline_page(uid)
+    return store.get_timeline_page(uid, cursor)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.storage")
+    parser.add_argument(
+        "--backend", action="append", choices=["redis", "sqlite"], default=[]
+    )
+    parser.add_argument("--path", help="sqlite database file (temporary by default)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--tweets", type=int, default=20000)
+    parser.add_argument("--following", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--flush", action="store_true", help="confirm the database can be flushed"
+    )
+    args = parser.parse_args()
+    if not args.flush:
+        parser.error("the benchmark flushes the database, pass --flush to confirm")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.path or os.path.join(directory, "twitter.db")
+        for backend in args.backend or ["redis", "sqlite"]:
+            store = open_storage(backend, path)
+            store.reset_db()
+            try:
+                run(backend, store, args)
+            finally:
+                store.reset_db()
+                if backend == "sqlite":
+                    store.close()
+
+
+if __name__ == "__main__":
+    main()
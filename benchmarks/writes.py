@@ -0,0 +1,107 @@
+import time
+import argparse
+from werkzeug.datastructures import FileStorage
+
+from twitter.controllers import keys
+from twitter.controllers.redis import get_redis_client
+from twitter.controllers.users import LoggedInUser
+
+#
+# writes.py: writes per second of the tweet and follow operations
+#
+# usage: python -m benchmarks.writes --flush [--users 20] [--tweets 2000]
+#
+# the benchmark signs up its own users, so it must run against a scratch redis
+# database: it is flushed before and after the run
+#
+
+
+def signup(client, num_of_users):
+    users = []
+    for i in range(1, num_of_users + 1):
+        uid, email, sid = str(i), f"bench{i}@bench.com", f"bench-sid-{i}"
+        client.conn.sadd(keys.shard(keys.UIDS, uid, client.shards), uid)
+        client.conn.hset(
+            keys.user(uid), mapping={"uid": uid, "email": email, "name": f"bench {i}"}
+        )
+        client.conn.hset(keys.email_shard(email, client.shards), email, uid)
+        client.conn.hset(sid, mapping={"email": email, "token": sid})
+        users.append(LoggedInUser(sid, redis_client=client))
+    return users
+
+
+def measure(name, operations):
+    start = time.perf_counter()
+    for operation in operations:
+        operation()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<8} {len(operations):>7} ops {len(operations) / elapsed:>10.1f} ops/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.writes")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--tweets", type=int, default=2000)
+    parser.add_argument(
+        "--flush", action="store_true", help="confirm the database can be flushed"
+    )
+    args = parser.parse_args()
+    if not args.flush:
+        parser.error("the benchmark flushes the database, pass --flush to confirm")
+
+    client = get_redis_client()
+    client.reset_db()
+    users = signup(client, args.users)
+    # everybody follows everybody, so that each tweet is fanned out
+    measure(
+        "follow",
+        [
+            lambda user=user, other=other: user.follow(other.uid)
+            for user in users
+            for other in users
+            if user is not other
+        ],
+    )
+    # build the timelines, so that the tweets are written to them
+    for user in users:
+        user.timeline
+    image = {"tweet_image": FileStorage(filename="")}
+    measure(
+        "post",
+        [
+            lambda user=users[i % len(users)]: user.post_tweet(
+                image=dict(image), tweet_text="benchmark"
+            )
+            for i in range(args.tweets)
+        ],
+    )
+    tweets = [(user, tid) for user in users for tid in user.tweets]
+    measure(
+        "update",
+        [
+            lambda user=user, tid=tid: user.update_tweet(
+                tid, image=dict(image), tweet_text="updated"
+            )
+            for user, tid in tweets
+        ],
+    )
+    measure(
+        "delete",
+        [lambda user=user, tid=tid: user.del_tweet(tid) for user, tid in tweets],
+    )
+    measure(
+        "unfollow",
+        [
+            lambda user=user, other=other: user.unfollow(other.uid)
+            for user in users
+            for other in users
+            if user is not other
+        ],
+    )
+    client.reset_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,16 @@ import os
 import flask
 
 from twitter import auth
+from twitter import assets
+from twitter import pages
 from twitter.controllers import s3 as controllers_s3
-from twitter.controllers import redis as controllers_redis
+from twitter.controllers import metrics as controllers_metrics
+from twitter.controllers import steps as controllers_steps
+from twitter.controllers import storage as controllers_storage
+from twitter.controllers import fragments as controllers_fragments
 from twitter.controllers import users as controllers_users
 from twitter.controllers import tweets as controllers_tweets
-
+from twitter.controllers import pagination as controllers_pagination
 
 #
 # app entry point
@@ -16,187 +21,139 @@ app = flask.Flask(__name__)
 app.secret_key = os.environ["APP_SECRET_KEY"]
 app.config["MAX_CONTENT_LENGTH"] = os.environ.get("MAX_CONTENT_LENGTH", 5 * 1024 * 1024)
 app.register_blueprint(auth.blueprint)
+# version of the static files and templates, part of the pages' etags
+app.config["ASSETS_VERSION"] = assets.init_app(app)
+# the #tags and @mentions of the tweets link to their pages
+app.jinja_env.filters["linkify"] = pages.linkify
+
+# shared by every request of this worker (the bucket is checked once here)
+s3_client = controllers_s3.get_s3_client()
+# the users, tweets and pages (see STORAGE_BACKEND)
+store = controllers_storage.get_storage()
+
+
+@app.before_request
+def start_metrics():
+    if controllers_metrics.METRICS_ENABLED:
+        controllers_metrics.start_request(flask.request.endpoint)
+
+
+# the backend calls of the request, as a Server-Timing header
+@app.after_request
+def end_metrics(response):
+    timings = []
+    for backend, (calls, seconds) in controllers_metrics.end_request().items():
+        timings.append(f'{backend};dur={seconds * 1000:.2f};desc="{calls} calls"')
+    if timings:
+        response.headers["Server-Timing"] = ", ".join(timings)
+    return response
 
-s3_client = controllers_s3.S3Client()
-redis_client = controllers_redis.RedisClient()
 
-# personal home page
+# personal home page (see pages.home)
 @app.route("/")
 @auth.protect
 def home():
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    return _run_page(pages.home)
 
-    uid = current_user.uid
-    tids = controllers_tweets.get_all_tweets_ids()
-    # user info
-    logged_in_user = current_user.profile
-    # just grab the info we need
-    logged_in_user.update({"following_uids": current_user.following})
-    logged_in_user.update({"num_of_following": len(current_user.following)})
-    logged_in_user.update({"num_of_followers": len(current_user.followers)})
-    # tweets
-    tweets = []
-    for tid in tids:
-        tweet = controllers_tweets.Tweet(tid)
-        # extract the content
-        content = tweet.tweet
-        content.update({"user": controllers_users.User(tweet.uid).profile})
-        tweets.append(content)
-    tweets.sort(key=lambda x: x["timestamp"], reverse=True)
-    # all unfollowed users
-    uids = controllers_users.get_all_users_ids()
-    users = []
-    for uid in set(uids) - set(current_user.following) - set(current_user.uid):
-        user = controllers_users.User(uid).profile
-        users.append(user)
-    return flask.render_template(
-        "home.html",
-        logged_in_user=logged_in_user,
-        user=logged_in_user,
-        users=users,
-        tweets=tweets,
-    )
 
-
-# personal profile page
+# personal profile page (see pages.profile)
 @app.route("/profile")
 @auth.protect
 def profile():
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
-    logged_in_user = current_user.profile
-    # get current user's followers and following
-    logged_in_user.update({"following_uids": current_user.following})
-    logged_in_user.update({"num_of_following": len(current_user.following)})
-    logged_in_user.update({"num_of_followers": len(current_user.followers)})
-    following_users = []
-    for uid in current_user.following:
-        user = controllers_users.User(uid).profile
-        following_users.append(user)
-    followers = []
-    for uid in current_user.followers:
-        user = controllers_users.User(uid).profile
-        user.update({"is_following": uid in current_user.following})
-        followers.append(user)
-    # personal tweets (yourself and following uids)
-    uids = current_user.following
-    uids.append(current_user.uid)
-    tweets = []
-    for user_id in uids:
-        tids = controllers_users.User(user_id).tweets
-        for tid in tids:
-            tweet = controllers_tweets.Tweet(tid)
-            # extract the content
-            content = tweet.tweet
-            content.update({"user": controllers_users.User(tweet.uid).profile})
-            tweets.append(content)
-    tweets.sort(key=lambda x: x["timestamp"], reverse=True)
-    return flask.render_template(
-        "profile.html",
-        logged_in_user=logged_in_user,
-        user=logged_in_user,
-        following_users=following_users,
-        followers=followers,
-        tweets=tweets,
-    )
+    return _run_page(pages.profile)
 
 
-# get users' profile page
+# get users' profile page (see pages.guest_profile)
 @app.route("/users/<int:uid>/profile")
 @auth.protect
 def guest_profile(uid):
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
-    logged_in_user = current_user.profile
-    logged_in_user.update({"following": str(uid) in current_user.following})
-    logged_in_user.update({"following_uids": current_user.following})
-    # get visiting user's info, followers, and following
-    visiting_user = controllers_users.User(uid)
-    if not visiting_user.is_exist():
-        return flask.render_template("error/404.html"), 404
-    user = visiting_user.profile
-    user.update({"num_of_following": len(visiting_user.following)})
-    user.update({"num_of_followers": len(visiting_user.followers)})
-    # get visting user's tweets
-    tids = visiting_user.tweets
-    tweets = []
-    for tid in tids:
-        tweet = controllers_tweets.Tweet(tid)
-        # extract the content
-        content = tweet.tweet
-        content.update({"user": controllers_users.User(tweet.uid).profile})
-        tweets.append(content)
-    tweets.sort(key=lambda x: x["timestamp"], reverse=True)
-    return flask.render_template(
-        "profile.html",
-        logged_in_user=logged_in_user,
-        user=user,
-        tweets=tweets,
-    )
+    return _run_page(pages.guest_profile, uid)
 
 
 # get all tweet images
 @app.route("/gallery")
 @auth.protect
 def gallery():
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    current_user = _current_user()
 
-    uid = current_user.uid
-    tids = controllers_tweets.get_all_tweets_ids()
+    # only the tweets with an image
+    tids, next_cursor = store.get_images_page(flask.request.args.get("cursor"))
     # user info
     logged_in_user = current_user.profile
     # tweets
-    tweets = []
-    for tid in tids:
-        tweet = controllers_tweets.Tweet(tid)
-        # extract the content
-        content = tweet.tweet
-        content.update({"user": controllers_users.User(tweet.uid).profile})
-        tweets.append(content)
-    # all unfollowed users
-    uids = controllers_users.get_all_users_ids()
-    users = []
-    for uid in set(uids) - set(current_user.following) - set(current_user.uid):
-        user = controllers_users.User(uid).profile
-        users.append(user)
+    tweets = _load_tweets(tids)
     return flask.render_template(
         "gallery.html",
         logged_in_user=logged_in_user,
         user=logged_in_user,
         tweets=tweets,
+        next_cursor=next_cursor,
+    )
+
+
+# the tweets with all the words of the query, newest first
+@app.route("/search")
+@auth.protect
+def search():
+    current_user = _current_user()
+    query = flask.request.args.get("q", "").strip()
+    tids, next_cursor = store.search(query, flask.request.args.get("cursor"))
+    tweets = _render_tweets(_load_tweets(tids))
+    logged_in_user = current_user.profile
+    logged_in_user.update(
+        {
+            "following_uids": current_user.is_following_many(
+                tweet["uid"] for tweet in tweets
+            )
+        }
+    )
+    return flask.render_template(
+        "search.html",
+        logged_in_user=logged_in_user,
+        user=logged_in_user,
+        query=query,
+        tweets=tweets,
+        next_cursor=next_cursor,
     )
 
 
+# the tweets with the #tag, newest first
+@app.route("/tags/<tag>")
+@auth.protect
+def tag(tag):
+    tids, next_cursor = store.get_tag_page(tag, flask.request.args.get("cursor"))
+    return _render_tweets_page(f"#{tag.lower()}", tids, next_cursor)
+
+
+# the tweets mentioning the logged in user, newest first
+@app.route("/mentions")
+@auth.protect
+def mentions():
+    current_user = _current_user()
+    tids, next_cursor = current_user.mentions_page(flask.request.args.get("cursor"))
+    return _render_tweets_page("Mentions", tids, next_cursor, current_user)
+
+
 # get other Users
 @app.route("/people")
 @auth.protect
 def people():
-    uids = controllers_users.get_all_users_ids()
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
-    uids.remove(current_user.uid)
+    uids, next_cursor = store.get_users_page(flask.request.args.get("cursor"))
+    current_user = _current_user()
+    if current_user.uid in uids:
+        uids.remove(current_user.uid)
+    following = current_user.is_following_many(uids)
     logged_in_user = current_user.profile
 
     users = []
-    for user_id in uids:
-        user = controllers_users.User(user_id).profile
-        user.update(
-            {
-                "following": redis_client.conn.sismember(
-                    f"following:{current_user.uid}", user_id
-                ),
-            }
-        )
+    for user_id, user in store.get_users(uids).items():
+        user.update({"following": user_id in following})
         users.append(user)
     return flask.render_template(
-        "people.html", logged_in_user=logged_in_user, users=users
+        "people.html",
+        logged_in_user=logged_in_user,
+        users=users,
+        next_cursor=next_cursor,
     )
 
 
@@ -205,11 +162,9 @@ def people():
 @auth.protect
 def following(uid):
     # check if the logged in user is doing something unexpected, e.g. follow / unfollow non-existing user
-    if not redis_client.validate_user_id(uid):
+    if not store.user_exists(uid):
         flask.abort(400, "Unexpected Client Side Error.")
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    current_user = _current_user()
     method = flask.request.form.get("_method")
     if method == "follow":
         if not current_user.follow(uid):
@@ -219,6 +174,7 @@ def following(uid):
             flask.abort(500, "Unexpected Server Side Error.")
     else:
         flask.abort(500, "Unexpected Server Side Error.")
+    auth.stick_to_primary()
     return flask.redirect(flask.request.form.get("_redirect"))
 
 
@@ -226,9 +182,7 @@ def following(uid):
 @app.route("/tweet/new", methods=["GET"])
 @auth.protect
 def new_tweet_form():
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    current_user = _current_user()
     return flask.render_template("add_tweet.html", user=current_user.profile)
 
 
@@ -236,11 +190,10 @@ def new_tweet_form():
 @app.route("/tweets", methods=["POST"])
 @auth.protect
 def new_tweet():
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    current_user = _current_user()
     if not current_user.post_tweet(**flask.request.form, image=flask.request.files):
         return f"<p>The uploaded image is not in an allowed format. Allowed Formats are {controllers_tweets.ALLOWED_UPLOAD_EXTENSIONS}"
+    auth.stick_to_primary()
     return flask.redirect(flask.url_for("home"))
 
 
@@ -249,18 +202,16 @@ def new_tweet():
 @auth.protect
 def get_tweet(tid):
     # get current user's info and followers
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    current_user = _current_user()
 
-    tweet = controllers_tweets.Tweet(tid)
+    tweet = controllers_tweets.Tweet(tid, s3_client=s3_client, store=store)
     if not tweet.is_exist():
         return flask.abort(400, "Unexpected Client side error.")
 
     return flask.render_template(
         "tweet.html",
         logged_in_user=current_user.profile,
-        user=controllers_users.User(tweet.uid).profile,
+        user=controllers_users.User(tweet.uid, store=store).profile,
         old_form=tweet.tweet,
     )
 
@@ -269,11 +220,9 @@ def get_tweet(tid):
 @app.route("/tweets/<int:tid>", methods=["POST"])
 @auth.protect
 def change_tweet(tid):
-    current_user = controllers_users.LoggedInUser(
-        flask.g.sid, redis_client=redis_client, s3_client=s3_client
-    )
+    current_user = _current_user()
 
-    tweet = controllers_tweets.Tweet(tid)
+    tweet = controllers_tweets.Tweet(tid, s3_client=s3_client, store=store)
     if not tweet.is_exist():
         return flask.abort(400, "Unexpected Client side error.")
 
@@ -290,9 +239,87 @@ def change_tweet(tid):
             flask.abort(500, "Server side error, delete not suceess.")
     else:
         flask.abort(500, "Server side error, update / delete not suceess.")
+    auth.stick_to_primary()
     return flask.redirect(flask.request.form.get("_redirect"))
 
 
+# cache statistics of this worker
+@app.route("/stats", methods=["GET"])
+@auth.protect
+def stats():
+    return flask.jsonify(
+        {
+            "presigned_urls": s3_client.url_cache.stats(),
+            "fragments": controllers_fragments.get_fragment_cache().stats(),
+        }
+    )
+
+
+# backend calls of this worker, in the prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return flask.Response(
+        controllers_metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     return flask.render_template("error/404.html"), 404
+
+
+@app.errorhandler(controllers_pagination.InvalidCursor)
+def invalid_cursor(e):
+    return "Unexpected Client Side Error.", 400
+
+
+#
+# Internal helper function
+#
+
+
+# the logged in user, from the session resolved by auth.protect
+def _current_user():
+    return controllers_users.LoggedInUser(
+        flask.g.sid, s3_client=s3_client, session=auth.get_session(), store=store
+    )
+
+
+# a page of the given tweets under the heading
+def _render_tweets_page(heading, tids, next_cursor, current_user=None):
+    current_user = current_user or _current_user()
+    tweets = _render_tweets(_load_tweets(tids))
+    logged_in_user = current_user.profile
+    logged_in_user.update(
+        {
+            "following_uids": current_user.is_following_many(
+                tweet["uid"] for tweet in tweets
+            )
+        }
+    )
+    return flask.render_template(
+        "tweets.html",
+        logged_in_user=logged_in_user,
+        user=logged_in_user,
+        heading=heading,
+        tweets=tweets,
+        next_cursor=next_cursor,
+    )
+
+
+# the page of the steps of pages.py, run one after the other
+def _run_page(page, *args):
+    reads = store.reads()
+    return controllers_steps.run(page(reads, auth.get_session(), s3_client, *args))
+
+
+# hydrate tweets and their (deduplicated) authors in two round trips
+def _load_tweets(tids):
+    tweets = controllers_steps.run(pages.load_tweets(store.reads(), tids, s3_client))
+    pages.add_authors(tweets, store.get_users(tweet["uid"] for tweet in tweets))
+    return tweets
+
+
+# the tweets' html shared by all the viewers (cached, see fragments.py)
+def _render_tweets(tweets):
+    return controllers_steps.run(pages.render_tweets(store.reads(), tweets))
@@ -0,0 +1,131 @@
+import io
+import sys
+import flask
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+
+from twitter import pages
+from twitter.app import app as wsgi_app
+from twitter.app import s3_client
+from twitter.controllers import aio
+from twitter.controllers import steps
+from twitter.controllers import pagination
+from twitter.controllers import storage as controllers_storage
+
+#
+# asgi.py: async entry point, e.g. uvicorn --workers 4 twitter.asgi:app
+#
+# the timeline pages (home, profile, guest_profile) are served on the event loop,
+# by the same pages and request hooks as the sync app (see pages.py), with their
+# independent redis calls in flight at the same time (see aio.py); on a redis
+# cluster or on the sqlite storage their reads run in the default executor
+# instead; every other request (the writes, the login, an anonymous or invalid
+# session...) is served by the sync app (app.py) in a thread pool
+#
+
+# the sync app, for everything the async views do not serve
+fallback = WsgiToAsgi(wsgi_app)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    response = None
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+        response = await _serve(scope)
+    if response is None:
+        return await fallback(scope, receive, send)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [
+                (name.lower().encode("latin1"), value.encode("latin1"))
+                for name, value in response.headers.items()
+            ],
+        }
+    )
+    body = response.get_data() if scope["method"] != "HEAD" else b""
+    await send({"type": "http.response.body", "body": body})
+
+
+# endpoint of the sync app --> its page, run on the event loop (see pages.py)
+VIEWS = {
+    "home": pages.home,
+    "profile": pages.profile,
+    "guest_profile": pages.guest_profile,
+}
+
+
+#
+# Internal helper function
+#
+
+
+# the response of the async view of the request, None if the sync app serves it
+async def _serve(scope):
+    environ = _environ(scope)
+    try:
+        endpoint, args = wsgi_app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return None
+    if endpoint not in VIEWS:
+        return None
+    with wsgi_app.request_context(environ):
+        if flask.session.get("sid") is None:
+            return None
+        # the hooks of the sync app (the session id, the reads from the primary
+        # after a write, the metrics)
+        response = wsgi_app.preprocess_request()
+        if response is None:
+            reads = aio.get_async_reads(controllers_storage.get_storage())
+            session = await steps.run_async(reads.resolve_session(flask.g.sid))
+            if session is None:
+                return None
+            # the session resolved once per request (see auth.get_session)
+            flask.g.resolved_session = session
+            page = VIEWS[endpoint](reads, session, s3_client, **args)
+            try:
+                response = await steps.run_async(page)
+            except pagination.InvalidCursor as e:
+                response = wsgi_app.handle_user_exception(e)
+        return wsgi_app.process_response(wsgi_app.make_response(response))
+
+
+# the wsgi environ of a request without a body (see PEP 3333)
+def _environ(scope):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin1"),
+        "PATH_INFO": scope["path"].encode().decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        value = value.decode("latin1")
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,71 @@
+import os
+import hashlib
+
+# seconds the browsers keep a fingerprinted static file (a changed file gets a
+# new name, so it is never stale)
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", 365 * 24 * 3600))
+
+#
+# assets.py: fingerprinted static files, url_for("static", filename="style.css")
+# is /static/style.<hash>.css and it is served with long-lived cache headers
+# (the plain names are still served, with the default headers)
+#
+
+
+# fingerprint the static files of the app, returns the version of its static
+# files and templates (it changes with every deployment changing the pages)
+def init_app(app):
+    # name --> fingerprinted name, and back
+    fingerprints, originals = {}, {}
+    for filename, digest in _digests(app.static_folder):
+        fingerprinted = _fingerprint(filename, digest)
+        fingerprints[filename] = fingerprinted
+        originals[fingerprinted] = filename
+
+    @app.url_defaults
+    def fingerprint_static_url(endpoint, values):
+        if endpoint == "static" and values.get("filename") in fingerprints:
+            values["filename"] = fingerprints[values["filename"]]
+
+    def static(filename):
+        if filename not in originals:
+            return app.send_static_file(filename)
+        response = app.send_static_file(originals[filename])
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions["static"] = static
+
+    version = hashlib.sha1()
+    for folder in (app.static_folder, os.path.join(app.root_path, app.template_folder)):
+        for filename, digest in _digests(folder):
+            version.update(f"{filename}:{digest}\n".encode())
+    return version.hexdigest()[:16]
+
+
+#
+# Internal helper function
+#
+
+
+# (name relative to the folder, digest of the content) of the files in it
+def _digests(folder):
+    digests = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:12]
+            filename = os.path.relpath(path, folder).replace(os.sep, "/")
+            digests.append((filename, digest))
+    return sorted(digests)
+
+
+# style.css --> style.<digest>.css
+def _fingerprint(filename, digest):
+    directory, _, name = filename.rpartition("/")
+    stem, dot, extension = name.partition(".")
+    name = f"{stem}.{digest}{dot}{extension}"
+    return f"{directory}/{name}" if directory else name
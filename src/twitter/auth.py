@@ -1,10 +1,12 @@
 import os
+import time
 import flask
 import functools
 from requests import post
 from pathlib import Path
 
-from twitter.controllers.redis import RedisClient
+from twitter.controllers import storage
+from twitter.controllers import redis as controllers_redis
 
 from google.auth.transport import requests as google_requests
 from google.oauth2 import id_token
@@ -29,7 +31,8 @@ SCOPES = [
     "https://www.googleapis.com/auth/userinfo.profile",
 ]
 
-redis_client = RedisClient()
+# the users and sessions (see STORAGE_BACKEND)
+store = storage.get_storage()
 
 #
 # auth.py: module's entry point
@@ -43,6 +46,10 @@ def get_session_id():
     # store the session id in flask if it exists in the session cookies,
     # and use it to retrive the credentials from the database
     flask.g.sid = flask.session.get("sid")
+    # the user wrote a moment ago, read from the primary (see stick_to_primary)
+    controllers_redis.read_from_primary(
+        flask.session.get("primary_until", 0) > time.time()
+    )
 
 
 @blueprint.route("/login")
@@ -58,7 +65,7 @@ def logout():
     sid = flask.g.sid
     if not sid:
         return flask.redirect(flask.url_for("home"))
-    (token,) = redis_client.conn.hmget(sid, "token")
+    token = store.delete_session(sid)
     if not token:
         return flask.redirect(flask.url_for("home"))
     post(
@@ -66,7 +73,6 @@ def logout():
         params={"token": token},
         headers={"content-type": "application/x-www-form-urlencoded"},
     )
-    redis_client.conn.hdel(sid, "token", "email")
     # Clear the session
     flask.session.clear()
     # Redirect back to index page
@@ -92,47 +98,25 @@ def google_login_callback():
 
     # (sign up)
     # email should be enough to uniquely identified a user x
-    if not redis_client.conn.sismember("emails", id_info["email"]):
-        # keep a set of emails which is used to identify the user
-        redis_client.conn.sadd("emails", id_info["email"])
-        uid = redis_client.conn.incr("uid")
-        redis_client.conn.sadd("uids", uid)
-
-        # users:<uid> --> user info
-        redis_client.conn.hmset(
-            f"users:{uid}",
+    if store.get_uid(id_info["email"]) is None:
+        store.create_user(
             {
-                "uid": uid,
                 "email": id_info["email"],  # email should always exists
                 "family_name": id_info.get("family_name"),
                 "given_name": id_info.get("given_name"),
                 "name": id_info.get("name"),
                 "locale": id_info.get("locale"),
                 "picture": id_info.get("picture"),
-            },
-        )
-        # [users] email--> uid
-        redis_client.conn.hset("users", id_info["email"], uid)
-
-        # save the session id in the session cookies
-        flask.session["sid"] = os.urandom(64)
-        # save the email and access token to the database: sid --> {email, access token}
-        redis_client.conn.hmset(
-            flask.session["sid"],
-            {"email": id_info["email"], "token": credentials.token},
+            }
         )
 
-        # delegate to index page to handle other redirection
-        return flask.redirect(flask.url_for("home"))
-
     # (log in)
     # save the session id in the session cookies
     flask.session["sid"] = os.urandom(64)
     # save the email and access token to the database: sid --> {email, access token}
-    redis_client.conn.hmset(
-        flask.session["sid"], {"email": id_info["email"], "token": credentials.token}
-    )
+    store.create_session(flask.session["sid"], id_info["email"], credentials.token)
 
+    stick_to_primary()
     # delegate to home page to handle other redirection
     return flask.redirect(flask.url_for("home"))
 
@@ -142,6 +126,25 @@ def google_login_callback():
 #
 
 
+# the user wrote, the reads of this request and of the user's next requests
+# (for REDIS_STICKY_SECONDS) go to the primary, so that the user sees the write
+# even if the replicas lag behind (the deadline is kept in the session cookie,
+# as the next request may be served by another worker)
+def stick_to_primary():
+    controllers_redis.read_from_primary()
+    if store.has_replicas:
+        deadline = time.time() + controllers_redis.REDIS_STICKY_SECONDS
+        flask.session["primary_until"] = deadline
+
+
+# the resolved session of the request (see Storage.resolve_session), it is
+# resolved once per request, None if there is no session or it is invalid
+def get_session():
+    if "resolved_session" not in flask.g:
+        flask.g.resolved_session = flask.g.sid and store.resolve_session(flask.g.sid)
+    return flask.g.resolved_session
+
+
 # check to see if the user is a logged in users only
 def protect(view):
     @functools.wraps(view)
@@ -151,8 +154,8 @@ def protect(view):
             return flask.render_template("index.html")
         elif flask.g.sid is None:
             return flask.render_template("error/403.html")
-        # if exists, validate session id
-        elif not redis_client.validate_session_id(flask.g.sid):
+        # if exists, validate session id (and resolve it for the view)
+        elif not get_session():
             flask.session.clear()
             flask.abort(400, "Unexpected Client Side Error.")
         return view(**kwargs)
@@ -1,11 +1,117 @@
+import os
+import sys
+import argparse
+
 from twitter.app import app
+from twitter.controllers import tweets as controllers_tweets
+from twitter.controllers import dataset as controllers_dataset
+from twitter.controllers import migrations as controllers_migrations
+from twitter.controllers import search as controllers_search
+from twitter.controllers import users as controllers_users
+from twitter.controllers import uploads as controllers_uploads
+from twitter.controllers import storage as controllers_storage
+
+# the maintenance commands of the redis layout (see keys.py)
+REDIS_COMMANDS = (
+    "migrate",
+    "migrate-layout",
+    "pack-tweets",
+    "search-index",
+    "export",
+    "import",
+    "images",
+    "counters",
+    "thumbnails",
+)
 
 
 def main(*args):
-    app.run(
-        host="localhost",
-        port=5000,
+    parser = argparse.ArgumentParser(prog="twitter")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="run the development server (default)")
+    commands.add_parser(
+        "migrate", help="convert the tweets indexes to time ordered sorted sets"
+    )
+    worker = commands.add_parser("worker", help="upload the tweets' images to s3")
+    worker.add_argument(
+        "--threads", type=int, default=controllers_uploads.UPLOAD_WORKERS
+    )
+    commands.add_parser(
+        "thumbnails", help="queue the derivatives of the existing images"
+    )
+    commands.add_parser(
+        "counters", help="recompute the followers / following / tweets counters"
+    )
+    commands.add_parser("images", help="index the existing tweets with an image")
+    layout = commands.add_parser(
+        "migrate-layout",
+        help="convert the keys to the cluster layout, or reshard the indexes",
     )
+    layout.add_argument("--shards", type=int, default=None)
+    packing = commands.add_parser(
+        "pack-tweets", help="pack the tweets into buckets, or unpack them (0)"
+    )
+    packing.add_argument("buckets", type=int)
+    commands.add_parser(
+        "search-index", help="rebuild the search, tags and mentions indexes"
+    )
+    exporting = commands.add_parser(
+        "export", help="write the users, follows and tweets as ndjson"
+    )
+    exporting.add_argument(
+        "path", help="file (- for stdout), the parts go to <path>.<n> with --workers"
+    )
+    exporting.add_argument("--workers", type=int, default=1)
+    exporting.add_argument("--batch-size", type=int, default=1000)
+    importing = commands.add_parser("import", help="import the ndjson of an export")
+    importing.add_argument("paths", nargs="+", help="files (- for stdin)")
+    importing.add_argument("--workers", type=int, default=os.cpu_count())
+    importing.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(args or None)
+    if (
+        args.command in REDIS_COMMANDS
+        and controllers_storage.STORAGE_BACKEND != "redis"
+    ):
+        parser.error(f"{args.command} only runs on the redis storage (STORAGE_BACKEND)")
+
+    if args.command == "migrate":
+        converted = controllers_tweets.migrate_indexes()
+        print(f"Converted {converted} index(es).")
+    elif args.command == "migrate-layout":
+        converted, moved = controllers_migrations.migrate_layout(args.shards)
+        print(f"Converted {converted} key(s), moved {moved} index entry(ies).")
+    elif args.command == "pack-tweets":
+        repacked = controllers_migrations.repack_tweets(args.buckets)
+        print(f"Repacked {repacked} tweet(s).")
+    elif args.command == "search-index":
+        indexed = controllers_search.reindex()
+        print(f"Indexed {indexed} tweet(s).")
+    elif args.command == "export":
+        written = controllers_dataset.export_parallel(
+            args.path, args.workers, args.batch_size
+        )
+        print(f"Exported {written} line(s).", file=sys.stderr)
+    elif args.command == "import":
+        imported = controllers_dataset.import_parallel(
+            args.paths, args.workers, args.batch_size
+        )
+        print(f"Imported {imported} line(s).")
+    elif args.command == "worker":
+        controllers_uploads.UploadWorker().run(args.threads)
+    elif args.command == "images":
+        indexed = controllers_tweets.index_images()
+        print(f"Indexed {indexed} tweet(s) with an image.")
+    elif args.command == "counters":
+        repaired = controllers_users.repair_all_counts()
+        print(f"Recomputed the counters of {repaired} user(s).")
+    elif args.command == "thumbnails":
+        queued = controllers_uploads.backfill()
+        print(f"Queued {queued} image(s), run `twitter worker` to process them.")
+    else:
+        app.run(
+            host="localhost",
+            port=5000,
+        )
 
 
 if __name__ == "__main__":
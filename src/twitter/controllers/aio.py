@@ -0,0 +1,172 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import redis.asyncio
+
+from twitter.controllers import keys
+from twitter.controllers import metrics
+from twitter.controllers import storage
+from twitter.controllers import redis as controllers_redis
+
+#
+# aio.py: the async redis client of the async app (see asgi.py)
+#
+# it has the calls of the sync RedisClient used by the reads of the pages, so
+# that the reads are written once as steps (see steps.py and
+# storage.RedisReads) and run on the event loop with it; the reads of a redis
+# cluster or of another storage run in the default executor instead
+#
+
+
+# records each command (and each pipeline as one call) in metrics
+class InstrumentedAsyncRedis(redis.asyncio.Redis):
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            metrics.record("redis", str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedAsyncPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error=raise_on_error)
+        finally:
+            metrics.record("redis", "PIPELINE", time.perf_counter() - start)
+
+
+# same as controllers_redis.RedisClient for the reads, on a single server
+class AsyncRedisClient(object):
+    def __init__(self, connection_pool=None, replica_pools=()):
+        redis_class = (
+            InstrumentedAsyncRedis if metrics.METRICS_ENABLED else redis.asyncio.Redis
+        )
+        self._conn = redis_class(
+            connection_pool=connection_pool or _new_connection_pool()
+        )
+        self._replicas = [redis_class(connection_pool=pool) for pool in replica_pools]
+        self._scripts = {}
+        self._shards = None
+        self._tweet_buckets = None
+
+    @property
+    def conn(self):
+        return self._conn
+
+    # a replica for the reads, the primary if there is none or if the current
+    # request reads its own writes (see controllers_redis.read_from_primary)
+    @property
+    def read_conn(self):
+        if not self._replicas or controllers_redis.reads_from_primary():
+            return self._conn
+        return random.choice(self._replicas)
+
+    @property
+    def has_replicas(self):
+        return bool(self._replicas)
+
+    # the client of the sync controllers (e.g. building a timeline)
+    @property
+    def sync_client(self):
+        return controllers_redis.get_redis_client()
+
+    async def get_shards(self):
+        if self._shards is None:
+            self._shards = int(await self.conn.get(keys.SHARDS) or 1)
+        return self._shards
+
+    async def get_tweet_buckets(self):
+        if self._tweet_buckets is None:
+            self._tweet_buckets = int(await self.conn.get(keys.TWEET_BUCKETS) or 0)
+        return self._tweet_buckets
+
+    async def mget(self, keys):
+        return await self.read_conn.mget(keys)
+
+    async def run_script(self, script, keys=(), args=(), read_only=False):
+        if script not in self._scripts:
+            self._scripts[script] = self.conn.register_script(script)
+        conn = self.read_conn if read_only else self.conn
+        return await self._scripts[script](
+            keys=list(keys), args=list(args), client=conn
+        )
+
+
+# the reads of the storage for the async app (see Storage.reads): on the event
+# loop on a single redis server, in the default executor otherwise
+def get_async_reads(store):
+    if isinstance(store, storage.RedisStorage) and not controllers_redis.REDIS_CLUSTER:
+        return store.reads(get_async_redis_client())
+    return storage.BlockingReads(store)
+
+
+#
+# Internal helper function
+#
+
+
+def _new_connection_pool(
+    host=controllers_redis.REDIS_HOST, port=controllers_redis.REDIS_PORT
+):
+    return redis.asyncio.BlockingConnectionPool(
+        host=host,
+        port=port,
+        decode_responses=True,
+        max_connections=controllers_redis.REDIS_MAX_CONNECTIONS,
+        timeout=controllers_redis.REDIS_POOL_TIMEOUT,
+    )
+
+
+# the pools of the REDIS_REPLICAS (none with a pool factory, e.g. a fake redis)
+def _new_replica_pools():
+    if _pool_factory is not _new_connection_pool:
+        return []
+    pools = []
+    for replica in controllers_redis.REDIS_REPLICAS:
+        host, _, port = replica.rpartition(":")
+        pools.append(_new_connection_pool(host, int(port)))
+    return pools
+
+
+#
+# Process-wide registry
+#
+
+# the connections of an asyncio pool belong to the event loop that opened them,
+# so the client is re-created whenever the pid or the running loop changes
+_lock = threading.Lock()
+_client = None
+_loop = None
+_pid = None
+_pool_factory = _new_connection_pool
+
+
+def get_async_redis_client():
+    global _client, _loop, _pid
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if _client is None or _loop is not loop or _pid != os.getpid():
+            _client = AsyncRedisClient(
+                connection_pool=_pool_factory(), replica_pools=_new_replica_pools()
+            )
+            _loop = loop
+            _pid = os.getpid()
+        return _client
+
+
+# create the pools with the given factory in this process instead of connecting
+# to the configured redis server (e.g. the fake redis of the offline benchmarks)
+def set_connection_pool_factory(factory):
+    global _client, _pool_factory
+    with _lock:
+        _pool_factory = factory
+        _client = None
@@ -0,0 +1,292 @@
+from collections import Counter
+
+from twitter.controllers import keys
+from twitter.controllers import records
+from twitter.controllers import scripts
+
+#
+# cluster.py: the scripts using the keys of several hash slots (see scripts.py)
+# run as their steps on a redis cluster (see RedisClient.run_script), with the
+# same arguments and results
+#
+# the writes of a tweet, of its author and of each follower are atomic in their
+# own slot (scripts.TWEET_* / USER_*), the global indexes and the other users
+# are written with single key commands, pipelined per node; a tweet is written
+# before it is indexed and it is deleted before it is unindexed, a reader may
+# see it in an index after it is deleted (the missing tweets are skipped when
+# they are loaded, see Tweet.load_many)
+#
+
+
+# same as scripts.POST_TWEET
+def post_tweet(client, script_keys, args):
+    uid, timestamp, max_length, *fields = args
+    uid = str(uid)
+    tid = client.conn.incr(keys.TID)
+    tweet = {"timestamp": timestamp, "uid": uid, "version": 1}
+    tweet.update(zip(fields[::2], fields[1::2]))
+    pipe = client.conn.pipeline(transaction=False)
+    records.write(pipe, tid, tweet, client.tweet_buckets)
+    pipe.zadd(keys.shard(keys.TIDS, tid, client.shards), {tid: timestamp})
+    if "image" in tweet:
+        pipe.zadd(keys.shard(keys.IMAGES, tid, client.shards), {tid: timestamp})
+        if script_keys:
+            pipe.lpush(script_keys[0], f"{tid}:{tweet['image']}")
+    pipe.sismember(keys.CELEBRITIES, uid)
+    celebrity = pipe.execute()[-1]
+    _tweeted(client, uid, tid, timestamp, max_length, celebrity)
+    return tid
+
+
+# same as scripts.UPDATE_TWEET
+def update_tweet(client, script_keys, args):
+    uid, tid, timestamp, max_length, image, *_ = args
+    uid = str(uid)
+    updated, *previous = client.run_script(
+        scripts.TWEET_UPDATE,
+        keys=[keys.tweet_key(tid, client.tweet_buckets)],
+        args=args,
+    )
+    if not updated:
+        return [0]
+    pipe = client.conn.pipeline(transaction=False)
+    pipe.zadd(keys.shard(keys.TIDS, tid, client.shards), {tid: timestamp})
+    if image:
+        pipe.zadd(keys.shard(keys.IMAGES, tid, client.shards), {tid: timestamp})
+        if script_keys:
+            pipe.lpush(script_keys[0], f"{tid}:{image}")
+    else:
+        pipe.zrem(keys.shard(keys.IMAGES, tid, client.shards), tid)
+    pipe.sismember(keys.CELEBRITIES, uid)
+    celebrity = pipe.execute()[-1]
+    _tweeted(client, uid, tid, timestamp, max_length, celebrity)
+    return [1, *previous]
+
+
+# same as scripts.DELETE_TWEET
+def delete_tweet(client, script_keys, args):
+    uid, tid = (str(arg) for arg in args)
+    deleted, *deleted_tweet = client.run_script(
+        scripts.TWEET_DELETE,
+        keys=[keys.tweet_key(tid, client.tweet_buckets)],
+        args=[uid, tid],
+    )
+    if not deleted:
+        return [0]
+    pipe = client.conn.pipeline(transaction=False)
+    pipe.zrem(keys.shard(keys.TIDS, tid, client.shards), tid)
+    pipe.zrem(keys.shard(keys.IMAGES, tid, client.shards), tid)
+    pipe.sismember(keys.CELEBRITIES, uid)
+    celebrity = pipe.execute()[-1]
+    _tweeted(client, uid, tid, None, 0, celebrity)
+    return [1, *deleted_tweet]
+
+
+# same as scripts.FOLLOW
+def follow(client, script_keys, args):
+    uid, other, max_followers, max_length = args
+    uid, other = str(uid), str(other)
+    conn = client.conn
+    followers = client.run_script(
+        scripts.USER_FOLLOWED, keys=[keys.followers(other)], args=[other, uid]
+    )
+    # the followers merge the new celebrity's tweets on read from now on
+    if followers > int(max_followers) and conn.sadd(keys.CELEBRITIES, other):
+        pipe = conn.pipeline(transaction=False)
+        for follower in conn.smembers(keys.followers(other)):
+            pipe.sadd(keys.following_celebrities(follower), other)
+        pipe.execute()
+    celebrity = conn.sismember(keys.CELEBRITIES, other)
+    built = client.run_script(
+        scripts.USER_FOLLOW,
+        keys=[keys.following(uid)],
+        args=[uid, other, int(celebrity)],
+    )
+    if built and not celebrity:
+        tweets = conn.zrevrange(
+            keys.user_tweets(other), 0, int(max_length) - 1, withscores=True
+        )
+        if tweets:
+            pipe = conn.pipeline(transaction=False)
+            pipe.zadd(keys.timeline(uid), dict(tweets))
+            pipe.zremrangebyrank(keys.timeline(uid), 0, -int(max_length) - 1)
+            pipe.execute()
+    return 1
+
+
+# same as scripts.UNFOLLOW
+def unfollow(client, script_keys, args):
+    uid, other, max_length = args
+    uid, other = str(uid), str(other)
+    client.run_script(
+        scripts.USER_UNFOLLOW, keys=[keys.following(uid)], args=[uid, other]
+    )
+    client.run_script(
+        scripts.USER_UNFOLLOWED, keys=[keys.followers(other)], args=[other, uid]
+    )
+    tids = client.conn.zrevrange(keys.user_tweets(other), 0, int(max_length) - 1)
+    if tids:
+        client.conn.zrem(keys.timeline(uid), *tids)
+    return 1
+
+
+# same as scripts.FINISH_UPLOAD
+def finish_upload(client, script_keys, args):
+    job, tid, *_ = args
+    client.conn.lrem(script_keys[0], 1, job)
+    uid = client.run_script(
+        scripts.TWEET_IMAGE_UPLOADED,
+        keys=[keys.tweet_key(tid, client.tweet_buckets)],
+        args=args,
+    )
+    if uid is None:
+        return 0
+    celebrity = client.conn.sismember(keys.CELEBRITIES, uid)
+    followers = client.run_script(
+        scripts.USER_TOUCHED, keys=[keys.user_tweets(uid)], args=[uid, int(celebrity)]
+    )
+    _fan_out(client, followers)
+    return 1
+
+
+# same as scripts.RESOLVE_SESSION
+def resolve_session(client, script_keys, args):
+    conn = client.conn
+    email = conn.hget(script_keys[0], "email")
+    if not email:
+        return []
+    uid = conn.hget(keys.email_shard(email, client.shards), email)
+    if not uid:
+        return []
+    pipe = conn.pipeline(transaction=False)
+    pipe.sismember(keys.shard(keys.UIDS, uid, client.shards), uid)
+    pipe.hgetall(keys.user(uid))
+    exists, profile = pipe.execute()
+    if not exists:
+        return []
+    return [uid] + [item for field_value in profile.items() for item in field_value]
+
+
+# same as scripts.SUGGEST
+def suggest(client, script_keys, args):
+    uid, size, random_size, sample, fanout, ttl = args
+    uid, size, random_size = str(uid), int(size), int(random_size)
+    conn = client.conn
+    key, following = keys.suggestions(uid), keys.following(uid)
+    # mutual follows among a bounded sample of the followed users' follows
+    pipe = conn.pipeline(transaction=False)
+    for followed in conn.srandmember(following, sample):
+        pipe.srandmember(keys.following(followed), fanout)
+    mutuals = Counter(user_id for follows in pipe.execute() for user_id in follows)
+    ranked = [user_id for user_id, _ in mutuals.most_common()]
+    random_uids = conn.srandmember(script_keys[0], size * 2)
+    candidates = [
+        user_id for user_id in dict.fromkeys(ranked + random_uids) if user_id != uid
+    ]
+    followed = conn.smismember(following, candidates) if candidates else []
+    candidates = {
+        user_id for user_id, is_followed in zip(candidates, followed) if not is_followed
+    }
+    suggested = {}
+    for user_id in ranked:
+        if len(suggested) >= size - random_size:
+            break
+        if user_id in candidates:
+            suggested[user_id] = mutuals[user_id]
+    for user_id in random_uids:
+        if len(suggested) >= size:
+            break
+        if user_id in candidates and user_id not in suggested:
+            suggested[user_id] = 0
+    pipe = conn.pipeline(transaction=False)
+    pipe.delete(key)
+    if suggested:
+        pipe.zadd(key, suggested)
+    pipe.expire(key, ttl)
+    pipe.set(keys.suggestions_fresh(uid), 1, ex=ttl)
+    pipe.execute()
+    return list(suggested)
+
+
+# same as scripts.INDEX_IMAGES
+def index_images(client, script_keys, args):
+    tids = [str(tid) for tid in args]
+    buckets = client.tweet_buckets
+    pipe = client.conn.pipeline(transaction=False)
+    for tid in tids:
+        pipe.zscore(keys.shard(keys.TIDS, tid, client.shards), tid)
+        records.read(pipe, tid, buckets)
+    results = pipe.execute()
+    pipe = client.conn.pipeline(transaction=False)
+    for tid, timestamp, tweet in zip(tids, results[::2], results[1::2]):
+        if timestamp is not None and "image" in records.parse(tweet, buckets):
+            pipe.zadd(keys.shard(keys.IMAGES, tid, client.shards), {tid: timestamp})
+    return sum(pipe.execute())
+
+
+# same as scripts.FEED_VERSIONS
+def feed_versions(client, script_keys, args):
+    celebrities_of, *uids = (str(arg) for arg in args)
+    if celebrities_of:
+        uids += sorted(client.conn.smembers(keys.following_celebrities(celebrities_of)))
+    if not uids:
+        return []
+    versions = client.mget([keys.feed(uid) for uid in uids])
+    return [f"{uid}={version or 0}" for uid, version in zip(uids, versions)]
+
+
+# script --> its steps
+STEPS = {
+    scripts.POST_TWEET: post_tweet,
+    scripts.UPDATE_TWEET: update_tweet,
+    scripts.DELETE_TWEET: delete_tweet,
+    scripts.FOLLOW: follow,
+    scripts.UNFOLLOW: unfollow,
+    scripts.FINISH_UPLOAD: finish_upload,
+    scripts.RESOLVE_SESSION: resolve_session,
+    scripts.SUGGEST: suggest,
+    scripts.INDEX_IMAGES: index_images,
+    scripts.FEED_VERSIONS: feed_versions,
+}
+
+
+#
+# Internal helper function
+#
+
+
+# the user posted, updated (timestamp is set) or deleted the tweet (see
+# scripts.USER_TWEETED)
+def _tweeted(client, uid, tid, timestamp, max_length, celebrity):
+    followers = client.run_script(
+        scripts.USER_TWEETED,
+        keys=[keys.user_tweets(uid)],
+        args=[
+            uid,
+            tid,
+            "" if timestamp is None else timestamp,
+            max_length,
+            int(celebrity),
+        ],
+    )
+    _fan_out(client, followers, tid, timestamp, max_length)
+
+
+# same as the fan_out function of the scripts
+def _fan_out(client, uids, tid=None, timestamp=None, max_length=0):
+    built = []
+    if uids:
+        pipe = client.conn.pipeline(transaction=False)
+        for uid in uids:
+            pipe.exists(keys.timeline_built(uid))
+        built = [uid for uid, exists in zip(uids, pipe.execute()) if exists]
+    pipe = client.conn.pipeline(transaction=False)
+    for uid in built:
+        if tid is not None and timestamp is not None:
+            pipe.zadd(keys.timeline(uid), {tid: timestamp})
+            pipe.zremrangebyrank(keys.timeline(uid), 0, -int(max_length) - 1)
+        elif tid is not None:
+            pipe.zrem(keys.timeline(uid), tid)
+        pipe.incr(keys.feed(uid))
+    pipe.incr(keys.feed("*"))
+    pipe.execute()
@@ -0,0 +1,298 @@
+import sys
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import records
+from twitter.controllers import search
+from twitter.controllers import tags
+
+#
+# dataset.py: export the users, follows and tweets as ndjson, and import them,
+# e.g. to seed a staging environment (see `twitter export` / `twitter import`)
+#
+# one json object per line, by "type":
+# counters --> {"tid", "uid", "iid"}, the id counters (in the first part only)
+# user --> {"uid", "profile", "celebrity"}, the profile without the sessions
+# following --> {"uid", "uids", "celebrities"}, some of the users the user
+#   follows (a user's follows are split into lines of at most batch_size uids)
+# tweet --> {"tid", "timestamp", "tweet"}, the tweet's fields and its timestamp
+#   in the indexes
+#
+# the export reads the users (in {uids:<n>}) and the tweets (with their score in
+# {tids:<n>}) by ids up to the counters, batch_size ids per round trip, and
+# scans the follows of the users, so its memory is bounded; it can be split into
+# parts by ranges of ids, exported in parallel, that read disjoint ids (the ids
+# beyond the counters, not allocated by the app, are not exported). The import
+# writes the users, follows and tweets with their indexes (search, tags and
+# mentions too) in a pipeline per batch_size lines, the counters, timelines and
+# suggestions are computed on the first read as for the users created before
+# them; the images stay in s3
+#
+
+
+# export the part-th of parts ranges of ids to the text stream, returns the
+# number of lines written; progress is called with that number after each batch
+def export_dataset(out, part=0, parts=1, client=None, batch_size=1000, progress=None):
+    client = client or redis.get_redis_client()
+    conn = client.conn
+    ids = client.mget([keys.TID, keys.UID, keys.IID])
+    tid, uid, iid = (int(id or 0) for id in ids)
+    written = 0
+    if part == 0:
+        counters = {"type": "counters", "tid": tid, "uid": uid, "iid": iid}
+        written += _write(out, [counters])
+    # the ids of the part are read in order rather than scanned, so that the
+    # parts do not scan the whole indexes each
+    for batch in _id_batches(uid, part, parts, batch_size):
+        pipe = conn.pipeline(transaction=False)
+        for user_id in batch:
+            pipe.sismember(keys.shard(keys.UIDS, user_id, client.shards), user_id)
+        uids = [user_id for user_id, exists in zip(batch, pipe.execute()) if exists]
+        written += _write(out, _export_users(client, uids, batch_size))
+        if progress:
+            progress(written)
+    buckets = client.tweet_buckets
+    for batch in _id_batches(tid, part, parts, batch_size):
+        pipe = conn.pipeline(transaction=False)
+        for tweet_id in batch:
+            pipe.zscore(keys.shard(keys.TIDS, tweet_id, client.shards), tweet_id)
+            records.read(pipe, tweet_id, buckets)
+        results = pipe.execute()
+        lines = [
+            {"type": "tweet", "tid": tweet_id, "timestamp": timestamp, "tweet": tweet}
+            for tweet_id, timestamp, result in zip(batch, results[::2], results[1::2])
+            for tweet in [records.parse(result, buckets)]
+            if timestamp is not None and tweet
+        ]
+        written += _write(out, lines)
+        if progress:
+            progress(written)
+    return written
+
+
+# import the lines (an iterable of ndjson lines), returns the number of lines
+# imported; progress is called with that number after each batch
+def import_dataset(lines, client=None, batch_size=1000, progress=None):
+    client = client or redis.get_redis_client()
+    imported = 0
+    for batch in _batches((line for line in lines if line.strip()), batch_size):
+        writes = _Writes()
+        for line in batch:
+            _import_line(client, writes, json.loads(line))
+        writes.execute(client.conn)
+        imported += len(batch)
+        if progress:
+            progress(imported)
+    return imported
+
+
+# export the dataset to the path ("-" for stdout), in parallel parts written to
+# <path>.<part> with several workers, returns the number of lines written
+def export_parallel(path, workers=1, batch_size=1000):
+    if workers <= 1:
+        return _export_file(path, 0, 1, batch_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_export_file, f"{path}.{part}", part, workers, batch_size)
+            for part in range(workers)
+        ]
+        return sum(future.result() for future in futures)
+
+
+# import the files ("-" for stdin), several at a time with several workers,
+# returns the number of lines imported
+def import_parallel(paths, workers=1, batch_size=1000):
+    if workers <= 1 or len(paths) <= 1:
+        return sum(_import_file(path, batch_size) for path in paths)
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        futures = [executor.submit(_import_file, path, batch_size) for path in paths]
+        return sum(future.result() for future in futures)
+
+
+#
+# Internal helper function
+#
+
+
+# the writes of a batch of lines, merged into one command per key (most of the
+# cost of a pipeline is per command), in the interface of a pipeline
+class _Writes(object):
+    def __init__(self):
+        self._deleted = []
+        self._hashes = {}
+        self._sets = {}
+        self._sorted_sets = {}
+
+    def delete(self, key):
+        self._deleted.append(key)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        fields = self._hashes.setdefault(key, {})
+        if field is not None:
+            fields[field] = value
+        fields.update(mapping or {})
+
+    def sadd(self, key, *members):
+        self._sets.setdefault(key, set()).update(members)
+
+    def zadd(self, key, mapping):
+        self._sorted_sets.setdefault(key, {}).update(mapping)
+
+    def execute(self, conn):
+        pipe = conn.pipeline(transaction=False)
+        for key in self._deleted:
+            pipe.delete(key)
+        for key, fields in self._hashes.items():
+            pipe.hset(key, mapping=fields)
+        for key, members in self._sets.items():
+            pipe.sadd(key, *members)
+        for key, mapping in self._sorted_sets.items():
+            pipe.zadd(key, mapping)
+        pipe.execute()
+
+
+def _export_users(client, uids, batch_size):
+    conn = client.conn
+    pipe = conn.pipeline(transaction=False)
+    for uid in uids:
+        pipe.hgetall(keys.user(uid))
+        pipe.sismember(keys.CELEBRITIES, uid)
+        pipe.smembers(keys.following_celebrities(uid))
+    results = pipe.execute()
+    lines = []
+    for uid, profile, celebrity, celebrities in zip(
+        uids, results[::3], results[1::3], results[2::3]
+    ):
+        lines.append(
+            {"type": "user", "uid": uid, "profile": profile, "celebrity": celebrity}
+        )
+        # the follows of a user are scanned, whatever their number
+        following = conn.sscan_iter(keys.following(uid), count=batch_size)
+        for followed in _batches(following, batch_size):
+            lines.append(
+                {
+                    "type": "following",
+                    "uid": uid,
+                    "uids": followed,
+                    "celebrities": sorted(celebrities & set(followed)),
+                }
+            )
+    return lines
+
+
+def _import_line(client, writes, line):
+    kind = line["type"]
+    if kind == "counters":
+        _import_counters(client, line)
+    elif kind == "user":
+        uid, profile = line["uid"], line["profile"]
+        writes.sadd(keys.shard(keys.UIDS, uid, client.shards), uid)
+        if profile:
+            writes.hset(keys.user(uid), mapping=profile)
+        if "email" in profile:
+            writes.hset(
+                keys.email_shard(profile["email"], client.shards), profile["email"], uid
+            )
+        if line.get("celebrity"):
+            writes.sadd(keys.CELEBRITIES, uid)
+        # recomputed on the first read
+        writes.delete(keys.counts(uid))
+    elif kind == "following":
+        uid, uids = line["uid"], line["uids"]
+        if uids:
+            writes.sadd(keys.following(uid), *uids)
+        for followed in uids:
+            writes.sadd(keys.followers(followed), uid)
+        if line.get("celebrities"):
+            writes.sadd(keys.following_celebrities(uid), *line["celebrities"])
+    elif kind == "tweet":
+        tid, timestamp, tweet = line["tid"], line["timestamp"], line["tweet"]
+        records.write(writes, tid, tweet, client.tweet_buckets)
+        writes.zadd(keys.shard(keys.TIDS, tid, client.shards), {tid: timestamp})
+        if "image" in tweet:
+            writes.zadd(keys.shard(keys.IMAGES, tid, client.shards), {tid: timestamp})
+        if "uid" in tweet:
+            writes.zadd(keys.user_tweets(tweet["uid"]), {tid: timestamp})
+        text = tweet.get("tweet_text")
+        search.index_tweet(writes, tid, timestamp, text, None, client.shards)
+        tags.index_tweet(writes, tid, timestamp, text)
+    else:
+        raise ValueError(f"Unknown line type {kind!r}")
+
+
+# the id counters are at least the ones of the dataset, so that the new ids do
+# not overwrite the imported ones
+def _import_counters(client, line):
+    conn = client.conn
+    for key, name in ((keys.TID, "tid"), (keys.UID, "uid"), (keys.IID, "iid")):
+        if int(conn.get(key) or 0) < int(line[name]):
+            conn.set(key, line[name])
+
+
+def _export_file(path, part, parts, batch_size):
+    out = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+    try:
+        return export_dataset(
+            out,
+            part=part,
+            parts=parts,
+            batch_size=batch_size,
+            progress=_progress(f"exported {path}"),
+        )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def _import_file(path, batch_size):
+    lines = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        return import_dataset(
+            lines, batch_size=batch_size, progress=_progress(f"imported {path}")
+        )
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+# prints the number of lines and their rate to stderr, at most every second
+def _progress(label):
+    start = last = time.perf_counter()
+
+    def report(count):
+        nonlocal last
+        now = time.perf_counter()
+        if now - last >= 1:
+            last = now
+            rate = count / (now - start)
+            print(f"{label}: {count} line(s), {rate:.0f}/s", file=sys.stderr)
+
+    return report
+
+
+# the ids of the part-th of parts ranges of 1..max_id, in batches of strings
+def _id_batches(max_id, part, parts, batch_size):
+    low, high = max_id * part // parts, max_id * (part + 1) // parts
+    for start in range(low + 1, high + 1, batch_size):
+        yield [str(id) for id in range(start, min(start + batch_size, high + 1))]
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _write(out, lines):
+    for line in lines:
+        out.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")))
+        out.write("\n")
+    return len(lines)
@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from twitter.controllers import s3
+from twitter.controllers import steps
+from twitter.controllers import storage
+
+# cache the rendered tweets (set to 0 to render them on every request)
+FRAGMENT_CACHE = os.environ.get("FRAGMENT_CACHE", "1") == "1"
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 10000))
+# seconds a rendered tweet is kept, no longer than its presigned urls are valid
+FRAGMENT_CACHE_TTL = int(
+    os.environ.get("FRAGMENT_CACHE_TTL", min(300, s3.PRESIGNED_URL_MIN_TTL))
+)
+
+#
+# fragments.py: cache of the rendered tweets (components/tweet.html), shared by
+# all the viewers, in the memory of the worker and in the storage (redis)
+#
+# fragment:<tid>:<version> --> the rendered tweet, a new version of the tweet
+#   (see scripts.py) is rendered again, the old ones expire
+#
+
+
+class FragmentCache(object):
+    def __init__(self, max_size=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # tid --> (version, html, expiry)
+        self._fragments = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # tid --> html of the tweets (tid, version) rendered by render(tweets), one
+    # round trip to the storage for the ones not in the memory of the worker
+    # (see Storage.get_cached)
+    def get_many(self, tweets, render, store=None):
+        store = store or storage.get_storage()
+        return steps.run(self.get_many_steps(tweets, render, store.reads()))
+
+    # the steps of get_many, with the reads of the storage (see steps.py)
+    def get_many_steps(self, tweets, render, reads):
+        fragments, missing = self._get_local(tweets)
+        if not missing:
+            return fragments
+        cached = yield reads.get_cached(
+            [_key(tid, version) for tid, version in missing]
+        )
+        rendered = self._add_missing(fragments, missing, cached, render)
+        if rendered:
+            yield reads.set_cached(
+                {
+                    _key(tid, version): rendered[tid]
+                    for tid, version in missing
+                    if tid in rendered
+                },
+                self._ttl,
+            )
+        return fragments
+
+    # forget the tweet in this worker (the other workers and redis rely on the
+    # version of the tweet)
+    def invalidate(self, tid):
+        with self._lock:
+            self._fragments.pop(str(tid), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._fragments),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _set(self, tid, version, html):
+        with self._lock:
+            self._fragments[tid] = (version, html, time.time() + self._ttl)
+            self._fragments.move_to_end(tid)
+            while len(self._fragments) > self._max_size:
+                self._fragments.popitem(last=False)
+
+    # tid --> html of the tweets in the memory of the worker, and the missing
+    # (tid, version)
+    def _get_local(self, tweets):
+        fragments, missing = {}, []
+        now = time.time()
+        with self._lock:
+            for tid, version in tweets:
+                version_html_expiry = self._fragments.get(tid)
+                if version_html_expiry and version_html_expiry[0] == version:
+                    if version_html_expiry[2] > now:
+                        self._fragments.move_to_end(tid)
+                        fragments[tid] = version_html_expiry[1]
+                        continue
+                missing.append((tid, version))
+            self.hits += len(fragments)
+        return fragments, missing
+
+    # add the missing tweets, from redis or rendered, to the fragments, returns
+    # tid --> html of the rendered ones
+    def _add_missing(self, fragments, missing, cached, render):
+        rendered = {}
+        for (tid, version), html in zip(missing, cached):
+            if html is None:
+                html = rendered[tid] = render(tid)
+            fragments[tid] = html
+            self._set(tid, version, html)
+        with self._lock:
+            self.misses += len(rendered)
+        return rendered
+
+
+#
+# Internal helper function
+#
+
+
+def _key(tid, version):
+    return f"fragment:{tid}:{version}"
+
+
+#
+# Process-wide registry
+#
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_fragment_cache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = FragmentCache()
+        return _cache
@@ -0,0 +1,24 @@
+import os
+from PIL import Image
+
+#
+# images.py: downscaled derivatives of the tweets' images, generated by the
+# upload worker (see uploads.py), this is the only module that needs Pillow
+#
+
+
+# save the image downscaled to fit in a size x size box in the directory, as
+# a jpeg (or a png if it has transparency), returns the path of the derivative
+def make_derivative(path, name, size, directory):
+    with Image.open(path) as image:
+        # the first frame of an animated gif
+        image.seek(0)
+        image = image.copy()
+    image.thumbnail((size, size))
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        derivative = os.path.join(directory, f"{name}.png")
+        image.convert("RGBA").save(derivative, "PNG", optimize=True)
+    else:
+        derivative = os.path.join(directory, f"{name}.jpg")
+        image.convert("RGB").save(derivative, "JPEG", quality=85, optimize=True)
+    return derivative
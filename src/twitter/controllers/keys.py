@@ -0,0 +1,158 @@
+#
+# keys.py: the key layout, shared by the controllers and the scripts (see
+# scripts.py), it works on a single redis server as well as on a redis cluster
+#
+# the keys of a user are tagged with the uid ("users:{<uid>}"...), so they are
+# in the hash slot of the user and a script can write them all at once; the
+# tweets:<tid> hashes (or the buckets of the tweets, see records.py) are spread
+# over the slots by their own name
+#
+# the global indexes (tids, images, uids, emails) are split into shards
+# "{<name>:<n>}" (a tid / uid is in shard tid % shards, an email in the shard of
+# its hash), so that they are spread over the cluster as well; the number of
+# shards is stored in the shards key (see migrations.py), 1 if it is not set
+#
+
+SHARDS = "shards"
+# counters of the ids
+TID = "tid"
+UID = "uid"
+IID = "iid"
+# uids of the authors whose tweets are fanned out on read (see timelines.py)
+CELEBRITIES = "celebrities"
+# number of tweets per bucket (see records.py), 0 or not set for one hash per tweet
+TWEET_BUCKETS = "tweet:buckets"
+
+# the global indexes, split into shards
+TIDS = "tids"
+IMAGES = "images"
+UIDS = "uids"
+# email --> uid
+EMAILS = "emails"
+# the inverted index of the tweets, {search:<n>}:<term> --> tids of shard n
+SEARCH = "search"
+# the trending tags (see trending.py), its keys are in one hash slot
+TRENDING = "{trending}:top"
+# set while the trending tags are fresh
+TRENDING_REFRESHED = "{trending}:refreshed"
+# the "<tid>:<iid>" jobs waiting for the upload worker, and the ones it is
+# processing (see uploads.py)
+UPLOADS = "uploads"
+UPLOADS_PROCESSING = "uploads:processing"
+
+
+# the user's profile
+def user(uid):
+    return _tagged("users", uid)
+
+
+def followers(uid):
+    return _tagged("followers", uid)
+
+
+def following(uid):
+    return _tagged("following", uid)
+
+
+# the celebrities among the followed users
+def following_celebrities(uid):
+    return _tagged("following:celebrities", uid)
+
+
+def counts(uid):
+    return _tagged("counts", uid)
+
+
+def user_tweets(uid):
+    return _tagged("user:tweets", uid)
+
+
+def timeline(uid):
+    return _tagged("timeline", uid)
+
+
+# set once the timeline is built (see timelines.rebuild)
+def timeline_built(uid):
+    return _tagged("timeline:built", uid)
+
+
+def suggestions(uid):
+    return _tagged("suggestions", uid)
+
+
+# set with the suggestions, even when there are none (see suggestions.py)
+def suggestions_fresh(uid):
+    return _tagged("suggestions:fresh", uid)
+
+
+# the tweets mentioning the user (see tags.py)
+def mentions(uid):
+    return _tagged("mentions", uid)
+
+
+# the version of the pages of the user ("*" for all the tweets, see
+# timelines.get_feed_versions)
+def feed(uid):
+    return _tagged("feed", uid)
+
+
+def tweet(tid):
+    return f"tweets:{tid}"
+
+
+# the bucket of the tweet's record (see records.py)
+def tweet_bucket(tid, buckets):
+    return f"tweets:bucket:{int(tid) // buckets}"
+
+
+# the key holding the tweet, its hash or its bucket
+def tweet_key(tid, buckets):
+    return tweet_bucket(tid, buckets) if buckets else tweet(tid)
+
+
+# the shard of the index holding the tid / uid
+def shard(name, id, shards):
+    return f"{{{name}:{int(id) % shards}}}"
+
+
+# the shard of the emails index holding the email, by a hash of the email that
+# the scripts compute as well
+def email_shard(email, shards):
+    hash = 0
+    for byte in email.encode():
+        hash = (hash * 31 + byte) % 2**32
+    return f"{{{EMAILS}:{hash % shards}}}"
+
+
+# every shard of the index
+def all_shards(name, shards):
+    return [f"{{{name}:{n}}}" for n in range(shards)]
+
+
+# the tids of shard n (tid % shards) of the tweets with the term (see search.py)
+def search_term(term, n):
+    return f"{{{SEARCH}:{n}}}:{term}"
+
+
+# the tids of shard n of the tweets with all the terms (see search.py)
+def search_query(terms, n):
+    return f"{{{SEARCH}:{n}}}:query:{' '.join(terms)}"
+
+
+# the counts of the trending tags of the minute (see trending.py)
+def trending_bucket(minute):
+    return f"{{trending}}:{minute}"
+
+
+# the tweets with the #tag (see tags.py), in the hash slot of the tag
+def tag(tag):
+    return _tagged("tag", tag)
+
+
+#
+# Internal helper function
+#
+
+
+def _tagged(name, uid):
+    return f"{name}:{{{uid}}}"
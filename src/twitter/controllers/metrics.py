@@ -0,0 +1,151 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+
+# count the redis / s3 calls and their latency (set to 0 to disable it)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# calls slower than this (in milliseconds) are logged to the twitter.slow_calls logger
+SLOW_CALL_MS = float(os.environ.get("SLOW_CALL_MS", 100))
+
+#
+# metrics.py: calls to the backends (redis, s3) per request and per route
+#
+# a call is recorded in the current request of the thread or of the async task
+# (a few additions to the dict of its context, shared by the tasks it gathers),
+# the request totals are merged into the worker's totals once, when the request
+# ends, so the lock is only taken once per request
+#
+
+logger = logging.getLogger("twitter.slow_calls")
+
+# (route, start, calls) of the current request
+_request = contextvars.ContextVar("metrics_request", default=None)
+_lock = threading.Lock()
+# (route, backend, command) --> [calls, seconds]
+_calls = {}
+# route --> [requests, seconds]
+_requests = {}
+
+
+# the request of the context starts, its calls are recorded under the route
+def start_request(route):
+    _request.set((route, time.perf_counter(), {}))
+
+
+# the request of the context ends, returns backend --> (calls, seconds) of it
+def end_request():
+    request = _request.get()
+    if request is None:
+        return {}
+    route, start, calls = request
+    elapsed = time.perf_counter() - start
+    _request.set(None)
+    totals = {}
+    with _lock:
+        for key, (count, seconds) in calls.items():
+            _add(_calls, key, count, seconds)
+        _add(_requests, route, 1, elapsed)
+    for (_, backend, _), (count, seconds) in calls.items():
+        total = totals.setdefault(backend, [0, 0.0])
+        total[0] += count
+        total[1] += seconds
+    return {backend: tuple(total) for backend, total in totals.items()}
+
+
+# a call to the backend took seconds (a pipeline is one call of its commands)
+def record(backend, command, seconds):
+    route, _, calls = _request.get() or (None, None, None)
+    if seconds * 1000 > SLOW_CALL_MS:
+        logger.warning(
+            "slow %s call %s in %s: %.1fms", backend, command, route, seconds * 1000
+        )
+    if calls is None:
+        # outside of a request (e.g. the upload worker)
+        with _lock:
+            _add(_calls, (route, backend, command), 1, seconds)
+        return
+    _add(calls, (route, backend, command), 1, seconds)
+
+
+# the totals of the worker in the prometheus text format
+def render():
+    with _lock:
+        calls = {key: tuple(value) for key, value in _calls.items()}
+        requests = {key: tuple(value) for key, value in _requests.items()}
+    lines = [
+        "# HELP twitter_requests_total Requests handled by the worker.",
+        "# TYPE twitter_requests_total counter",
+    ]
+    for route, (count, _) in sorted(requests.items(), key=_sort_key):
+        lines.append(f"twitter_requests_total{_labels(route=route)} {count}")
+    lines += [
+        "# HELP twitter_request_seconds_total Time spent handling the requests.",
+        "# TYPE twitter_request_seconds_total counter",
+    ]
+    for route, (_, seconds) in sorted(requests.items(), key=_sort_key):
+        lines.append(f"twitter_request_seconds_total{_labels(route=route)} {seconds}")
+    lines += [
+        "# HELP twitter_backend_calls_total Calls to redis / s3 (a pipeline is one call).",
+        "# TYPE twitter_backend_calls_total counter",
+    ]
+    for (route, backend, command), (count, _) in sorted(calls.items(), key=_sort_key):
+        labels = _labels(route=route, backend=backend, command=command)
+        lines.append(f"twitter_backend_calls_total{labels} {count}")
+    lines += [
+        "# HELP twitter_backend_call_seconds_total Time spent in the calls to redis / s3.",
+        "# TYPE twitter_backend_call_seconds_total counter",
+    ]
+    for (route, backend, command), (_, seconds) in sorted(calls.items(), key=_sort_key):
+        labels = _labels(route=route, backend=backend, command=command)
+        lines.append(f"twitter_backend_call_seconds_total{labels} {seconds}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _calls.clear()
+        _requests.clear()
+
+
+# record the api calls made by a boto3 client
+def instrument_boto_client(client, backend="s3"):
+    def before_call(context, **kwargs):
+        context["metrics_start"] = time.perf_counter()
+
+    def after_call(context, model, **kwargs):
+        start = context.pop("metrics_start", None)
+        if start is not None:
+            record(backend, model.name, time.perf_counter() - start)
+
+    client.meta.events.register(f"before-call.{backend}", before_call)
+    client.meta.events.register(f"after-call.{backend}", after_call)
+    client.meta.events.register(f"after-call-error.{backend}", after_call)
+
+
+#
+# Internal helper function
+#
+
+
+def _add(totals, key, count, seconds):
+    total = totals.get(key)
+    if total is None:
+        totals[key] = [count, seconds]
+    else:
+        total[0] += count
+        total[1] += seconds
+
+
+def _sort_key(item):
+    key = item[0] if isinstance(item[0], tuple) else (item[0],)
+    return tuple(str(part) for part in key)
+
+
+def _labels(**labels):
+    pairs = []
+    for name, value in labels.items():
+        value = str(value or "").replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
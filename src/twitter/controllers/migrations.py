@@ -0,0 +1,194 @@
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import records
+from twitter.controllers import search
+from twitter.controllers import tweets
+
+#
+# migrations.py: convert a database to the key layout of keys.py, change the
+# number of shards of its global indexes, or the storage of its tweets
+#
+# the layout before keys.py, on a single redis server:
+# users:<uid>, followers:<uid>, following:<uid>, counts:<uid>,
+#   user:tweets:<uid>, timeline:<uid>, suggestions:<uid> --> the keys of a user
+# tids, images, uids --> the global indexes, in one key each
+# users --> {email: uid}, and emails the set of its emails
+# timelines --> uids whose timeline has been built
+# feeds --> {"*" or uid: version of the pages}
+#
+
+# name of the keys of a user --> the key in the layout
+_USER_KEYS = {
+    "users": keys.user,
+    "followers": keys.followers,
+    "following": keys.following,
+    "counts": keys.counts,
+    "user:tweets": keys.user_tweets,
+    "timeline": keys.timeline,
+    "suggestions": keys.suggestions,
+}
+
+# global index --> its key before keys.py
+_INDEXES = {
+    keys.TIDS: "tids",
+    keys.IMAGES: "images",
+    keys.UIDS: "uids",
+    keys.EMAILS: "users",
+}
+
+
+# convert the database to the layout (if the shards key is not set yet) and
+# split its global indexes into the given number of shards (the current one
+# by default), returns the number of keys converted and of index entries moved
+#
+# the app must not serve traffic in the meantime; a database of a single server
+# is converted before it is imported into a redis cluster (`redis-cli --cluster
+# import`), the shards of a cluster can be changed in place
+def migrate_layout(shards=None, client=None, batch_size=1000):
+    client = client or redis.get_redis_client()
+    conn = client.conn
+    converted = 0
+    if conn.get(keys.SHARDS) is None:
+        # the indexes created before pagination are sorted sets first
+        tweets.migrate_indexes(client=client)
+        converted = _convert_user_keys(conn, batch_size)
+    client.reload_layout()
+    previous, shards = client.shards, shards or client.shards
+    moved = 0
+    for name, legacy in _INDEXES.items():
+        sources = [legacy] + keys.all_shards(name, client.shards)
+        moved += _reshard(conn, name, sources, shards, batch_size)
+    conn.delete("emails")
+    conn.set(keys.SHARDS, shards)
+    client.reload_layout()
+    # the search index is sharded as the tweets
+    if converted or shards != previous:
+        search.reindex(client=client, batch_size=batch_size)
+    return converted, moved
+
+
+# pack the tweets into buckets of the given number of tweets (0 for one hash
+# per tweet, see records.py), returns the number of tweets repacked; the app
+# must not serve traffic in the meantime
+def repack_tweets(buckets, client=None, batch_size=1000):
+    client = client or redis.get_redis_client()
+    conn = client.conn
+    client.reload_layout()
+    current = client.tweet_buckets
+    if buckets == current:
+        return 0
+    tids = [
+        tid
+        for shard in keys.all_shards(keys.TIDS, client.shards)
+        for tid, _ in conn.zscan_iter(shard, count=batch_size)
+    ]
+    repacked = 0
+    for start in range(0, len(tids), batch_size):
+        batch = tids[start : start + batch_size]
+        pipe = conn.pipeline(transaction=False)
+        for tid in batch:
+            records.read(pipe, tid, current)
+        tweets = [records.parse(tweet, current) for tweet in pipe.execute()]
+        pipe = conn.pipeline(transaction=False)
+        for tid, tweet in zip(batch, tweets):
+            if not tweet:
+                continue
+            records.write(pipe, tid, tweet, buckets)
+            # a bucket of both sizes is written in place
+            if keys.tweet_key(tid, current) != keys.tweet_key(tid, buckets):
+                records.delete(pipe, tid, current)
+            repacked += 1
+        pipe.execute()
+    if buckets:
+        conn.set(keys.TWEET_BUCKETS, buckets)
+    else:
+        conn.delete(keys.TWEET_BUCKETS)
+    client.reload_layout()
+    return repacked
+
+
+#
+# Internal helper function
+#
+
+
+# tag the keys of the users, and move the timelines, feeds and celebrities
+# state to them, returns the number of keys converted
+def _convert_user_keys(conn, batch_size):
+    converted = 0
+    for name, key_of in _USER_KEYS.items():
+        prefix = f"{name}:"
+        for key in list(conn.scan_iter(match=f"{prefix}*", count=batch_size)):
+            uid = key[len(prefix) :]
+            if uid.isdigit():
+                conn.rename(key, key_of(uid))
+                converted += 1
+    pipe = conn.pipeline(transaction=False)
+    for uid in conn.sscan_iter("timelines", count=batch_size):
+        pipe.set(keys.timeline_built(uid), 1)
+        converted += 1
+    for uid, version in conn.hscan_iter("feeds", count=batch_size):
+        pipe.set(keys.feed(uid), version)
+        converted += 1
+    # the celebrities among the followed users
+    for celebrity in conn.sscan_iter(keys.CELEBRITIES, count=batch_size):
+        for follower in conn.sscan_iter(keys.followers(celebrity), count=batch_size):
+            pipe.sadd(keys.following_celebrities(follower), celebrity)
+    pipe.delete("timelines")
+    pipe.delete("feeds")
+    pipe.execute()
+    return converted
+
+
+# move the entries of the sources to the given number of shards of the index,
+# returns the number of entries moved
+def _reshard(conn, name, sources, shards, batch_size):
+    moved = 0
+    for source in sources:
+        kind = conn.type(source)
+        if kind not in ("zset", "set", "hash"):
+            continue
+        scan = {"zset": conn.zscan_iter, "set": conn.sscan_iter}.get(
+            kind, conn.hscan_iter
+        )
+        # the entries scanned are removed from the source as they are moved,
+        # which a scan allows
+        batch = []
+        for entry in scan(source, count=batch_size):
+            member, value = (entry, None) if kind == "set" else entry
+            if _shard(name, member, shards) != source:
+                batch.append((member, value))
+            if len(batch) >= batch_size:
+                moved += _move(conn, name, kind, source, batch, shards)
+                batch = []
+        moved += _move(conn, name, kind, source, batch, shards)
+    return moved
+
+
+def _move(conn, name, kind, source, batch, shards):
+    if not batch:
+        return 0
+    pipe = conn.pipeline(transaction=False)
+    for member, value in batch:
+        destination = _shard(name, member, shards)
+        if kind == "zset":
+            pipe.zadd(destination, {member: value})
+        elif kind == "set":
+            pipe.sadd(destination, member)
+        else:
+            pipe.hset(destination, member, value)
+    members = [member for member, _ in batch]
+    if kind == "zset":
+        pipe.zrem(source, *members)
+    elif kind == "set":
+        pipe.srem(source, *members)
+    else:
+        pipe.hdel(source, *members)
+    pipe.execute()
+    return len(batch)
+
+
+def _shard(name, member, shards):
+    if name == keys.EMAILS:
+        return keys.email_shard(member, shards)
+    return keys.shard(name, member, shards)
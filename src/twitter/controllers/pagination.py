@@ -0,0 +1,99 @@
+import os
+import math
+
+from twitter.controllers import redis
+from twitter.controllers import steps
+
+# number of items rendered per page
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 20))
+
+#
+# pagination.py: keyset pagination over sorted sets of tids scored by timestamp
+#
+# a cursor "<timestamp>:<tid>" points to the last item of the previous page, so
+# a page is read with ZREVRANGEBYSCORE starting right after it, in the same
+# order as ZREVRANGE (newest first, ties broken by the reversed tid)
+#
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, tid):
+    return f"{timestamp!r}:{tid}"
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        timestamp, tid = cursor.rsplit(":", 1)
+        timestamp = float(timestamp)
+    except ValueError:
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+    # nan / inf are not scores redis would accept as a range
+    if not math.isfinite(timestamp):
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+    return timestamp, tid
+
+
+# a page of tids after the (encoded) cursor, and the cursor of the next page
+# (None if this is the last page)
+def get_page(key, cursor=None, count=PAGE_SIZE, client=None):
+    return get_merged_page([key], cursor=cursor, count=count, client=client)
+
+
+# same as get_page, but merges several sorted sets (duplicated tids are dropped),
+# read from the primary if primary is set (e.g. right after writing them)
+def get_merged_page(keys, cursor=None, count=PAGE_SIZE, client=None, primary=False):
+    client = client or redis.get_redis_client()
+    return steps.run(get_merged_page_steps(keys, cursor, count, client, primary))
+
+
+# the steps of get_merged_page, with the sync or the async client (see steps.py)
+def get_merged_page_steps(keys, cursor, count, client, primary=False):
+    cursor = decode_cursor(cursor)
+    conn = client.conn if primary else client.read_conn
+    pipe = conn.pipeline(transaction=False)
+    for key in keys:
+        # one more item to know whether there is a next page
+        queue_page(pipe, key, cursor, count + 1)
+    results = iter((yield steps.call(pipe.execute)))
+    pages = [read_page(results, cursor, count + 1) for _ in keys]
+    return merge_pages(pages, count)
+
+
+# queue the commands reading a page of (tid, timestamp) to the pipeline
+def queue_page(pipe, key, cursor, count):
+    if cursor is None:
+        pipe.zrevrange(key, 0, count - 1, withscores=True)
+        return
+    timestamp, _ = cursor
+    # tids sharing the cursor's timestamp (usually only the cursor itself)
+    pipe.zrevrangebyscore(key, timestamp, timestamp, withscores=True)
+    pipe.zrevrangebyscore(
+        key, f"({timestamp!r}", "-inf", start=0, num=count, withscores=True
+    )
+
+
+# read the page queued by queue_page from the iterator of the pipeline results
+def read_page(results, cursor, count):
+    if cursor is None:
+        return next(results)
+    _, last_tid = cursor
+    ties = [(tid, timestamp) for tid, timestamp in next(results) if tid < last_tid]
+    return (ties + next(results))[:count]
+
+
+# merge the pages read by read_page (duplicated tids are dropped), returns the
+# page of tids and the cursor of the next page
+def merge_pages(pages, count):
+    tweets = {}
+    for page in pages:
+        tweets.update(page)
+    page = sorted(tweets.items(), key=lambda x: (x[1], x[0]), reverse=True)
+    if len(page) <= count:
+        return [tid for tid, _ in page], None
+    page = page[:count]
+    return [tid for tid, _ in page], encode_cursor(page[-1][1], page[-1][0])
@@ -0,0 +1,82 @@
+import json
+
+from twitter.controllers import keys
+
+#
+# records.py: how a tweet is stored, shared by the controllers and the scripts
+# (see scripts.py)
+#
+# by default each tweet is its own hash tweets:<tid>; with tweet buckets (the
+# tweet:buckets key, see migrations.py) the tweets are packed into the hashes
+# tweets:bucket:<tid // buckets> instead, {tid: record}, which saves the
+# overhead of a key per tweet; a bucket stays a listpack as long as it has at
+# most hash-max-listpack-entries records of at most hash-max-listpack-value bytes
+#
+# a record is the json array of the values of FIELDS (null if the tweet has no
+# such field), followed by an object of its other fields if it has any
+#
+
+FIELDS = (
+    "timestamp",
+    "uid",
+    "version",
+    "tweet_text",
+    "image",
+    "image_thumb",
+    "image_medium",
+    "image_status",
+)
+
+# the s3 keys of the tweet's image and of its derivatives (see
+# uploads.DERIVATIVES)
+IMAGE_FIELDS = ("image", "image_thumb", "image_medium")
+
+
+# {field: value} --> record, the values are strings (as in a hash)
+def pack(tweet):
+    tweet = {field: str(value) for field, value in tweet.items()}
+    values = [tweet.get(field) for field in FIELDS]
+    others = {field: value for field, value in tweet.items() if field not in FIELDS}
+    if others:
+        values.append(others)
+    return json.dumps(values, ensure_ascii=False, separators=(",", ":"))
+
+
+# record (None if the tweet does not exist) --> {field: value}, {} if it does not
+# exist (as HGETALL)
+def unpack(record):
+    if record is None:
+        return {}
+    values = json.loads(record)
+    tweet = {field: value for field, value in zip(FIELDS, values) if value is not None}
+    if len(values) > len(FIELDS):
+        tweet.update(values[-1])
+    return tweet
+
+
+# queue the read of the tweet on the pipeline (or read it), see parse
+def read(conn, tid, buckets):
+    if buckets:
+        return conn.hget(keys.tweet_bucket(tid, buckets), tid)
+    return conn.hgetall(keys.tweet(tid))
+
+
+# the result of read --> {field: value}, {} if the tweet does not exist
+def parse(result, buckets):
+    if buckets:
+        return unpack(result)
+    return result
+
+
+# queue the write of the whole tweet on the pipeline (or write it)
+def write(conn, tid, tweet, buckets):
+    if buckets:
+        return conn.hset(keys.tweet_bucket(tid, buckets), tid, pack(tweet))
+    return conn.hset(keys.tweet(tid), mapping=tweet)
+
+
+# queue the delete of the tweet on the pipeline (or delete it)
+def delete(conn, tid, buckets):
+    if buckets:
+        return conn.hdel(keys.tweet_bucket(tid, buckets), tid)
+    return conn.delete(keys.tweet(tid))
@@ -1,37 +1,268 @@
 import os
+import time
 import redis
+import random
+import threading
+import contextvars
+import redis.cluster
+
+from twitter.controllers import keys
+from twitter.controllers import cluster
+from twitter.controllers import metrics
+
+
+# connection settings, the pool is bounded so that a burst of requests waits for
+# a free connection (up to REDIS_POOL_TIMEOUT seconds) instead of opening new sockets
+REDIS_HOST = os.environ.get("REDIS_PROD_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PROD_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 20))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+# "host:port,..." of the replicas of the primary, the reads go to a random one of
+# them (none by default, everything goes to the primary)
+REDIS_REPLICAS = [
+    replica for replica in os.environ.get("REDIS_REPLICAS", "").split(",") if replica
+]
+# seconds the reads of a user go to the primary after a write of the user, so
+# that the user sees it even if the replicas lag behind
+REDIS_STICKY_SECONDS = float(os.environ.get("REDIS_STICKY_SECONDS", 5))
+# REDIS_PROD_HOST:REDIS_PROD_PORT is a node of a redis cluster (see keys.py and
+# cluster.py), the cluster's own replicas are used instead of REDIS_REPLICAS
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER", "0") == "1"
+
+# the reads of the current request (or task) go to the primary
+_primary_reads = contextvars.ContextVar("primary_reads", default=False)
+
+
+# records each command (and each pipeline as one call) in metrics
+class InstrumentedRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.record("redis", str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error=raise_on_error)
+        finally:
+            metrics.record("redis", "PIPELINE", time.perf_counter() - start)
 
 
 # basically only use for handling log in and other generic operartions
 class RedisClient(object):
-    def __init__(self):
-        self._conn = redis.Redis(
-            host=os.environ.get("REDIS_PROD_HOST", "localhost"),
-            port=os.environ.get("REDIS_PROD_PORT", 6379),
-            decode_responses=True,
-        )
+    # cluster runs the scripts as their steps (see cluster.py), it connects to
+    # the REDIS_CLUSTER unless a pool is given (e.g. a single server, as a
+    # cluster of one node)
+    def __init__(self, connection_pool=None, replica_pools=None, cluster=None):
+        self._cluster = REDIS_CLUSTER if cluster is None else cluster
+        redis_class = InstrumentedRedis if metrics.METRICS_ENABLED else redis.Redis
+        if self._cluster and connection_pool is None:
+            self._conn = redis.cluster.RedisCluster(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                decode_responses=True,
+                max_connections=REDIS_MAX_CONNECTIONS,
+            )
+            replica_pools = []
+        else:
+            self._conn = redis_class(
+                connection_pool=connection_pool or get_connection_pool(),
+            )
+        if replica_pools is None:
+            replica_pools = get_replica_pools()
+        self._replicas = [redis_class(connection_pool=pool) for pool in replica_pools]
+        self._scripts = {}
+        self._shards = None
+        self._tweet_buckets = None
         self._check_alive()
 
+    # the primary, for the writes (and the reads that must see them)
     @property
     def conn(self):
         return self._conn
 
+    # a replica for the reads, the primary if there is none or if the current
+    # request reads its own writes (see read_from_primary)
+    @property
+    def read_conn(self):
+        if not self._replicas or reads_from_primary():
+            return self._conn
+        return random.choice(self._replicas)
+
+    # the client of the sync controllers (see aio.AsyncRedisClient)
+    @property
+    def sync_client(self):
+        return self
+
+    @property
+    def has_replicas(self):
+        return bool(self._replicas)
+
+    @property
+    def cluster(self):
+        return self._cluster
+
+    # the number of shards of the global indexes (see keys.py), it only changes
+    # when they are resharded (see migrations.py)
+    @property
+    def shards(self):
+        if self._shards is None:
+            self._shards = int(self.conn.get(keys.SHARDS) or 1)
+        return self._shards
+
+    # the number of tweets per bucket, 0 for one hash per tweet (see records.py),
+    # it only changes when the tweets are repacked (see migrations.py)
+    @property
+    def tweet_buckets(self):
+        if self._tweet_buckets is None:
+            self._tweet_buckets = int(self.conn.get(keys.TWEET_BUCKETS) or 0)
+        return self._tweet_buckets
+
+    # same as shards and tweet_buckets, as the calls of the reads shared with the
+    # async client (see steps.py)
+    def get_shards(self):
+        return self.shards
+
+    def get_tweet_buckets(self):
+        return self.tweet_buckets
+
+    # forget the number of shards and of tweets per bucket, e.g. after resharding
+    def reload_layout(self):
+        self._shards = None
+        self._tweet_buckets = None
+
+    # MGET of keys in any slots (split by slot on a redis cluster)
+    def mget(self, keys):
+        if isinstance(self._conn, redis.cluster.RedisCluster):
+            return self._conn.mget_nonatomic(keys)
+        return self.read_conn.mget(keys)
+
     def validate_session_id(self, sid):
-        if not self.conn.hmget(sid, "email")[0]:
+        if not self.read_conn.hmget(sid, "email")[0]:
             return False
         return True
 
     def validate_user_id(self, uid):
-        return self.conn.sismember("uids", uid)
+        if uid is None:
+            return False
+        return self.read_conn.sismember(keys.shard(keys.UIDS, uid, self.shards), uid)
 
     def get_user_id(self, sid):
-        uid = self.conn.hget("users", self.conn.hmget(sid, "email")[0])
+        conn = self.read_conn
+        email = conn.hmget(sid, "email")[0]
+        uid = email and conn.hget(keys.email_shard(email, self.shards), email)
         if not self.validate_user_id(uid):
             return {"success": False, "payload": None}
         return {"success": True, "payload": uid}
 
+    # run a server side script (see scripts.py), it is sent to redis once and
+    # then called by its sha, a read only script may run on a replica; on a
+    # cluster the scripts using several slots run as their steps
+    def run_script(self, script, keys=(), args=(), read_only=False):
+        if self._cluster and script in cluster.STEPS:
+            return cluster.STEPS[script](self, list(keys), list(args))
+        if script not in self._scripts:
+            self._scripts[script] = self.conn.register_script(script)
+        conn = self.read_conn if read_only else self.conn
+        return self._scripts[script](keys=list(keys), args=list(args), client=conn)
+
+    # the keys are freed in the background, a large database is flushed without
+    # blocking the server (nor timing out)
     def reset_db(self):
-        self.conn.flushall()
+        self.conn.flushall(asynchronous=True)
 
     def _check_alive(self):
         return self._conn.ping()
+
+
+# the reads of the current request (or task) go to the primary or not, it is
+# set at the start of every request (see auth.py)
+def read_from_primary(enabled=True):
+    _primary_reads.set(enabled)
+
+
+# whether the reads of the current request (or task) go to the primary
+def reads_from_primary():
+    return _primary_reads.get()
+
+
+#
+# Process-wide registry
+#
+
+# the pool and the client are created lazily and re-created whenever the pid
+# changes, so a gunicorn worker never reuses sockets inherited from its parent
+_lock = threading.Lock()
+_pool = None
+_replica_pools = None
+_client = None
+_pid = None
+# the pool was given by set_connection_pool
+_pool_given = False
+
+
+def get_connection_pool():
+    global _pool, _replica_pools, _client, _pid
+    with _lock:
+        if _pool is None or _pid != os.getpid():
+            _pool = _new_pool(REDIS_HOST, REDIS_PORT)
+            _replica_pools = None
+            _client = None
+            _pid = os.getpid()
+        return _pool
+
+
+# the pools of the REDIS_REPLICAS (none when the pool was set by set_connection_pool)
+def get_replica_pools():
+    global _replica_pools
+    get_connection_pool()
+    with _lock:
+        if _replica_pools is None:
+            _replica_pools = []
+            for replica in REDIS_REPLICAS:
+                host, _, port = replica.rpartition(":")
+                _replica_pools.append(_new_pool(host, int(port)))
+        return _replica_pools
+
+
+# use the given pool in this process instead of the configured redis server
+# (e.g. the fake redis of the offline benchmarks)
+def set_connection_pool(pool):
+    global _pool, _replica_pools, _client, _pid, _pool_given
+    with _lock:
+        _pool = pool
+        _pool_given = True
+        _replica_pools = []
+        _client = None
+        _pid = os.getpid()
+
+
+def get_redis_client():
+    global _client
+    pool = get_connection_pool()
+    replica_pools = get_replica_pools()
+    with _lock:
+        if _client is None and REDIS_CLUSTER and not _pool_given:
+            _client = RedisClient(cluster=True)
+        elif _client is None:
+            _client = RedisClient(connection_pool=pool, replica_pools=replica_pools)
+        return _client
+
+
+def _new_pool(host, port):
+    return redis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+    )
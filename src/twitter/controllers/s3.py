@@ -1,7 +1,15 @@
 import os
+import time
 import boto3
+import threading
+from collections import OrderedDict
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
+from twitter.controllers import redis
+from twitter.controllers import metrics
+
 
 class EnvironmentNotSet(Exception):
     pass
@@ -29,18 +37,164 @@ if S3_PROD_ENDPOINT_URL:
 BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
 if not BUCKET_NAME:
     raise EnvironmentNotSet("BUCKET_NAME must be set to access aws s3 bucket!")
+# size of the urllib3 pool shared by all requests of a worker
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 10))
+# presigned urls are reused until less than PRESIGNED_URL_MIN_TTL seconds of their
+# validity remain, the cache is either "local" (per worker), "redis" or "none"
+PRESIGNED_URL_CACHE = os.environ.get("PRESIGNED_URL_CACHE", "local")
+PRESIGNED_URL_CACHE_SIZE = int(os.environ.get("PRESIGNED_URL_CACHE_SIZE", 10000))
+PRESIGNED_URL_MIN_TTL = int(os.environ.get("PRESIGNED_URL_MIN_TTL", 600))
+# the images are below the multipart threshold, transferring them in the calling
+# thread saves a thread pool per transfer (and keeps the calls in the request metrics)
+TRANSFER_CONFIG = TransferConfig(use_threads=False)
+
+
+# in-process LRU cache of presigned urls, key --> {expires_in --> (url, expiry)}
+class PresignedUrlCache(object):
+    def __init__(
+        self, max_size=PRESIGNED_URL_CACHE_SIZE, min_ttl=PRESIGNED_URL_MIN_TTL
+    ):
+        self._max_size = max_size
+        self._min_ttl = min_ttl
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, expires_in):
+        with self._lock:
+            entry = self._urls.get(key, {}).get(expires_in)
+            if entry and entry[1] - time.time() > self._min_ttl:
+                self._urls.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, expires_in, url):
+        with self._lock:
+            self._urls.setdefault(key, {})[expires_in] = (url, time.time() + expires_in)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self._max_size:
+                self._urls.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._urls.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._urls)}
+
+
+# presigned urls shared by all the workers, presigned:<key> --> hash of
+# expires_in --> "<expiry timestamp> <url>"
+class RedisPresignedUrlCache(PresignedUrlCache):
+    def __init__(self, min_ttl=PRESIGNED_URL_MIN_TTL, client=None):
+        super().__init__(min_ttl=min_ttl)
+        self._redis_client = client
+
+    @property
+    def conn(self):
+        return (self._redis_client or redis.get_redis_client()).conn
+
+    def get(self, key, expires_in):
+        entry = self.conn.hget(f"presigned:{key}", expires_in)
+        url = None
+        if entry:
+            expires_at, url = entry.split(" ", 1)
+            if float(expires_at) - time.time() <= self._min_ttl:
+                url = None
+        with self._lock:
+            if url:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return url
+
+    def set(self, key, expires_in, url):
+        expires_at = time.time() + expires_in
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hset(f"presigned:{key}", expires_in, f"{expires_at!r} {url}")
+        pipe.expire(f"presigned:{key}", expires_in)
+        pipe.execute()
+
+    def invalidate(self, key):
+        self.conn.delete(f"presigned:{key}")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# a cache that never hits
+class NullPresignedUrlCache(PresignedUrlCache):
+    def set(self, key, expires_in, url):
+        pass
 
 
 class S3Client(object):
-    def __init__(self, bucket_name=BUCKET_NAME):
+    def __init__(
+        self, bucket_name=BUCKET_NAME, session=None, check_bucket=True, url_cache=None
+    ):
         self._bucket = bucket_name
-        self._client = boto3.client(
+        self._url_cache = url_cache or get_presigned_url_cache()
+        self._session = session or boto3.session.Session()
+        self._client = self._session.client(
             "s3",
+            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
             **S3_KWARGS,
         )
+        if metrics.METRICS_ENABLED:
+            metrics.instrument_boto_client(self._client)
+        if check_bucket:
+            self._check_bucket()
+
+    @property
+    def url_cache(self):
+        return self._url_cache
+
+    # reuse a cached url as long as it stays valid for a while, so that the
+    # browser can cache the image and we do not sign it on every render
+    def create_presigned_url(self, key, expires_in=3600):
+        url = self._url_cache.get(key, expires_in)
+        if url is None:
+            url = self._client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": self._bucket, "Key": key},
+                ExpiresIn=expires_in,
+            )
+            self._url_cache.set(key, expires_in, url)
+        return url
+
+    def upload_fileobj(self, file, key):
+        self._url_cache.invalidate(str(key))
+        return self._client.upload_fileobj(
+            file.stream, self._bucket, str(key), Config=TRANSFER_CONFIG
+        )
+
+    def upload_file(self, path, key):
+        self._url_cache.invalidate(str(key))
+        return self._client.upload_file(
+            path, self._bucket, str(key), Config=TRANSFER_CONFIG
+        )
+
+    def download_file(self, key, path):
+        return self._client.download_file(
+            self._bucket, str(key), path, Config=TRANSFER_CONFIG
+        )
+
+    def delete_file(self, key):
+        self._url_cache.invalidate(key)
+        return self._client.delete_object(Bucket=self._bucket, Key=key)
+
+    def reset_s3(self):
+        self._session.resource("s3", **S3_KWARGS).Bucket(
+            self._bucket
+        ).objects.all().delete()
+
+    def _check_bucket(self):
         # check if the bucket exist or not
         try:
-            self._client.head_bucket(Bucket=bucket_name)
+            self._client.head_bucket(Bucket=self._bucket)
         except ClientError as e:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
@@ -48,22 +202,47 @@ class S3Client(object):
             if error_code == 403:
                 raise AccessDenied("Private Bucket. Forbidden Access!")
             elif error_code == 404:
-                self._client.create_bucket(Bucket=bucket_name, ACL="private")
+                self._client.create_bucket(Bucket=self._bucket, ACL="private")
             else:
                 raise e
 
-    def create_presigned_url(self, key, expires_in=3600):
-        return self._client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": self._bucket, "Key": key},
-            ExpiresIn=expires_in,
-        )
 
-    def upload_fileobj(self, file, key):
-        return self._client.upload_fileobj(file.stream, self._bucket, str(key))
+#
+# Process-wide registry
+#
 
-    def delete_file(self, key):
-        return self._client.delete_object(Bucket=self._bucket, Key=key)
+# boto3 sessions and clients are not fork safe, so one client is kept per bucket
+# and per pid; the bucket itself is only checked once, by the first process that
+# asks for it (the gunicorn master when preloading, otherwise each worker once)
+_lock = threading.Lock()
+_clients = {}
+_checked_buckets = set()
 
-    def reset_s3(self):
-        boto3.resource("s3", **S3_KWARGS).Bucket(self._bucket).objects.all().delete()
+
+_url_cache = None
+_url_cache_lock = threading.Lock()
+
+
+def get_presigned_url_cache():
+    global _url_cache
+    with _url_cache_lock:
+        if _url_cache is None:
+            _url_cache = {
+                "local": PresignedUrlCache,
+                "redis": RedisPresignedUrlCache,
+                "none": NullPresignedUrlCache,
+            }[PRESIGNED_URL_CACHE]()
+        return _url_cache
+
+
+def get_s3_client(bucket_name=BUCKET_NAME):
+    pid = os.getpid()
+    with _lock:
+        entry = _clients.get(bucket_name)
+        if entry is None or entry[0] != pid:
+            client = S3Client(
+                bucket_name, check_bucket=bucket_name not in _checked_buckets
+            )
+            _checked_buckets.add(bucket_name)
+            _clients[bucket_name] = entry = (pid, client)
+        return entry[1]
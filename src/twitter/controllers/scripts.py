@@ -0,0 +1,774 @@
+from twitter.controllers import records
+
+#
+# scripts.py: server side (lua) scripts of the write operations, each of them
+# runs atomically in one round trip (see RedisClient.run_script)
+#
+# the keys are in the layout of keys.py:
+# counts:{uid} --> {followers, following, tweets}, the sizes of followers:{uid},
+#   following:{uid} and user:tweets:{uid}, maintained by the scripts
+# {images:<n>} --> sorted sets of the tids of the tweets with an image, scored by
+#   the tweet timestamp (as {tids:<n>})
+# tweets:<tid> version --> incremented whenever the rendered tweet changes (see
+#   fragments.py), the tweets may be packed into buckets instead (see records.py)
+# feed:{*} / feed:{uid} --> bumped by every tweet write / whenever the pages of
+#   the user change, the versions of the pages (see timelines.get_feed_versions)
+#
+# on a redis cluster a script may only use the keys of one hash slot, so the
+# scripts touching several users are run as their steps instead (see the
+# functions below and cluster.py), each of them atomic in the slot it writes
+#
+
+# the key layout (see keys.py)
+_KEYS = """
+local function tagged(name, uid)
+    return name .. ":{" .. uid .. "}"
+end
+
+local shards
+local function get_shards()
+    shards = shards or tonumber(redis.call("GET", "shards") or 1)
+    return shards
+end
+
+-- the shard of the index holding the tid / uid
+local function shard(name, id)
+    return "{" .. name .. ":" .. tonumber(id) % get_shards() .. "}"
+end
+
+-- the shard of the emails index holding the email
+local function email_shard(email)
+    local hash = 0
+    for i = 1, #email do
+        hash = (hash * 31 + string.byte(email, i)) % 4294967296
+    end
+    return "{emails:" .. hash % get_shards() .. "}"
+end
+"""
+
+# helpers of the scripts writing the timelines, push and user_* only use the
+# keys of the user
+_TIMELINES = """
+-- push a tweet to a timeline and trim it to its maximum length
+local function push(uid, tid, timestamp, max_length)
+    local key = tagged("timeline", uid)
+    redis.call("ZADD", key, timestamp, tid)
+    redis.call("ZREMRANGEBYRANK", key, 0, -max_length - 1)
+end
+
+-- the pages of the user changed, returns the followers the user's tweets are
+-- written to (none for a celebrity, their tweets are merged on read)
+local function user_touched(uid, celebrity)
+    redis.call("INCR", tagged("feed", uid))
+    if celebrity then
+        return {}
+    end
+    return redis.call("SMEMBERS", tagged("followers", uid))
+end
+
+-- the user posted or updated (timestamp is set) or deleted the tweet: update
+-- the user's tweets, counter and own timeline, returns the followers the tweet
+-- is fanned out to (see user_touched)
+local function user_tweeted(uid, tid, timestamp, max_length, celebrity)
+    local key = tagged("user:tweets", uid)
+    local built = redis.call("EXISTS", tagged("timeline:built", uid)) == 1
+    local added
+    if timestamp then
+        added = redis.call("ZADD", key, timestamp, tid)
+        if built then
+            push(uid, tid, timestamp, max_length)
+        end
+    else
+        added = -redis.call("ZREM", key, tid)
+        redis.call("ZREM", tagged("timeline", uid), tid)
+    end
+    redis.call("HINCRBY", tagged("counts", uid), "tweets", added)
+    return user_touched(uid, celebrity)
+end
+
+-- write the tweet (timestamp is set) to or remove it from the built timelines
+-- among the given ones (tid is false to only touch them), and bump the versions
+-- of their feeds and of all the tweets
+local function fan_out(uids, tid, timestamp, max_length)
+    for _, uid in ipairs(uids) do
+        if redis.call("EXISTS", tagged("timeline:built", uid)) == 1 then
+            if tid and timestamp then
+                push(uid, tid, timestamp, max_length)
+            elseif tid then
+                redis.call("ZREM", tagged("timeline", uid), tid)
+            end
+            redis.call("INCR", tagged("feed", uid))
+        end
+    end
+    redis.call("INCR", tagged("feed", "*"))
+end
+
+local function is_celebrity(uid)
+    return redis.call("SISMEMBER", "celebrities", uid) == 1
+end
+"""
+
+# how the tweets are stored (see records.py), load_tweet / store_tweet /
+# remove_tweet only use the key of the tweet (once it is located, see
+# _GIVEN_TWEET)
+_RECORDS = (
+    "local FIELDS = {"
+    + ", ".join(f'"{field}"' for field in records.FIELDS)
+    + "}"
+    + """
+local buckets
+
+-- the key holding the tweet, and whether it is a bucket (see keys.tweet_key)
+local locate = function(tid)
+    buckets = buckets or tonumber(redis.call("GET", "tweet:buckets") or 0)
+    if buckets == 0 then
+        return "tweets:" .. tid, false
+    end
+    return "tweets:bucket:" .. math.floor(tonumber(tid) / buckets), true
+end
+
+-- {field = value} of the tweet, nil if it does not exist
+local function load_tweet(tid)
+    local key, bucket = locate(tid)
+    local tweet = {}
+    if not bucket then
+        local flat = redis.call("HGETALL", key)
+        if #flat == 0 then
+            return nil
+        end
+        for i = 1, #flat, 2 do
+            tweet[flat[i]] = flat[i + 1]
+        end
+        return tweet
+    end
+    local record = redis.call("HGET", key, tid)
+    if not record then
+        return nil
+    end
+    local values = cjson.decode(record)
+    for i, field in ipairs(FIELDS) do
+        if values[i] ~= cjson.null then
+            tweet[field] = values[i]
+        end
+    end
+    for field, value in pairs(values[#FIELDS + 1] or {}) do
+        tweet[field] = value
+    end
+    return tweet
+end
+
+-- replace the fields of the tweet
+local function store_tweet(tid, tweet)
+    local key, bucket = locate(tid)
+    if not bucket then
+        local flat = {}
+        for field, value in pairs(tweet) do
+            flat[#flat + 1] = field
+            flat[#flat + 1] = value
+        end
+        redis.call("DEL", key)
+        redis.call("HSET", key, unpack(flat))
+        return
+    end
+    local values, others, known = {}, nil, {}
+    for i, field in ipairs(FIELDS) do
+        values[i] = tweet[field] or cjson.null
+        known[field] = true
+    end
+    for field, value in pairs(tweet) do
+        if not known[field] then
+            others = others or {}
+            others[field] = value
+        end
+    end
+    values[#FIELDS + 1] = others
+    redis.call("HSET", key, tid, cjson.encode(values))
+end
+
+local function remove_tweet(tid)
+    local key, bucket = locate(tid)
+    if bucket then
+        redis.call("HDEL", key, tid)
+    else
+        redis.call("DEL", key)
+    end
+end
+"""
+)
+
+# helpers of the scripts writing the tweets, they only use the tweet's key
+_TWEETS = (
+    _RECORDS
+    + "local IMAGE_FIELDS = {"
+    + ", ".join(f'"{field}"' for field in records.IMAGE_FIELDS)
+    + "}"
+    + """
+
+-- the s3 keys of the tweet's image and derivatives
+local function images(tweet)
+    local keys = {}
+    for _, field in ipairs(IMAGE_FIELDS) do
+        if tweet[field] then
+            keys[#keys + 1] = tweet[field]
+        end
+    end
+    return keys
+end
+
+-- the version of the rendered tweet changed
+local function touch(tweet)
+    tweet.version = tostring((tonumber(tweet.version) or 0) + 1)
+end
+
+-- update the user's tweet with the fields and image ("" removes it), returns
+-- false if it is not the user's tweet, otherwise its previous text and the keys
+-- of its previous images
+local function update_tweet(uid, tid, timestamp, image, fields)
+    local tweet = load_tweet(tid)
+    if not tweet or tweet.uid ~= uid then
+        return false
+    end
+    local previous_text, previous_images = tweet.tweet_text or "", images(tweet)
+    -- a new image is pending (image_status is in the fields) or already uploaded
+    tweet.image_status = nil
+    for _, field in ipairs(IMAGE_FIELDS) do
+        tweet[field] = nil
+    end
+    tweet.timestamp = timestamp
+    for i = 1, #fields, 2 do
+        tweet[fields[i]] = fields[i + 1]
+    end
+    if image ~= "" then
+        tweet.image = image
+    end
+    touch(tweet)
+    store_tweet(tid, tweet)
+    return previous_text, previous_images
+end
+
+-- delete the user's tweet, returns false if it is not the user's tweet,
+-- otherwise its text and the keys of its images
+local function delete_tweet(uid, tid)
+    local tweet = load_tweet(tid)
+    if not tweet or tweet.uid ~= uid then
+        return false
+    end
+    remove_tweet(tid)
+    return tweet.tweet_text or "", images(tweet)
+end
+
+-- the upload worker is done with the tweet's image (fields are the keys of its
+-- derivatives), returns false if the image is not the tweet's anymore,
+-- otherwise the uid of the tweet
+local function image_uploaded(tid, image, status, fields)
+    local tweet = load_tweet(tid)
+    if not tweet or tweet.image ~= image then
+        return false
+    end
+    if status == "ready" then
+        tweet.image_status = nil
+    else
+        tweet.image_status = status
+    end
+    for i = 1, #fields, 2 do
+        tweet[fields[i]] = fields[i + 1]
+    end
+    touch(tweet)
+    store_tweet(tid, tweet)
+    return tweet.uid
+end
+"""
+)
+
+# helpers of the follow scripts, follow / unfollow only use the keys of uid,
+# followed / unfollowed the keys of other
+_FOLLOWS = """
+-- returns whether the timeline of the user is built
+local function follow(uid, other, celebrity)
+    if redis.call("SADD", tagged("following", uid), other) == 1 then
+        redis.call("HINCRBY", tagged("counts", uid), "following", 1)
+    end
+    if celebrity then
+        redis.call("SADD", tagged("following:celebrities", uid), other)
+    end
+    redis.call("ZREM", tagged("suggestions", uid), other)
+    redis.call("INCR", tagged("feed", uid))
+    return redis.call("EXISTS", tagged("timeline:built", uid)) == 1
+end
+
+-- returns the number of followers of other
+local function followed(other, uid)
+    if redis.call("SADD", tagged("followers", other), uid) == 1 then
+        redis.call("HINCRBY", tagged("counts", other), "followers", 1)
+    end
+    redis.call("INCR", tagged("feed", other))
+    return redis.call("SCARD", tagged("followers", other))
+end
+
+local function unfollow(uid, other)
+    if redis.call("SREM", tagged("following", uid), other) == 1 then
+        redis.call("HINCRBY", tagged("counts", uid), "following", -1)
+    end
+    redis.call("SREM", tagged("following:celebrities", uid), other)
+    redis.call("INCR", tagged("feed", uid))
+end
+
+local function unfollowed(other, uid)
+    if redis.call("SREM", tagged("followers", other), uid) == 1 then
+        redis.call("HINCRBY", tagged("counts", other), "followers", -1)
+    end
+    redis.call("INCR", tagged("feed", other))
+end
+"""
+
+# KEYS: (optional) upload queue, the "<tid>:<image>" job is queued to it
+# ARGV: uid, timestamp, timeline max length, field, value, ...
+# returns the tid
+POST_TWEET = (
+    _KEYS
+    + _TIMELINES
+    + _RECORDS
+    + """
+local uid, timestamp, max_length = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local tid = redis.call("INCR", "tid")
+local tweet = {timestamp = timestamp, uid = uid, version = "1"}
+for i = 4, #ARGV, 2 do
+    tweet[ARGV[i]] = ARGV[i + 1]
+end
+store_tweet(tid, tweet)
+redis.call("ZADD", shard("tids", tid), timestamp, tid)
+local followers = user_tweeted(uid, tid, timestamp, max_length, is_celebrity(uid))
+fan_out(followers, tid, timestamp, max_length)
+for i = 4, #ARGV, 2 do
+    if ARGV[i] == "image" then
+        redis.call("ZADD", shard("images", tid), timestamp, tid)
+        if KEYS[1] then
+            redis.call("LPUSH", KEYS[1], tid .. ":" .. ARGV[i + 1])
+        end
+    end
+end
+return tid
+"""
+)
+
+# KEYS: (optional) upload queue, the "<tid>:<image>" job is queued to it
+# ARGV: uid, tid, timestamp, timeline max length, image ("" removes it), field,
+# value, ...
+# returns {0} if the tweet is not the user's, otherwise {1, previous text,
+# previous image keys...}
+UPDATE_TWEET = (
+    _KEYS
+    + _TIMELINES
+    + _TWEETS
+    + """
+local uid, tid, timestamp, max_length = ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4])
+local image = ARGV[5]
+local previous_text, previous_images =
+    update_tweet(uid, tid, timestamp, image, {unpack(ARGV, 6)})
+if not previous_text then
+    return {0}
+end
+if image ~= "" and KEYS[1] then
+    redis.call("LPUSH", KEYS[1], tid .. ":" .. image)
+end
+-- move the tweet to the top of the indexes and timelines
+redis.call("ZADD", shard("tids", tid), timestamp, tid)
+if image ~= "" then
+    redis.call("ZADD", shard("images", tid), timestamp, tid)
+else
+    redis.call("ZREM", shard("images", tid), tid)
+end
+local followers = user_tweeted(uid, tid, timestamp, max_length, is_celebrity(uid))
+fan_out(followers, tid, timestamp, max_length)
+return {1, previous_text, unpack(previous_images)}
+"""
+)
+
+# ARGV: uid, tid
+# returns {0} if the tweet is not the user's, otherwise {1, text, image keys...}
+DELETE_TWEET = (
+    _KEYS
+    + _TIMELINES
+    + _TWEETS
+    + """
+local uid, tid = ARGV[1], ARGV[2]
+local text, keys = delete_tweet(uid, tid)
+if not text then
+    return {0}
+end
+redis.call("ZREM", shard("tids", tid), tid)
+redis.call("ZREM", shard("images", tid), tid)
+fan_out(user_tweeted(uid, tid, false, 0, is_celebrity(uid)), tid, false, 0)
+return {1, text, unpack(keys)}
+"""
+)
+
+# ARGV: uid, uid to follow, max followers before being a celebrity, timeline
+# max length
+FOLLOW = (
+    _KEYS
+    + _FOLLOWS
+    + """
+local uid, other = ARGV[1], ARGV[2]
+local max_followers, max_length = tonumber(ARGV[3]), tonumber(ARGV[4])
+-- celebrities are never unmarked so that none of their tweets go missing, their
+-- followers merge their tweets on read from now on
+if followed(other, uid) > max_followers
+    and redis.call("SADD", "celebrities", other) == 1 then
+    for _, follower in ipairs(redis.call("SMEMBERS", tagged("followers", other))) do
+        redis.call("SADD", tagged("following:celebrities", follower), other)
+    end
+end
+local celebrity = redis.call("SISMEMBER", "celebrities", other) == 1
+-- add the followed user's tweets to the timeline (if it is built, otherwise
+-- they are included when it is built), celebrities are merged on read
+if follow(uid, other, celebrity) and not celebrity then
+    local key = tagged("timeline", uid)
+    local tweets = redis.call(
+        "ZREVRANGE", tagged("user:tweets", other), 0, max_length - 1, "WITHSCORES"
+    )
+    for i = 1, #tweets, 2 do
+        redis.call("ZADD", key, tweets[i + 1], tweets[i])
+    end
+    redis.call("ZREMRANGEBYRANK", key, 0, -max_length - 1)
+end
+return 1
+"""
+)
+
+# ARGV: uid, uid to unfollow, timeline max length
+UNFOLLOW = (
+    _KEYS
+    + _FOLLOWS
+    + """
+local uid, other, max_length = ARGV[1], ARGV[2], tonumber(ARGV[3])
+unfollow(uid, other)
+unfollowed(other, uid)
+-- remove the unfollowed user's tweets from the timeline, it only keeps the
+-- latest max_length tweets so the older tweets of the user cannot be in it
+local tids = redis.call("ZREVRANGE", tagged("user:tweets", other), 0, max_length - 1)
+for _, tid in ipairs(tids) do
+    redis.call("ZREM", tagged("timeline", uid), tid)
+end
+return 1
+"""
+)
+
+# KEYS: tids or user:tweets:<uid> (in the layout before keys.py)
+# converts a set of tids into a sorted set scored by the tweets' timestamps in
+# one atomic step, so that no tweet posted during the migration is lost
+MIGRATE_INDEX = """
+if redis.call("TYPE", KEYS[1]).ok ~= "set" then
+    return 0
+end
+local tids = redis.call("SMEMBERS", KEYS[1])
+redis.call("DEL", KEYS[1])
+for _, tid in ipairs(tids) do
+    local timestamp = redis.call("HGET", "tweets:" .. tid, "timestamp")
+    if timestamp then
+        redis.call("ZADD", KEYS[1], timestamp, tid)
+    end
+end
+return 1
+"""
+
+# KEYS: uploads:processing
+# ARGV: job, tid, image, status ("ready" or "failed"), derivative field, key, ...
+# returns 0 if the image is not the tweet's anymore, otherwise 1
+FINISH_UPLOAD = (
+    _KEYS
+    + _TIMELINES
+    + _TWEETS
+    + """
+local tid, image, status = ARGV[2], ARGV[3], ARGV[4]
+redis.call("LREM", KEYS[1], 1, ARGV[1])
+local uid = image_uploaded(tid, image, status, {unpack(ARGV, 5)})
+if not uid then
+    return 0
+end
+fan_out(user_touched(uid, is_celebrity(uid)), false)
+return 1
+"""
+)
+
+# KEYS: sid
+# returns {} if the session or its user is invalid, otherwise {uid, profile
+# field, value, ...}
+RESOLVE_SESSION = (
+    _KEYS
+    + """
+local email = redis.call("HGET", KEYS[1], "email")
+if not email then
+    return {}
+end
+local uid = redis.call("HGET", email_shard(email), email)
+if not uid or redis.call("SISMEMBER", shard("uids", uid), uid) == 0 then
+    return {}
+end
+return {uid, unpack(redis.call("HGETALL", tagged("users", uid)))}
+"""
+)
+
+# KEYS: counts:{uid}
+# ARGV: uid
+# recompute counts:{uid} from the sets, returns {followers, following, tweets}
+REPAIR_COUNTS = (
+    _KEYS
+    + """
+local uid = ARGV[1]
+local counts = {
+    redis.call("SCARD", tagged("followers", uid)),
+    redis.call("SCARD", tagged("following", uid)),
+    redis.call("ZCARD", tagged("user:tweets", uid)),
+}
+redis.call(
+    "HSET", KEYS[1],
+    "followers", counts[1], "following", counts[2], "tweets", counts[3]
+)
+return counts
+"""
+)
+
+# KEYS: the shard of the uids the random users are drawn from
+# ARGV: uid, size, random size, sample of the followed users, sample of their
+# followed users, seconds the suggestions are kept
+# returns the suggested uids: the friends of friends with the most mutual
+# follows, then random users (at least random size of them)
+SUGGEST = (
+    _KEYS
+    + """
+local uid, size, random_size = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local sample, fanout, ttl = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local key, following = tagged("suggestions", uid), tagged("following", uid)
+local function candidate(user_id)
+    return user_id ~= uid and not redis.call("ZSCORE", key, user_id)
+        and redis.call("SISMEMBER", following, user_id) == 0
+end
+-- mutual follows among a bounded sample of the followed users' follows
+local mutuals = {}
+for _, followed in ipairs(redis.call("SRANDMEMBER", following, sample)) do
+    local follows = redis.call("SRANDMEMBER", tagged("following", followed), fanout)
+    for _, user_id in ipairs(follows) do
+        mutuals[user_id] = (mutuals[user_id] or 0) + 1
+    end
+end
+local ranked = {}
+for user_id, count in pairs(mutuals) do
+    ranked[#ranked + 1] = {user_id, count}
+end
+table.sort(ranked, function(a, b) return a[2] > b[2] end)
+redis.call("DEL", key)
+local suggested = {}
+for _, user in ipairs(ranked) do
+    if #suggested >= size - random_size then
+        break
+    end
+    if candidate(user[1]) then
+        redis.call("ZADD", key, user[2], user[1])
+        suggested[#suggested + 1] = user[1]
+    end
+end
+for _, user_id in ipairs(redis.call("SRANDMEMBER", KEYS[1], size * 2)) do
+    if #suggested >= size then
+        break
+    end
+    if candidate(user_id) then
+        redis.call("ZADD", key, 0, user_id)
+        suggested[#suggested + 1] = user_id
+    end
+end
+redis.call("EXPIRE", key, ttl)
+redis.call("SET", tagged("suggestions:fresh", uid), 1, "EX", ttl)
+return suggested
+"""
+)
+
+# ARGV: tid, ...
+# add the given tweets to the images index if they have an image, returns the
+# number of tweets added
+INDEX_IMAGES = (
+    _KEYS
+    + _RECORDS
+    + """
+local added = 0
+for _, tid in ipairs(ARGV) do
+    local timestamp = redis.call("ZSCORE", shard("tids", tid), tid)
+    local tweet = timestamp and load_tweet(tid)
+    if tweet and tweet.image then
+        added = added + redis.call("ZADD", shard("images", tid), timestamp, tid)
+    end
+end
+return added
+"""
+)
+
+# ARGV: uid whose followed celebrities are included ("" for none), uid or "*", ...
+# returns {"<uid>=<version>", ...} of the given feeds and of the celebrities'
+# ones (their tweets are merged on read, see timelines.get_timeline)
+FEED_VERSIONS = (
+    _KEYS
+    + """
+local uids = {}
+for i = 2, #ARGV do
+    uids[#uids + 1] = ARGV[i]
+end
+if ARGV[1] ~= "" then
+    local celebrities = redis.call("SMEMBERS", tagged("following:celebrities", ARGV[1]))
+    table.sort(celebrities)
+    for _, celebrity in ipairs(celebrities) do
+        uids[#uids + 1] = celebrity
+    end
+end
+local versions = {}
+for i, uid in ipairs(uids) do
+    versions[i] = uid .. "=" .. (redis.call("GET", tagged("feed", uid)) or "0")
+end
+return versions
+"""
+)
+
+# KEYS: the trending key, the refreshed key, the buckets of the window (in one
+# hash slot, see trending.py)
+# ARGV: number of trending tags, seconds they are kept, seconds they are fresh,
+# weight of each bucket
+# returns the number of trending tags
+REFRESH_TRENDING = """
+local size = tonumber(ARGV[1])
+local union = {"ZUNIONSTORE", KEYS[1], #KEYS - 2}
+for i = 3, #KEYS do
+    union[#union + 1] = KEYS[i]
+end
+union[#union + 1] = "WEIGHTS"
+for i = 4, #ARGV do
+    union[#union + 1] = ARGV[i]
+end
+redis.call(unpack(union))
+redis.call("ZREMRANGEBYRANK", KEYS[1], 0, -size - 1)
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("SET", KEYS[2], 1, "EX", ARGV[3])
+return redis.call("ZCARD", KEYS[1])
+"""
+
+#
+# the steps of the scripts above on a redis cluster (see cluster.py), each of
+# them only uses the keys of the slot of its KEYS[1]
+#
+
+# the tweet's key is given, tweet:buckets is in another slot
+_GIVEN_TWEET = """
+locate = function(tid)
+    return KEYS[1], string.find(KEYS[1], "tweets:bucket:", 1, true) == 1
+end
+"""
+
+# KEYS: the key of the tweet (see keys.tweet_key)
+# ARGV: same as UPDATE_TWEET
+# returns same as UPDATE_TWEET
+TWEET_UPDATE = (
+    _TWEETS
+    + _GIVEN_TWEET
+    + """
+local uid, tid, timestamp, image = ARGV[1], ARGV[2], ARGV[3], ARGV[5]
+local previous_text, previous_images =
+    update_tweet(uid, tid, timestamp, image, {unpack(ARGV, 6)})
+if not previous_text then
+    return {0}
+end
+return {1, previous_text, unpack(previous_images)}
+"""
+)
+
+# KEYS: the key of the tweet (see keys.tweet_key)
+# ARGV: same as DELETE_TWEET
+# returns same as DELETE_TWEET
+TWEET_DELETE = (
+    _TWEETS
+    + _GIVEN_TWEET
+    + """
+local text, keys = delete_tweet(ARGV[1], ARGV[2])
+if not text then
+    return {0}
+end
+return {1, text, unpack(keys)}
+"""
+)
+
+# KEYS: the key of the tweet (see keys.tweet_key)
+# ARGV: same as FINISH_UPLOAD
+# returns the uid of the tweet, nil if the image is not the tweet's anymore
+TWEET_IMAGE_UPLOADED = (
+    _TWEETS
+    + _GIVEN_TWEET
+    + """
+return image_uploaded(ARGV[2], ARGV[3], ARGV[4], {unpack(ARGV, 5)})
+"""
+)
+
+# KEYS: user:tweets:{uid}
+# ARGV: uid, tid, timestamp ("" if the tweet is deleted), timeline max length,
+# whether the user is a celebrity (1 or 0)
+# returns the followers the tweet is fanned out to
+USER_TWEETED = (
+    _KEYS
+    + _TIMELINES
+    + """
+local uid, tid, max_length = ARGV[1], ARGV[2], tonumber(ARGV[4])
+local timestamp = ARGV[3] ~= "" and ARGV[3]
+return user_tweeted(uid, tid, timestamp, max_length, ARGV[5] == "1")
+"""
+)
+
+# KEYS: user:tweets:{uid}
+# ARGV: uid, whether the user is a celebrity (1 or 0)
+# returns the followers whose pages changed
+USER_TOUCHED = (
+    _KEYS
+    + _TIMELINES
+    + """
+return user_touched(ARGV[1], ARGV[2] == "1")
+"""
+)
+
+# KEYS: following:{uid}
+# ARGV: uid, uid to follow, whether the followed user is a celebrity (1 or 0)
+# returns 1 if the timeline of the user is built, otherwise 0
+USER_FOLLOW = (
+    _KEYS
+    + _FOLLOWS
+    + """
+return follow(ARGV[1], ARGV[2], ARGV[3] == "1") and 1 or 0
+"""
+)
+
+# KEYS: followers:{other}
+# ARGV: followed uid, uid of the follower
+# returns the number of followers
+USER_FOLLOWED = (
+    _KEYS
+    + _FOLLOWS
+    + """
+return followed(ARGV[1], ARGV[2])
+"""
+)
+
+# KEYS: following:{uid}
+# ARGV: uid, uid to unfollow
+USER_UNFOLLOW = (
+    _KEYS
+    + _FOLLOWS
+    + """
+unfollow(ARGV[1], ARGV[2])
+return 1
+"""
+)
+
+# KEYS: followers:{other}
+# ARGV: unfollowed uid, uid of the follower
+USER_UNFOLLOWED = (
+    _KEYS
+    + _FOLLOWS
+    + """
+unfollowed(ARGV[1], ARGV[2])
+return 1
+"""
+)
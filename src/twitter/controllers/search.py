@@ -0,0 +1,127 @@
+import os
+import re
+
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import tags
+from twitter.controllers import records
+from twitter.controllers import pagination
+
+# the words shorter than this are not indexed (nor searched)
+SEARCH_MIN_TERM_LENGTH = int(os.environ.get("SEARCH_MIN_TERM_LENGTH", 2))
+# a query is limited to its first terms
+SEARCH_MAX_TERMS = int(os.environ.get("SEARCH_MAX_TERMS", 5))
+# seconds the result of a query of several terms is kept for its next pages
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 60))
+
+#
+# search.py: full text search over the tweets, with an inverted index kept up to
+# date by the writes of the tweets (see LoggedInUser.post_tweet)
+#
+# {search:<n>}:<term> --> sorted set of the tids of shard n (tid % shards, as
+#   {tids:<n>}) of the tweets with the term, scored by the tweet timestamp
+# {search:<n>}:query:<terms> --> the intersection of the terms' sets of shard n,
+#   kept SEARCH_CACHE_TTL seconds for the next pages of the query
+#
+# the keys of a shard are in one hash slot, so that the intersections run on the
+# server even on a redis cluster; the index is written after the tweet, a tweet
+# deleted in the meantime is skipped when the results are loaded
+#
+
+_WORD = re.compile(r"\w+")
+
+
+# the indexed terms of the text (lowercase words, "#tag" is "tag"), in order
+def get_terms(text):
+    words = _WORD.findall((text or "").lower())
+    return list(
+        dict.fromkeys(word for word in words if len(word) >= SEARCH_MIN_TERM_LENGTH)
+    )
+
+
+# the searched terms of the query (its first SEARCH_MAX_TERMS terms), sorted
+def get_query_terms(query):
+    return sorted(get_terms(query)[:SEARCH_MAX_TERMS])
+
+
+# queue the index of the posted or updated tweet (previous_text is the text
+# before the update, the deleted tweet has an empty text) on the pipeline (or
+# write it), see tags.index_tweet
+def index_tweet(conn, tid, timestamp, text, previous_text, shards):
+    n = int(tid) % shards
+    terms = get_terms(text)
+    for term in set(get_terms(previous_text)) - set(terms):
+        conn.zrem(keys.search_term(term, n), tid)
+    for term in terms:
+        conn.zadd(keys.search_term(term, n), {tid: timestamp})
+
+
+# a page of the tids of the tweets with all the terms of the query after the
+# cursor, newest first, and the cursor of the next page
+def search(query, cursor=None, count=pagination.PAGE_SIZE, client=None):
+    client = client or redis.get_redis_client()
+    terms = get_query_terms(query)
+    if not terms:
+        return [], None
+    shards = range(client.shards)
+    if len(terms) == 1:
+        return pagination.get_merged_page(
+            [keys.search_term(terms[0], n) for n in shards],
+            cursor=cursor,
+            count=count,
+            client=client,
+        )
+    results = [keys.search_query(terms, n) for n in shards]
+    # the first page intersects the terms, the next ones read the intersection
+    # (unless it expired)
+    pipe = client.conn.pipeline(transaction=False)
+    for key in results:
+        pipe.exists(key)
+    exists = pipe.execute() if cursor else [False] * len(results)
+    pipe = client.conn.pipeline(transaction=False)
+    for n, key, exist in zip(shards, results, exists):
+        if not exist:
+            sources = [keys.search_term(term, n) for term in terms]
+            pipe.zinterstore(key, sources, aggregate="MAX")
+            pipe.expire(key, SEARCH_CACHE_TTL)
+    pipe.execute()
+    return pagination.get_merged_page(
+        results, cursor=cursor, count=count, client=client, primary=True
+    )
+
+
+# rebuild the index, and the tags and mentions indexes (see tags.py), from the
+# tweets, returns the number of tweets indexed
+def reindex(client=None, batch_size=1000):
+    client = client or redis.get_redis_client()
+    conn = client.conn
+    indexes = [
+        key
+        for pattern in (f"{{{keys.SEARCH}:*", keys.tag("*"), keys.mentions("*"))
+        for key in conn.scan_iter(match=pattern, count=batch_size)
+    ]
+    for start in range(0, len(indexes), batch_size):
+        pipe = conn.pipeline(transaction=False)
+        for key in indexes[start : start + batch_size]:
+            pipe.delete(key)
+        pipe.execute()
+    buckets, indexed = client.tweet_buckets, 0
+    for shard in keys.all_shards(keys.TIDS, client.shards):
+        # the tids with their timestamp
+        entries = list(conn.zscan_iter(shard, count=batch_size))
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start : start + batch_size]
+            pipe = conn.pipeline(transaction=False)
+            for tid, _ in batch:
+                records.read(pipe, tid, buckets)
+            tweets = [records.parse(tweet, buckets) for tweet in pipe.execute()]
+            pipe = conn.pipeline(transaction=False)
+            for (tid, timestamp), tweet in zip(batch, tweets):
+                if not tweet:
+                    continue
+                text = tweet.get("tweet_text")
+                index_tweet(pipe, tid, timestamp, text, None, client.shards)
+                tags.index_tweet(pipe, tid, timestamp, text)
+                indexed += 1
+            pipe.execute()
+    return indexed
@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from twitter.controllers import redis
+from twitter.controllers import steps
+from twitter.controllers import scripts
+
+# seconds a resolved session is kept in the memory of the worker (0 disables
+# it), a logged out session stays valid in the other workers for that long
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 0))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+
+#
+# sessions.py: resolve a session id into the logged in user, in one round trip
+#
+# a resolved session is {"uid": uid, "profile": users:{uid}}, it is resolved
+# once per request (see auth.get_session) and optionally cached per worker
+#
+
+
+class SessionCache(object):
+    def __init__(self, ttl=SESSION_CACHE_TTL, max_size=SESSION_CACHE_SIZE):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # sid --> (resolved session, expiry)
+        self._sessions = OrderedDict()
+
+    def get(self, sid):
+        with self._lock:
+            session, expiry = self._sessions.get(sid, (None, 0))
+            if expiry <= time.time():
+                self._sessions.pop(sid, None)
+                return None
+            return session
+
+    def set(self, sid, session):
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            self._sessions[sid] = (session, time.time() + self._ttl)
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self._max_size:
+                self._sessions.popitem(last=False)
+
+    def invalidate(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+
+# the logged in user of the session, None if the session (or its user) is invalid
+def resolve(sid, client=None, cache=None):
+    client = client or redis.get_redis_client()
+    return steps.run(resolve_steps(sid, client, cache))
+
+
+# the steps of resolve, with the sync or the async client (see steps.py)
+def resolve_steps(sid, client, cache=None):
+    cache = cache or get_session_cache()
+    session = cache.get(sid)
+    if session is None:
+        result = yield steps.call(
+            client.run_script, scripts.RESOLVE_SESSION, keys=[sid], read_only=True
+        )
+        if not result:
+            return None
+        session = parse(result)
+        cache.set(sid, session)
+    return session
+
+
+# the resolved session from the (non empty) result of the RESOLVE_SESSION script
+def parse(result):
+    uid, *profile = result
+    return {"uid": uid, "profile": dict(zip(profile[::2], profile[1::2]))}
+
+
+#
+# Process-wide registry
+#
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_session_cache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = SessionCache()
+        return _cache
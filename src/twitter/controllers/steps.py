@@ -0,0 +1,85 @@
+import asyncio
+import inspect
+import functools
+import contextvars
+
+#
+# steps.py: the reads written once for the sync and the async redis clients
+#
+# a read is a generator yielding its steps, and given back their results:
+#   call(function, *args) --> a call of the client (e.g. the execute of a
+#     pipeline), awaited when the client is async
+#   blocking(function, *args) --> a call of the sync controllers (e.g. building
+#     a timeline), run in the default executor on the event loop
+#   a generator --> a nested read
+#   [steps] --> independent steps, their results as a list
+#
+# run drives a read with the sync client, one step after the other; run_async
+# drives it on the event loop with the async client (see aio.py), with the
+# independent steps in flight at the same time
+#
+
+
+class Call(object):
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.function(*self.args, **self.kwargs)
+
+
+class Blocking(Call):
+    pass
+
+
+def call(function, *args, **kwargs):
+    return Call(function, *args, **kwargs)
+
+
+def blocking(function, *args, **kwargs):
+    return Blocking(function, *args, **kwargs)
+
+
+# the result of the read (or of any step), with the sync client
+def run(step):
+    if isinstance(step, list):
+        return [run(each) for each in step]
+    if not inspect.isgenerator(step):
+        return step()
+    result, error = None, None
+    while True:
+        try:
+            next_step = step.throw(error) if error else step.send(result)
+        except StopIteration as e:
+            return e.value
+        try:
+            result, error = run(next_step), None
+        except Exception as e:
+            result, error = None, e
+
+
+# the result of the read (or of any step), with the async client
+async def run_async(step):
+    if isinstance(step, list):
+        return list(await asyncio.gather(*(run_async(each) for each in step)))
+    if isinstance(step, Blocking):
+        # in the context of the request (e.g. its metrics)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(context.run, step)
+        )
+    if not inspect.isgenerator(step):
+        result = step()
+        return await result if inspect.isawaitable(result) else result
+    result, error = None, None
+    while True:
+        try:
+            next_step = step.throw(error) if error else step.send(result)
+        except StopIteration as e:
+            return e.value
+        try:
+            result, error = await run_async(next_step), None
+        except Exception as e:
+            result, error = None, e
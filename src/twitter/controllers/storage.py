@@ -0,0 +1,1375 @@
+import os
+import abc
+import json
+import time
+import random
+import sqlite3
+import functools
+import threading
+import contextlib
+
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import steps
+from twitter.controllers import records
+from twitter.controllers import scripts
+from twitter.controllers import metrics
+from twitter.controllers import sessions
+from twitter.controllers import timelines
+from twitter.controllers import pagination
+from twitter.controllers import suggestions
+from twitter.controllers import trending
+from twitter.controllers import search
+from twitter.controllers import tags
+
+# where the app keeps its data: "redis" (the layout of keys.py) or "sqlite" (an
+# embedded database in the STORAGE_SQLITE_PATH file, without a redis server)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "redis")
+STORAGE_SQLITE_PATH = os.environ.get("STORAGE_SQLITE_PATH", "twitter.db")
+# seconds between two polls of the sqlite upload queue by a waiting worker
+STORAGE_SQLITE_POLL = float(os.environ.get("STORAGE_SQLITE_POLL", 0.2))
+
+#
+# storage.py: the data of the app (users, sessions, follow graph, tweets, the
+# pages of tweets, the upload queue) behind one interface, with two backends
+#
+# RedisStorage --> the redis layout of the rest of the controllers (see keys.py),
+#   the writes run the scripts of scripts.py and keep the search, tags and
+#   trending indexes up to date
+# SQLiteStorage --> an embedded single node database (a file, or ":memory:"),
+#   e.g. for small deployments and hermetic tests, without a redis server
+#
+# the uids and tids are strings, a tweet is its fields with "tid", "uid",
+# "timestamp" (a float) and "version", and the pages are the pages of tids of
+# pagination.py (newest first, "<timestamp>:<tid>" cursors); the models (see
+# users.py and tweets.py), the views and the upload worker go through the
+# storage of get_storage, the maintenance commands of the cli (migrations,
+# export, ...) work on the redis layout directly
+#
+# the reads of the timeline pages are also steps (see steps.py and reads), run
+# by the sync and the async apps (see pages.py)
+#
+
+
+class Storage(abc.ABC):
+    #
+    # users
+    #
+
+    # create the user with the profile (its "email" is required), returns its uid
+    @abc.abstractmethod
+    def create_user(self, profile):
+        raise NotImplementedError
+
+    # the uid of the user with the email, None if there is none
+    @abc.abstractmethod
+    def get_uid(self, email):
+        raise NotImplementedError
+
+    # the profiles of the users (uid --> profile, {} for an unknown user),
+    # duplicated uids are only fetched once
+    @abc.abstractmethod
+    def get_users(self, uids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def user_exists(self, uid):
+        raise NotImplementedError
+
+    # a page of uids after the cursor (the page size is only a hint), and the
+    # cursor of the next page
+    @abc.abstractmethod
+    def get_users_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the uids of the users suggested to the user (see suggestions.py), from the
+    # most to the least relevant
+    @abc.abstractmethod
+    def get_suggestions(self, uid):
+        raise NotImplementedError
+
+    #
+    # sessions
+    #
+
+    @abc.abstractmethod
+    def create_session(self, sid, email, token):
+        raise NotImplementedError
+
+    # the logged in user of the session ({"uid", "profile"}), None if the
+    # session (or its user) is invalid
+    @abc.abstractmethod
+    def resolve_session(self, sid):
+        raise NotImplementedError
+
+    # log the session out, returns its token (None if it was not logged in)
+    @abc.abstractmethod
+    def delete_session(self, sid):
+        raise NotImplementedError
+
+    #
+    # follow graph
+    #
+
+    # follow / unfollow another user, False for the user itself
+    @abc.abstractmethod
+    def follow(self, uid, other):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def unfollow(self, uid, other):
+        raise NotImplementedError
+
+    # the uids of the user's followers / followed users
+    @abc.abstractmethod
+    def get_followers(self, uid):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_following(self, uid):
+        raise NotImplementedError
+
+    # a random sample of (at most count) followers' / followed users' uids
+    @abc.abstractmethod
+    def sample_followers(self, uid, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sample_following(self, uid, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the uids (among the given ones) followed by the user
+    @abc.abstractmethod
+    def is_following_many(self, uid, uids):
+        raise NotImplementedError
+
+    # {"num_of_followers", "num_of_following", "num_of_tweets"} of the user
+    @abc.abstractmethod
+    def get_counts(self, uid):
+        raise NotImplementedError
+
+    #
+    # tweets
+    #
+
+    # a new image id, so that an image id always refers to the same content and
+    # its (cached) presigned url can be reused
+    @abc.abstractmethod
+    def next_image_id(self):
+        raise NotImplementedError
+
+    # post the tweet with the fields (e.g. tweet_text, image) at the timestamp
+    # (now by default), returns its tid; a tweet with an image is queued for the
+    # upload worker
+    @abc.abstractmethod
+    def post_tweet(self, uid, fields, timestamp=None):
+        raise NotImplementedError
+
+    # replace the fields and the image ("" removes it, a new one is queued for
+    # the upload worker) of the user's tweet and move it to the timestamp (now
+    # by default), returns the keys of the images the tweet had, None if it is
+    # not the user's tweet
+    @abc.abstractmethod
+    def update_tweet(self, uid, tid, fields, image="", timestamp=None):
+        raise NotImplementedError
+
+    # returns the keys of the images the tweet had, None if it is not the user's
+    # tweet
+    @abc.abstractmethod
+    def delete_tweet(self, uid, tid):
+        raise NotImplementedError
+
+    # the tweets, in the order of the tids (tweets that no longer exist are
+    # skipped)
+    @abc.abstractmethod
+    def get_tweets(self, tids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def tweet_exists(self, tid):
+        raise NotImplementedError
+
+    #
+    # pages, a page of tids after the cursor and the cursor of the next page
+    #
+
+    # all the tweets
+    @abc.abstractmethod
+    def get_tweets_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_user_tweets_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the tweets with an image
+    @abc.abstractmethod
+    def get_images_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the tweets mentioning the user / with the #tag (see tags.py)
+    @abc.abstractmethod
+    def get_mentions_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_tag_page(self, tag, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the tweets with all the words of the query (see search.py)
+    @abc.abstractmethod
+    def search(self, query, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the personal timeline (the user's and followed users' tweets)
+    @abc.abstractmethod
+    def get_timeline_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        raise NotImplementedError
+
+    # the versions of the feeds of the given uids ("*" for all the tweets) and,
+    # if celebrities_of is given, of the users whose tweets are merged into that
+    # user's timeline on read, a page showing them is unchanged as long as they
+    # are (see timelines.get_feed_versions)
+    @abc.abstractmethod
+    def get_feed_versions(self, uids, celebrities_of=None):
+        raise NotImplementedError
+
+    # the trending tags, [(tag, score)] from the most to the least trending
+    @abc.abstractmethod
+    def get_trending(self):
+        raise NotImplementedError
+
+    #
+    # upload queue (see uploads.py)
+    #
+
+    # take the next job, waiting up to timeout seconds for it (0 does not wait),
+    # returns (job, tid, iid), None if there is none
+    @abc.abstractmethod
+    def take_upload(self, timeout=0):
+        raise NotImplementedError
+
+    # put back the jobs taken by the workers that died while processing them
+    @abc.abstractmethod
+    def requeue_uploads(self):
+        raise NotImplementedError
+
+    # the worker is done with the job: set the status ("ready" or "failed") and
+    # the derivatives (field --> key) of the tweet's image, returns False if the
+    # image is not the tweet's anymore
+    @abc.abstractmethod
+    def finish_upload(self, job, tid, iid, status, derivatives):
+        raise NotImplementedError
+
+    #
+    # cache shared by the workers (see fragments.py)
+    #
+
+    # the cached values of the keys, None for the missing ones
+    @abc.abstractmethod
+    def get_cached(self, keys):
+        raise NotImplementedError
+
+    # cache the values (key --> value) for ttl seconds
+    @abc.abstractmethod
+    def set_cached(self, values, ttl):
+        raise NotImplementedError
+
+    # delete everything
+    @abc.abstractmethod
+    def reset_db(self):
+        raise NotImplementedError
+
+    # whether the reads may lag behind the writes (see auth.stick_to_primary)
+    @property
+    def has_replicas(self):
+        return False
+
+    # the reads of the storage as steps (see steps.py), each a blocking call of
+    # its method by default (run in the default executor by the async app)
+    def reads(self, client=None):
+        return BlockingReads(self)
+
+
+class RedisStorage(Storage):
+    def __init__(self, client=None):
+        self._client = client or redis.get_redis_client()
+
+    @property
+    def has_replicas(self):
+        return self._client.has_replicas
+
+    # the reads of the pages with the client of the storage, or with the given
+    # one (e.g. the async client of aio.py)
+    def reads(self, client=None):
+        return RedisReads(client or self._client)
+
+    def create_user(self, profile):
+        client = self._client
+        uid = str(client.conn.incr(keys.UID))
+        client.conn.sadd(keys.shard(keys.UIDS, uid, client.shards), uid)
+        # users:{uid} --> user info
+        client.conn.hset(keys.user(uid), mapping=_profile(uid, profile))
+        # [emails] email --> uid, which is used to identify the user
+        email = profile["email"]
+        client.conn.hset(keys.email_shard(email, client.shards), email, uid)
+        return uid
+
+    def get_uid(self, email):
+        client = self._client
+        return client.conn.hget(keys.email_shard(email, client.shards), email)
+
+    def get_users(self, uids):
+        return steps.run(self.reads().get_users(uids))
+
+    def user_exists(self, uid):
+        return steps.run(self.reads().user_exists(uid))
+
+    # the cursor is "<shard>:<SSCAN cursor>"
+    def get_users_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        client = self._client
+        shards = keys.all_shards(keys.UIDS, client.shards)
+        try:
+            shard, position = (int(part) for part in (cursor or "0:0").split(":"))
+            if not 0 <= shard < len(shards):
+                raise ValueError(shard)
+        except ValueError:
+            raise pagination.InvalidCursor(f"Invalid cursor {cursor!r}")
+        uids = []
+        # the next shard starts once this one is scanned, until the page has uids
+        while not uids and shard < len(shards):
+            position, uids = client.read_conn.sscan(
+                shards[shard], position, count=count
+            )
+            if not position:
+                shard += 1
+        return uids, (f"{shard}:{position}" if shard < len(shards) else None)
+
+    def get_suggestions(self, uid):
+        return steps.run(self.reads().get_suggestions(uid))
+
+    def create_session(self, sid, email, token):
+        # sid --> {email, access token}
+        self._client.conn.hset(sid, mapping={"email": email, "token": token})
+
+    def resolve_session(self, sid):
+        return steps.run(self.reads().resolve_session(sid))
+
+    def delete_session(self, sid):
+        conn = self._client.conn
+        (token,) = conn.hmget(sid, "token")
+        if token:
+            conn.hdel(sid, "token", "email")
+            sessions.get_session_cache().invalidate(sid)
+        return token
+
+    def follow(self, uid, other):
+        if str(uid) == str(other):
+            return False
+        self._client.run_script(
+            scripts.FOLLOW,
+            args=[
+                uid,
+                other,
+                timelines.FANOUT_MAX_FOLLOWERS,
+                timelines.TIMELINE_MAX_LENGTH,
+            ],
+        )
+        return True
+
+    def unfollow(self, uid, other):
+        if str(uid) == str(other):
+            return False
+        self._client.run_script(
+            scripts.UNFOLLOW, args=[uid, other, timelines.TIMELINE_MAX_LENGTH]
+        )
+        return True
+
+    def get_followers(self, uid):
+        return list(self._client.read_conn.smembers(keys.followers(uid)))
+
+    def get_following(self, uid):
+        return list(self._client.read_conn.smembers(keys.following(uid)))
+
+    def sample_followers(self, uid, count=pagination.PAGE_SIZE):
+        return steps.run(self.reads().sample_followers(uid, count))
+
+    def sample_following(self, uid, count=pagination.PAGE_SIZE):
+        return steps.run(self.reads().sample_following(uid, count))
+
+    def is_following_many(self, uid, uids):
+        return steps.run(self.reads().is_following_many(uid, uids))
+
+    def get_counts(self, uid):
+        return steps.run(self.reads().get_counts(uid))
+
+    def next_image_id(self):
+        return self._client.conn.incr(keys.IID)
+
+    # set the tweet, update the indexes and push the tweet to the timelines at
+    # once (and queue the image for the upload worker)
+    def post_tweet(self, uid, fields, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        tid = self._client.run_script(
+            scripts.POST_TWEET,
+            keys=[keys.UPLOADS],
+            args=[uid, timestamp, timelines.TIMELINE_MAX_LENGTH, *_flatten(fields)],
+        )
+        self._index_tweet(tid, timestamp, fields.get("tweet_text"))
+        return str(tid)
+
+    # update the tweet, its timestamp, indexes and timelines at once
+    def update_tweet(self, uid, tid, fields, image="", timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        updated, *previous = self._client.run_script(
+            scripts.UPDATE_TWEET,
+            keys=[keys.UPLOADS],
+            args=[
+                uid,
+                tid,
+                timestamp,
+                timelines.TIMELINE_MAX_LENGTH,
+                image,
+                *_flatten(fields),
+            ],
+        )
+        if not updated:
+            return None
+        previous_text, *previous_images = previous
+        self._index_tweet(tid, timestamp, fields.get("tweet_text"), previous_text)
+        return previous_images
+
+    # remove the tweet, its indexes and timelines entries at once
+    def delete_tweet(self, uid, tid):
+        deleted, *deleted_tweet = self._client.run_script(
+            scripts.DELETE_TWEET, args=[uid, tid]
+        )
+        if not deleted:
+            return None
+        text, *images = deleted_tweet
+        self._index_tweet(tid, None, "", previous_text=text)
+        return images
+
+    def get_tweets(self, tids):
+        return steps.run(self.reads().get_tweets(tids))
+
+    def tweet_exists(self, tid):
+        shard = keys.shard(keys.TIDS, tid, self._client.shards)
+        return self._client.read_conn.zscore(shard, tid) is not None
+
+    def get_tweets_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return steps.run(self.reads().get_tweets_page(cursor, count))
+
+    def get_user_tweets_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return steps.run(self.reads().get_user_tweets_page(uid, cursor, count))
+
+    def get_images_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return pagination.get_merged_page(
+            keys.all_shards(keys.IMAGES, self._client.shards),
+            cursor=cursor,
+            count=count,
+            client=self._client,
+        )
+
+    def get_mentions_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return pagination.get_page(
+            keys.mentions(uid), cursor=cursor, count=count, client=self._client
+        )
+
+    def get_tag_page(self, tag, cursor=None, count=pagination.PAGE_SIZE):
+        return tags.get_tag_page(tag, cursor, count=count, client=self._client)
+
+    def search(self, query, cursor=None, count=pagination.PAGE_SIZE):
+        return search.search(query, cursor, count=count, client=self._client)
+
+    def get_timeline_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return steps.run(self.reads().get_timeline_page(uid, cursor, count))
+
+    def get_feed_versions(self, uids, celebrities_of=None):
+        return steps.run(self.reads().get_feed_versions(uids, celebrities_of))
+
+    def get_trending(self):
+        return steps.run(self.reads().get_trending())
+
+    # the job "<tid>:<iid>" moves to uploads:processing until it is finished
+    def take_upload(self, timeout=0):
+        conn = self._client.conn
+        if timeout:
+            job = conn.brpoplpush(keys.UPLOADS, keys.UPLOADS_PROCESSING, timeout)
+        else:
+            job = conn.rpoplpush(keys.UPLOADS, keys.UPLOADS_PROCESSING)
+        if job is None:
+            return None
+        tid, iid = job.split(":", 1)
+        return job, tid, iid
+
+    def requeue_uploads(self):
+        while self._client.conn.rpoplpush(keys.UPLOADS_PROCESSING, keys.UPLOADS):
+            pass
+
+    def finish_upload(self, job, tid, iid, status, derivatives):
+        return bool(
+            self._client.run_script(
+                scripts.FINISH_UPLOAD,
+                keys=[keys.UPLOADS_PROCESSING],
+                args=[job, tid, iid, status, *_flatten(derivatives)],
+            )
+        )
+
+    def get_cached(self, keys):
+        return steps.run(self.reads().get_cached(keys))
+
+    def set_cached(self, values, ttl):
+        return steps.run(self.reads().set_cached(values, ttl))
+
+    def reset_db(self):
+        self._client.reset_db()
+
+    # index the words, tags and mentions of the posted, updated (previous_text
+    # is the text before the update) or deleted ("" text) tweet, and count its
+    # trending tags, in one round trip after the script wrote the tweet
+    def _index_tweet(self, tid, timestamp, text, previous_text=None):
+        client = self._client
+        pipe = client.conn.pipeline(transaction=False)
+        search.index_tweet(pipe, tid, timestamp, text, previous_text, client.shards)
+        tags.index_tweet(pipe, tid, timestamp, text, previous_text)
+        if timestamp is not None:
+            trending.count_tweet(pipe, timestamp, text, previous_text)
+        pipe.execute()
+
+
+# the reads of RedisStorage as steps (see steps.py), with its sync client or an
+# async one (see aio.py): each is one round trip (a pipeline or a script)
+class RedisReads(object):
+    def __init__(self, client):
+        self._client = client
+
+    # in one pipelined round trip
+    def get_users(self, uids):
+        uids = list(dict.fromkeys(str(uid) for uid in uids))
+        pipe = self._client.read_conn.pipeline(transaction=False)
+        for uid in uids:
+            pipe.hgetall(keys.user(uid))
+        results = yield steps.call(pipe.execute)
+        return dict(zip(uids, results))
+
+    def user_exists(self, uid):
+        if uid is None:
+            return False
+        shards = yield steps.call(self._client.get_shards)
+        shard = keys.shard(keys.UIDS, uid, shards)
+        return bool((yield steps.call(self._client.read_conn.sismember, shard, uid)))
+
+    def get_suggestions(self, uid):
+        return (yield suggestions.get_suggestions_steps(str(uid), self._client))
+
+    def resolve_session(self, sid):
+        return (yield sessions.resolve_steps(sid, self._client))
+
+    def sample_followers(self, uid, count=pagination.PAGE_SIZE):
+        conn = self._client.read_conn
+        return (yield steps.call(conn.srandmember, keys.followers(uid), count))
+
+    def sample_following(self, uid, count=pagination.PAGE_SIZE):
+        conn = self._client.read_conn
+        return (yield steps.call(conn.srandmember, keys.following(uid), count))
+
+    # in one round trip
+    def is_following_many(self, uid, uids):
+        uids = list(dict.fromkeys(str(other) for other in uids))
+        pipe = self._client.read_conn.pipeline(transaction=False)
+        for other in uids:
+            pipe.sismember(keys.following(uid), other)
+        results = yield steps.call(pipe.execute)
+        return {other for other, follows in zip(uids, results) if follows}
+
+    # from the counters maintained by the scripts (they are computed once for
+    # the users created before the counters, see users.repair_counts)
+    def get_counts(self, uid):
+        counts = yield steps.call(
+            self._client.read_conn.hmget,
+            keys.counts(uid),
+            "followers",
+            "following",
+            "tweets",
+        )
+        if None in counts:
+            counts = yield steps.call(
+                self._client.run_script,
+                scripts.REPAIR_COUNTS,
+                keys=[keys.counts(uid)],
+                args=[uid],
+            )
+        followers, following, num_of_tweets = (int(count) for count in counts)
+        return {
+            "num_of_followers": followers,
+            "num_of_following": following,
+            "num_of_tweets": num_of_tweets,
+        }
+
+    # in one pipelined round trip
+    def get_tweets(self, tids):
+        tids = [str(tid) for tid in tids]
+        buckets = yield steps.call(self._client.get_tweet_buckets)
+        pipe = self._client.read_conn.pipeline(transaction=False)
+        for tid in tids:
+            records.read(pipe, tid, buckets)
+        results = yield steps.call(pipe.execute)
+        return [
+            {**tweet, "tid": tid, "timestamp": float(tweet["timestamp"])}
+            for tid, result in zip(tids, results)
+            for tweet in [records.parse(result, buckets)]
+            if tweet
+        ]
+
+    def get_tweets_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        shards = yield steps.call(self._client.get_shards)
+        return (
+            yield pagination.get_merged_page_steps(
+                keys.all_shards(keys.TIDS, shards), cursor, count, self._client
+            )
+        )
+
+    def get_user_tweets_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return (
+            yield pagination.get_merged_page_steps(
+                [keys.user_tweets(uid)], cursor, count, self._client
+            )
+        )
+
+    def get_timeline_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return (yield timelines.get_timeline_steps(uid, cursor, count, self._client))
+
+    def get_feed_versions(self, uids, celebrities_of=None):
+        return (
+            yield timelines.get_feed_versions_steps(uids, celebrities_of, self._client)
+        )
+
+    def get_trending(self):
+        return (yield trending.get_trending_steps(self._client))
+
+    def get_cached(self, keys):
+        return (yield steps.call(self._client.mget, keys))
+
+    # in one pipelined round trip
+    def set_cached(self, values, ttl):
+        pipe = self._client.conn.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(key, value, ex=ttl)
+        yield steps.call(pipe.execute)
+
+
+# the reads of another storage as steps, each a blocking call of its method
+class BlockingReads(object):
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        return functools.partial(steps.blocking, getattr(self._store, name))
+
+
+class SQLiteStorage(Storage):
+    # the follow graph is indexed by follower (its primary key) and by followed
+    # user, the tweets by author and timestamp (the user's tweets and the
+    # timelines), by timestamp (all the tweets) and, for the ones with an image,
+    # by timestamp again; the postings are the search terms ("term:<term>"),
+    # tags ("tag:<tag>") and mentions ("mention:<uid>") of the tweets, indexed by
+    # key and timestamp (the pages) and by tweet (its updates); feeds are the
+    # versions of the feeds (see get_feed_versions), trending the counts of the
+    # tags per minute
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        uid INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT NOT NULL UNIQUE,
+        profile TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+        sid BLOB PRIMARY KEY,
+        email TEXT NOT NULL,
+        token TEXT
+    );
+    CREATE TABLE IF NOT EXISTS follows (
+        follower INTEGER NOT NULL,
+        followed INTEGER NOT NULL,
+        PRIMARY KEY (follower, followed)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS follows_by_followed ON follows (followed, follower);
+    CREATE TABLE IF NOT EXISTS tweets (
+        tid INTEGER PRIMARY KEY AUTOINCREMENT,
+        uid INTEGER NOT NULL,
+        timestamp REAL NOT NULL,
+        image INTEGER NOT NULL DEFAULT 0,
+        fields TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS tweets_by_author ON tweets (uid, timestamp, tid);
+    CREATE INDEX IF NOT EXISTS tweets_by_timestamp ON tweets (timestamp, tid);
+    CREATE INDEX IF NOT EXISTS tweets_with_image ON tweets (timestamp, tid)
+        WHERE image = 1;
+    CREATE TABLE IF NOT EXISTS postings (
+        key TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        tid INTEGER NOT NULL,
+        PRIMARY KEY (key, timestamp, tid)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS postings_by_tweet ON postings (tid);
+    CREATE TABLE IF NOT EXISTS feeds (
+        uid TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS trending (
+        minute INTEGER NOT NULL,
+        tag TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (minute, tag)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS uploads (
+        job INTEGER PRIMARY KEY AUTOINCREMENT,
+        tid INTEGER NOT NULL,
+        image TEXT NOT NULL,
+        taken INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS uploads_by_taken ON uploads (taken, job);
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path=":memory:"):
+        # one connection shared by the threads of the process, one statement
+        # (or write transaction) at a time
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+
+    def create_user(self, profile):
+        with self._transaction("create_user") as conn:
+            cursor = conn.execute(
+                "INSERT INTO users (email, profile) VALUES (?, '')", (profile["email"],)
+            )
+            uid = str(cursor.lastrowid)
+            conn.execute(
+                "UPDATE users SET profile = ? WHERE uid = ?",
+                (json.dumps(_profile(uid, profile)), uid),
+            )
+        return uid
+
+    def get_uid(self, email):
+        row = self._fetchone(
+            "get_uid", "SELECT uid FROM users WHERE email = ?", (email,)
+        )
+        return row and str(row[0])
+
+    def get_users(self, uids):
+        uids = list(dict.fromkeys(str(uid) for uid in uids))
+        profiles = {uid: {} for uid in uids}
+        rows = self._fetchall(
+            "get_users",
+            f"SELECT uid, profile FROM users WHERE uid IN ({_params(uids)})",
+            _ids(uids),
+        )
+        profiles.update({str(uid): json.loads(profile) for uid, profile in rows})
+        return profiles
+
+    def user_exists(self, uid):
+        row = self._fetchone(
+            "user_exists", "SELECT 1 FROM users WHERE uid = ?", (_id(uid),)
+        )
+        return row is not None
+
+    # the cursor is the last uid of the previous page
+    def get_users_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        try:
+            after = int(cursor or 0)
+        except ValueError:
+            raise pagination.InvalidCursor(f"Invalid cursor {cursor!r}")
+        rows = self._fetchall(
+            "get_users_page",
+            "SELECT uid FROM users WHERE uid > ? ORDER BY uid LIMIT ?",
+            (after, count + 1),
+        )
+        uids = [str(uid) for uid, in rows[:count]]
+        return uids, (uids[-1] if len(rows) > count else None)
+
+    # computed on read, as the SUGGEST script: the users followed by a random
+    # sample of the followed users (the first SUGGESTIONS_FANOUT follows of
+    # each), with the most mutual follows first, then random users
+    def get_suggestions(self, uid):
+        size = suggestions.SUGGESTIONS_SIZE
+        rows = self._fetchall(
+            "get_suggestions",
+            "SELECT theirs.followed FROM ("
+            " SELECT followed FROM follows WHERE follower = ?"
+            " ORDER BY random() LIMIT ?"
+            ") AS mine JOIN follows AS theirs"
+            " ON theirs.follower = mine.followed AND theirs.followed IN ("
+            " SELECT fanout.followed FROM follows AS fanout"
+            " WHERE fanout.follower = mine.followed LIMIT ?"
+            ") WHERE theirs.followed != ? AND NOT EXISTS ("
+            " SELECT 1 FROM follows AS followed"
+            " WHERE followed.follower = ? AND followed.followed = theirs.followed"
+            ") GROUP BY theirs.followed ORDER BY COUNT(*) DESC LIMIT ?",
+            (
+                _id(uid),
+                suggestions.SUGGESTIONS_SAMPLE,
+                suggestions.SUGGESTIONS_FANOUT,
+                _id(uid),
+                _id(uid),
+                max(size - suggestions.SUGGESTIONS_RANDOM, 0),
+            ),
+        )
+        suggested = [str(other) for other, in rows]
+        # the random users are drawn from the uids below the last one
+        (last,) = self._fetchone("get_suggestions", "SELECT MAX(uid) FROM users")
+        if len(suggested) >= size or not last:
+            return suggested
+        candidates = random.sample(range(1, last + 1), min(last, size * 2))
+        rows = self._fetchall(
+            "get_suggestions",
+            f"SELECT uid FROM users WHERE uid IN ({_params(candidates)})"
+            " AND uid != ? AND NOT EXISTS ("
+            " SELECT 1 FROM follows WHERE follower = ? AND followed = users.uid"
+            ")",
+            (*candidates, _id(uid), _id(uid)),
+        )
+        others = {str(other) for other, in rows} - set(suggested)
+        suggested += [str(other) for other in candidates if str(other) in others]
+        return suggested[:size]
+
+    def create_session(self, sid, email, token):
+        with self._transaction("create_session") as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, email, token) VALUES (?, ?, ?)",
+                (sid, email, token),
+            )
+
+    # cached as by sessions.resolve
+    def resolve_session(self, sid):
+        cache = sessions.get_session_cache()
+        session = cache.get(sid)
+        if session is not None:
+            return session
+        row = self._fetchone(
+            "resolve_session",
+            "SELECT users.uid, users.profile FROM sessions"
+            " JOIN users ON users.email = sessions.email WHERE sessions.sid = ?",
+            (sid,),
+        )
+        if row is None:
+            return None
+        session = {"uid": str(row[0]), "profile": json.loads(row[1])}
+        cache.set(sid, session)
+        return session
+
+    def delete_session(self, sid):
+        with self._transaction("delete_session") as conn:
+            row = conn.execute(
+                "SELECT token FROM sessions WHERE sid = ?", (sid,)
+            ).fetchone()
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+        sessions.get_session_cache().invalidate(sid)
+        return row and row[0]
+
+    # the feeds of both users change (their counts)
+    def follow(self, uid, other):
+        if str(uid) == str(other):
+            return False
+        with self._transaction("follow") as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO follows (follower, followed) VALUES (?, ?)",
+                (_id(uid), _id(other)),
+            )
+            _touch(conn, uid, other)
+        return True
+
+    def unfollow(self, uid, other):
+        if str(uid) == str(other):
+            return False
+        with self._transaction("unfollow") as conn:
+            conn.execute(
+                "DELETE FROM follows WHERE follower = ? AND followed = ?",
+                (_id(uid), _id(other)),
+            )
+            _touch(conn, uid, other)
+        return True
+
+    def get_followers(self, uid):
+        rows = self._fetchall(
+            "get_followers",
+            "SELECT follower FROM follows WHERE followed = ?",
+            (_id(uid),),
+        )
+        return [str(follower) for follower, in rows]
+
+    def get_following(self, uid):
+        rows = self._fetchall(
+            "get_following",
+            "SELECT followed FROM follows WHERE follower = ?",
+            (_id(uid),),
+        )
+        return [str(followed) for followed, in rows]
+
+    def sample_followers(self, uid, count=pagination.PAGE_SIZE):
+        rows = self._fetchall(
+            "sample_followers",
+            "SELECT follower FROM follows WHERE followed = ? ORDER BY random() LIMIT ?",
+            (_id(uid), count),
+        )
+        return [str(follower) for follower, in rows]
+
+    def sample_following(self, uid, count=pagination.PAGE_SIZE):
+        rows = self._fetchall(
+            "sample_following",
+            "SELECT followed FROM follows WHERE follower = ? ORDER BY random() LIMIT ?",
+            (_id(uid), count),
+        )
+        return [str(followed) for followed, in rows]
+
+    def is_following_many(self, uid, uids):
+        uids = list(dict.fromkeys(str(other) for other in uids))
+        rows = self._fetchall(
+            "is_following_many",
+            "SELECT followed FROM follows"
+            f" WHERE follower = ? AND followed IN ({_params(uids)})",
+            (_id(uid), *_ids(uids)),
+        )
+        return {str(followed) for followed, in rows}
+
+    # counted on the indexes of the follows and of the tweets
+    def get_counts(self, uid):
+        followers, following, num_of_tweets = self._fetchone(
+            "get_counts",
+            "SELECT (SELECT COUNT(*) FROM follows WHERE followed = ?),"
+            " (SELECT COUNT(*) FROM follows WHERE follower = ?),"
+            " (SELECT COUNT(*) FROM tweets WHERE uid = ?)",
+            (_id(uid),) * 3,
+        )
+        return {
+            "num_of_followers": followers,
+            "num_of_following": following,
+            "num_of_tweets": num_of_tweets,
+        }
+
+    def next_image_id(self):
+        ((iid,),) = self._fetchall(
+            "next_image_id",
+            "INSERT INTO counters (name, value) VALUES ('iid', 1)"
+            " ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value",
+        )
+        return iid
+
+    # the tweet, its postings, its trending tags and its upload job at once
+    def post_tweet(self, uid, fields, timestamp=None):
+        timestamp = float(time.time() if timestamp is None else timestamp)
+        tweet = {**_strings(fields), "version": "1"}
+        image = tweet.get("image")
+        with self._transaction("post_tweet") as conn:
+            tid = conn.execute(
+                "INSERT INTO tweets (uid, timestamp, image, fields) VALUES (?, ?, ?, ?)",
+                (_id(uid), timestamp, int(bool(image)), json.dumps(tweet)),
+            ).lastrowid
+            if image:
+                conn.execute(
+                    "INSERT INTO uploads (tid, image) VALUES (?, ?)", (tid, image)
+                )
+            _index_tweet(conn, tid, timestamp, tweet.get("tweet_text"))
+            _count_tags(conn, timestamp, tweet.get("tweet_text"))
+            _touch(conn, uid, "*")
+        return str(tid)
+
+    # as the UPDATE_TWEET script
+    def update_tweet(self, uid, tid, fields, image="", timestamp=None):
+        timestamp = float(time.time() if timestamp is None else timestamp)
+        with self._transaction("update_tweet") as conn:
+            row = conn.execute(
+                "SELECT fields FROM tweets WHERE tid = ? AND uid = ?",
+                (_id(tid), _id(uid)),
+            ).fetchone()
+            if row is None:
+                return None
+            tweet = json.loads(row[0])
+            previous_text = tweet.get("tweet_text", "")
+            previous_images = _images(tweet)
+            for field in ("image_status", *records.IMAGE_FIELDS):
+                tweet.pop(field, None)
+            tweet.update(_strings(fields))
+            if image:
+                tweet["image"] = image
+                conn.execute(
+                    "INSERT INTO uploads (tid, image) VALUES (?, ?)", (_id(tid), image)
+                )
+            tweet["version"] = str(int(tweet.get("version", 0)) + 1)
+            conn.execute(
+                "UPDATE tweets SET timestamp = ?, image = ?, fields = ? WHERE tid = ?",
+                (timestamp, int(bool(image)), json.dumps(tweet), _id(tid)),
+            )
+            _index_tweet(conn, _id(tid), timestamp, tweet.get("tweet_text"))
+            _count_tags(conn, timestamp, tweet.get("tweet_text"), previous_text)
+            _touch(conn, uid, "*")
+        return previous_images
+
+    def delete_tweet(self, uid, tid):
+        with self._transaction("delete_tweet") as conn:
+            rows = conn.execute(
+                "DELETE FROM tweets WHERE tid = ? AND uid = ? RETURNING fields",
+                (_id(tid), _id(uid)),
+            ).fetchall()
+            if not rows:
+                return None
+            conn.execute("DELETE FROM postings WHERE tid = ?", (_id(tid),))
+            _touch(conn, uid, "*")
+        return _images(json.loads(rows[0][0]))
+
+    def get_tweets(self, tids):
+        tids = [str(tid) for tid in tids]
+        rows = self._fetchall(
+            "get_tweets",
+            "SELECT tid, uid, timestamp, fields FROM tweets"
+            f" WHERE tid IN ({_params(tids)})",
+            _ids(tids),
+        )
+        found = {
+            str(tid): {
+                **json.loads(fields),
+                "tid": str(tid),
+                "uid": str(uid),
+                "timestamp": timestamp,
+            }
+            for tid, uid, timestamp, fields in rows
+        }
+        return [dict(found[tid]) for tid in tids if tid in found]
+
+    def tweet_exists(self, tid):
+        row = self._fetchone(
+            "tweet_exists", "SELECT 1 FROM tweets WHERE tid = ?", (_id(tid),)
+        )
+        return row is not None
+
+    def get_tweets_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return self._page("get_tweets_page", "", (), cursor, count)
+
+    def get_user_tweets_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return self._page("get_user_tweets_page", "uid = ?", (_id(uid),), cursor, count)
+
+    # from the partial index of the tweets with an image
+    def get_images_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return self._page("get_images_page", "image = 1", (), cursor, count)
+
+    def get_mentions_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        return self._postings_page(
+            "get_mentions_page", [f"mention:{uid}"], cursor, count
+        )
+
+    def get_tag_page(self, tag, cursor=None, count=pagination.PAGE_SIZE):
+        return self._postings_page(
+            "get_tag_page", [f"tag:{tag.lower()}"], cursor, count
+        )
+
+    def search(self, query, cursor=None, count=pagination.PAGE_SIZE):
+        terms = [f"term:{term}" for term in search.get_query_terms(query)]
+        if not terms:
+            return [], None
+        return self._postings_page("search", terms, cursor, count)
+
+    # merged on read in one query: the latest count + 1 tweets of each author
+    # (the user and the followed users) after the cursor are read newest first
+    # from tweets_by_author, then only those are sorted, so that a page reads
+    # at most (following + 1) * (count + 1) tweets whatever the number of tweets
+    # of the authors
+    def get_timeline_page(self, uid, cursor=None, count=pagination.PAGE_SIZE):
+        cursor = _decode_cursor(cursor)
+        after, params = "", (_id(uid), _id(uid))
+        if cursor is not None:
+            after, params = "AND (latest.timestamp, latest.tid) < (?, ?)", (
+                *params,
+                *cursor,
+            )
+        rows = self._fetchall(
+            "get_timeline_page",
+            "SELECT tweets.tid, tweets.timestamp FROM ("
+            " SELECT followed AS uid FROM follows WHERE follower = ? UNION ALL SELECT ?"
+            ") AS authors JOIN tweets ON tweets.tid IN ("
+            " SELECT latest.tid FROM tweets AS latest"
+            f" WHERE latest.uid = authors.uid {after}"
+            " ORDER BY latest.timestamp DESC, latest.tid DESC LIMIT ?"
+            ") ORDER BY tweets.timestamp DESC, tweets.tid DESC LIMIT ?",
+            (*params, count + 1, count + 1),
+        )
+        tids, next_cursor = pagination.merge_pages([rows], count)
+        return [str(tid) for tid in tids], next_cursor
+
+    # the timelines are merged on read, so every followed user is a "celebrity"
+    # of the user: a tweet only bumps the feeds of its author and of all the
+    # tweets ("*"), a follow the feeds of both users
+    def get_feed_versions(self, uids, celebrities_of=None):
+        uids = [str(uid) for uid in uids]
+        if celebrities_of is not None:
+            uids += self.get_following(celebrities_of)
+        rows = self._fetchall(
+            "get_feed_versions",
+            f"SELECT uid, version FROM feeds WHERE uid IN ({_params(uids)})",
+            uids,
+        )
+        versions = dict(rows)
+        return [f"{uid}={versions.get(uid, 0)}" for uid in uids]
+
+    # computed on read from the counts of the minutes of the window, each
+    # weighted by its decay (as the REFRESH_TRENDING script)
+    def get_trending(self):
+        minute = int(time.time() // 60)
+        rows = self._fetchall(
+            "get_trending",
+            "SELECT minute, tag, count FROM trending WHERE minute > ?",
+            (minute - trending.TRENDING_WINDOW,),
+        )
+        scores = {}
+        for counted, tag, count in rows:
+            decay = trending.TRENDING_DECAY ** max(minute - counted, 0)
+            scores[tag] = scores.get(tag, 0) + count * decay
+        ranked = sorted(scores.items(), key=lambda x: (x[1], x[0]), reverse=True)
+        return ranked[: trending.TRENDING_SIZE]
+
+    # the queue is polled every STORAGE_SQLITE_POLL seconds while waiting
+    def take_upload(self, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            rows = self._fetchall(
+                "take_upload",
+                "UPDATE uploads SET taken = 1 WHERE job = ("
+                " SELECT job FROM uploads WHERE taken = 0 ORDER BY job LIMIT 1"
+                ") RETURNING job, tid, image",
+            )
+            for job, tid, iid in rows:
+                return str(job), str(tid), iid
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(STORAGE_SQLITE_POLL, remaining))
+
+    def requeue_uploads(self):
+        with self._transaction("requeue_uploads") as conn:
+            conn.execute("UPDATE uploads SET taken = 0 WHERE taken = 1")
+
+    # as the FINISH_UPLOAD script
+    def finish_upload(self, job, tid, iid, status, derivatives):
+        with self._transaction("finish_upload") as conn:
+            conn.execute("DELETE FROM uploads WHERE job = ?", (_id(job),))
+            row = conn.execute(
+                "SELECT uid, fields FROM tweets WHERE tid = ?", (_id(tid),)
+            ).fetchone()
+            tweet = row and json.loads(row[1])
+            if not tweet or tweet.get("image") != iid:
+                return False
+            tweet.pop("image_status", None)
+            if status != "ready":
+                tweet["image_status"] = status
+            tweet.update(_strings(derivatives))
+            tweet["version"] = str(int(tweet.get("version", 0)) + 1)
+            conn.execute(
+                "UPDATE tweets SET fields = ? WHERE tid = ?",
+                (json.dumps(tweet), _id(tid)),
+            )
+            _touch(conn, row[0], "*")
+        return True
+
+    # no cache shared by the workers, each of them only keeps its own
+    def get_cached(self, keys):
+        return [None] * len(keys)
+
+    def set_cached(self, values, ttl):
+        pass
+
+    def reset_db(self):
+        with self._transaction("reset_db") as conn:
+            tables = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall()
+            for (table,) in tables:
+                conn.execute(f"DELETE FROM {table}")
+
+    def close(self):
+        self._conn.close()
+
+    # the connection, in one transaction (recorded as one call to the sqlite
+    # backend, see metrics.py)
+    @contextlib.contextmanager
+    def _transaction(self, operation):
+        start = time.perf_counter()
+        try:
+            with self._lock, self._conn:
+                yield self._conn
+        finally:
+            metrics.record("sqlite", operation, time.perf_counter() - start)
+
+    def _fetchone(self, operation, sql, params=()):
+        with self._transaction(operation) as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, operation, sql, params=()):
+        with self._transaction(operation) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    # a page of the tids of the tweets matching the condition after the cursor,
+    # in the order of pagination.py (the tids are numbers here, not strings)
+    def _page(self, operation, condition, params, cursor, count):
+        cursor = _decode_cursor(cursor)
+        conditions = [condition] if condition else []
+        if cursor is not None:
+            conditions.append("(timestamp, tid) < (?, ?)")
+            params = (*params, *cursor)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # one more tweet to know whether there is a next page
+        rows = self._fetchall(
+            operation,
+            f"SELECT tid, timestamp FROM tweets {where}"
+            " ORDER BY timestamp DESC, tid DESC LIMIT ?",
+            (*params, count + 1),
+        )
+        tids, next_cursor = pagination.merge_pages([rows], count)
+        return [str(tid) for tid in tids], next_cursor
+
+    # a page of the tids of the tweets with all the postings: the first one is
+    # read newest first, each of its tweets is looked up in the others
+    def _postings_page(self, operation, postings, cursor, count):
+        cursor = _decode_cursor(cursor)
+        first, *others = postings
+        conditions, params = ["key = ?"], [first]
+        for other in others:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM postings AS other WHERE other.key = ?"
+                " AND other.timestamp = postings.timestamp"
+                " AND other.tid = postings.tid)"
+            )
+            params.append(other)
+        if cursor is not None:
+            conditions.append("(timestamp, tid) < (?, ?)")
+            params += cursor
+        rows = self._fetchall(
+            operation,
+            f"SELECT tid, timestamp FROM postings WHERE {' AND '.join(conditions)}"
+            " ORDER BY timestamp DESC, tid DESC LIMIT ?",
+            (*params, count + 1),
+        )
+        tids, next_cursor = pagination.merge_pages([rows], count)
+        return [str(tid) for tid in tids], next_cursor
+
+
+#
+# Internal helper function
+#
+
+
+# the profile as stored (and read back) by redis, string values with the uid
+def _profile(uid, profile):
+    return _strings({**profile, "uid": uid})
+
+
+def _strings(mapping):
+    return {field: str(value) for field, value in mapping.items() if value is not None}
+
+
+# {field: value} --> [field, value, ...] (script arguments)
+def _flatten(mapping):
+    return [item for field_value in mapping.items() for item in field_value]
+
+
+# the s3 keys of the tweet's image and derivatives
+def _images(tweet):
+    return [tweet[field] for field in records.IMAGE_FIELDS if tweet.get(field)]
+
+
+# the numeric id, -1 (no row) for an id that is not a number
+def _id(id):
+    try:
+        return int(id)
+    except (TypeError, ValueError):
+        return -1
+
+
+def _ids(ids):
+    return [_id(id) for id in ids]
+
+
+def _params(ids):
+    return ", ".join("?" * len(ids))
+
+
+# the cursor as (timestamp, numeric tid), see pagination.decode_cursor
+def _decode_cursor(cursor):
+    decoded = pagination.decode_cursor(cursor)
+    if decoded is None:
+        return None
+    timestamp, tid = decoded
+    try:
+        return timestamp, int(tid)
+    except ValueError:
+        raise pagination.InvalidCursor(f"Invalid cursor {cursor!r}")
+
+
+# bump the versions of the feeds of the uids ("*" for all the tweets)
+def _touch(conn, *uids):
+    conn.executemany(
+        "INSERT INTO feeds (uid, version) VALUES (?, 1)"
+        " ON CONFLICT (uid) DO UPDATE SET version = version + 1",
+        [(str(uid),) for uid in uids],
+    )
+
+
+# replace the postings of the tweet by the terms, tags and mentions of its text
+def _index_tweet(conn, tid, timestamp, text):
+    conn.execute("DELETE FROM postings WHERE tid = ?", (tid,))
+    postings = [f"term:{term}" for term in search.get_terms(text)]
+    postings += [f"tag:{tag}" for tag in tags.get_tags(text)]
+    postings += [f"mention:{uid}" for uid in tags.get_mentions(text)]
+    conn.executemany(
+        "INSERT OR IGNORE INTO postings (key, timestamp, tid) VALUES (?, ?, ?)",
+        [(key, timestamp, tid) for key in postings],
+    )
+
+
+# count the tags of the posted or updated tweet (see trending.count_tweet) in
+# its minute, the minutes out of the window are forgotten
+def _count_tags(conn, timestamp, text, previous_text=None):
+    minute = int(timestamp // 60)
+    conn.executemany(
+        "INSERT INTO trending (minute, tag, count) VALUES (?, ?, 1)"
+        " ON CONFLICT (minute, tag) DO UPDATE SET count = count + 1",
+        [(minute, tag) for tag in trending.get_counted_tags(text, previous_text)],
+    )
+    conn.execute(
+        "DELETE FROM trending WHERE minute <= ?",
+        (int(time.time() // 60) - trending.TRENDING_WINDOW,),
+    )
+
+
+#
+# Process-wide registry
+#
+
+# the storage of the app, created once per process (a forked worker opens its
+# own connections)
+_lock = threading.Lock()
+_storage = None
+_pid = None
+
+
+# the storage of the app (see STORAGE_BACKEND), or the redis storage of the
+# given client (e.g. another database)
+def get_storage(client=None):
+    global _storage, _pid
+    if client is not None:
+        return RedisStorage(client)
+    with _lock:
+        if _storage is None or _pid != os.getpid():
+            if STORAGE_BACKEND == "sqlite":
+                _storage = SQLiteStorage(STORAGE_SQLITE_PATH)
+            elif STORAGE_BACKEND == "redis":
+                _storage = RedisStorage()
+            else:
+                raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+            _pid = os.getpid()
+        return _storage
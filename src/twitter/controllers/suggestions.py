@@ -0,0 +1,106 @@
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import steps
+from twitter.controllers import scripts
+
+# number of suggested users, and how many of them are random users
+SUGGESTIONS_SIZE = int(os.environ.get("SUGGESTIONS_SIZE", 10))
+SUGGESTIONS_RANDOM = int(os.environ.get("SUGGESTIONS_RANDOM", 3))
+# the suggestions are computed from (at most) SUGGESTIONS_SAMPLE followed users
+# and SUGGESTIONS_FANOUT of the users each of them follows
+SUGGESTIONS_SAMPLE = int(os.environ.get("SUGGESTIONS_SAMPLE", 50))
+SUGGESTIONS_FANOUT = int(os.environ.get("SUGGESTIONS_FANOUT", 50))
+# seconds the suggestions are fresh, they are served for as long again while
+# they are refreshed in the background
+SUGGESTIONS_TTL = int(os.environ.get("SUGGESTIONS_TTL", 300))
+
+#
+# suggestions.py: "who to follow", a bounded list whatever the number of users
+#
+# suggestions:{uid} --> sorted set of the suggested uids scored by the number of
+#   followed users following them (0 for the random ones), it expires after
+#   twice SUGGESTIONS_TTL; a followed user is removed from it by the follow script
+# suggestions:fresh:{uid} --> set when the suggestions are computed, with the
+#   same expiry, so that a user without suggestions (an empty sorted set does
+#   not exist) is not recomputed on every page
+#
+
+
+# the suggested uids, from the most to the least relevant
+def get_suggestions(uid, client=None):
+    client = client or redis.get_redis_client()
+    return steps.run(get_suggestions_steps(uid, client))
+
+
+# the steps of get_suggestions, with the sync or the async client (see
+# steps.py), the suggestions are computed by the sync client
+def get_suggestions_steps(uid, client):
+    pipe = client.read_conn.pipeline(transaction=False)
+    pipe.zrevrange(keys.suggestions(uid), 0, -1)
+    pipe.ttl(keys.suggestions_fresh(uid))
+    uids, ttl = yield steps.call(pipe.execute)
+    # never computed (or expired)
+    if ttl < 0:
+        return (yield steps.blocking(refresh, uid, client=client.sync_client))
+    if ttl < SUGGESTIONS_TTL:
+        refresh_in_background(uid, client=client.sync_client)
+    return uids
+
+
+# compute the suggestions of the user, returns them
+def refresh(uid, client=None):
+    client = client or redis.get_redis_client()
+    # the random users are drawn from one of the shards of the uids
+    return client.run_script(
+        scripts.SUGGEST,
+        keys=[random.choice(keys.all_shards(keys.UIDS, client.shards))],
+        args=[
+            uid,
+            SUGGESTIONS_SIZE,
+            SUGGESTIONS_RANDOM,
+            SUGGESTIONS_SAMPLE,
+            SUGGESTIONS_FANOUT,
+            SUGGESTIONS_TTL * 2,
+        ],
+    )
+
+
+# refresh the suggestions of the user in the refresh thread of the process (a
+# user is only queued once at a time)
+def refresh_in_background(uid, client=None):
+    global _executor, _pid
+    client = client or redis.get_redis_client()
+    with _lock:
+        if _executor is None or _pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1)
+            _pid = os.getpid()
+            _pending.clear()
+        if uid in _pending:
+            return
+        _pending.add(uid)
+        _executor.submit(_refresh, uid, client)
+
+
+# one refresh thread per process
+_lock = threading.Lock()
+_executor = None
+_pid = None
+_pending = set()
+
+
+#
+# Internal helper function
+#
+
+
+def _refresh(uid, client):
+    try:
+        refresh(uid, client=client)
+    finally:
+        with _lock:
+            _pending.discard(uid)
@@ -0,0 +1,57 @@
+import re
+
+from twitter.controllers import keys
+from twitter.controllers import pagination
+
+#
+# tags.py: the #tags and @mentions of the tweets, parsed when they are written
+# (see LoggedInUser.post_tweet)
+#
+# tag:{<tag>} --> sorted set of the tids of the tweets with the #tag (lowercase),
+#   scored by the tweet timestamp
+# mentions:{<uid>} --> sorted set of the tids of the tweets mentioning the user
+#   (@<uid>, the users are known by their uid as in /users/<uid>/profile)
+#
+# an update diffs the previous text against the new one, a delete removes the
+# tweet from every index of its text
+#
+
+# a #tag or an @mention, not inside a word (e.g. an email address)
+TOKENS = re.compile(r"(?<![\w#@&])([#@])(\w+)")
+
+
+# the tags of the text (lowercase), in order
+def get_tags(text):
+    tokens = TOKENS.findall(text or "")
+    return list(dict.fromkeys(word.lower() for sign, word in tokens if sign == "#"))
+
+
+# the uids mentioned by the text, in order
+def get_mentions(text):
+    tokens = TOKENS.findall(text or "")
+    return list(
+        dict.fromkeys(word for sign, word in tokens if sign == "@" and word.isdigit())
+    )
+
+
+# queue the index of the posted or updated tweet (previous_text is the text
+# before the update, the deleted tweet has an empty text) on the pipeline (or
+# write it)
+def index_tweet(conn, tid, timestamp, text, previous_text=None):
+    tags, mentions = get_tags(text), get_mentions(text)
+    for tag in set(get_tags(previous_text)) - set(tags):
+        conn.zrem(keys.tag(tag), tid)
+    for uid in set(get_mentions(previous_text)) - set(mentions):
+        conn.zrem(keys.mentions(uid), tid)
+    for tag in tags:
+        conn.zadd(keys.tag(tag), {tid: timestamp})
+    for uid in mentions:
+        conn.zadd(keys.mentions(uid), {tid: timestamp})
+
+
+# a page of the tids of the tweets with the tag after the cursor, newest first,
+# and the cursor of the next page
+def get_tag_page(tag, cursor=None, count=pagination.PAGE_SIZE, client=None):
+    return pagination.get_page(
+        keys.tag(tag.lower()), cursor=cursor, count=count, client=client
+    )
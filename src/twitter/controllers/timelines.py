@@ -0,0 +1,111 @@
+import os
+
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import steps
+from twitter.controllers import scripts
+from twitter.controllers import pagination
+
+# maximum number of tids kept in each timeline:<uid>, older ones are trimmed
+TIMELINE_MAX_LENGTH = int(os.environ.get("TIMELINE_MAX_LENGTH", 800))
+# authors with more followers than this are not fanned out on write, their tweets
+# are merged into the followers' timelines when the timelines are read instead
+FANOUT_MAX_FOLLOWERS = int(os.environ.get("FANOUT_MAX_FOLLOWERS", 5000))
+
+#
+# timelines.py: personal timelines (yourself and following users' tweets), they
+# are written to by the scripts of the write operations (see scripts.py)
+#
+# timeline:{uid} --> sorted set of tids scored by the tweet timestamp
+# timeline:built:{uid} --> set once the timeline has been built, the other
+#   timelines are not written to and are built from scratch on their first read
+# celebrities --> uids of the authors whose tweets are fanned out on read, and
+#   following:celebrities:{uid} the ones followed by the user
+# feed:{*} / feed:{uid} --> versions of the pages showing the tweets (all the
+#   tweets, or the user's), bumped by the scripts so that a page can be
+#   revalidated in one call
+#
+
+
+# build the timeline from scratch (e.g. for the users signed up before timelines)
+def rebuild(uid, client=None):
+    client = client or redis.get_redis_client()
+    authors = client.conn.sdiff(keys.following(uid), keys.following_celebrities(uid))
+    authors.add(str(uid))
+    tweets = _get_tweets_timestamps(authors, client)
+    pipe = client.conn.pipeline(transaction=False)
+    pipe.delete(keys.timeline(uid))
+    if tweets:
+        _push(pipe, uid, tweets)
+    pipe.set(keys.timeline_built(uid), 1)
+    pipe.execute()
+
+
+# a page of the user's timeline (from the newest to the oldest tid) after the
+# cursor, and the cursor of the next page
+def get_timeline(uid, cursor=None, count=pagination.PAGE_SIZE, client=None):
+    client = client or redis.get_redis_client()
+    return steps.run(get_timeline_steps(uid, cursor, count, client))
+
+
+# the steps of get_timeline, with the sync or the async client (see steps.py),
+# a timeline never read is built by the sync client
+def get_timeline_steps(uid, cursor, count, client):
+    pipe = client.read_conn.pipeline(transaction=False)
+    pipe.exists(keys.timeline_built(uid))
+    pipe.smembers(keys.following_celebrities(uid))
+    built, celebrities = yield steps.call(pipe.execute)
+    if not built:
+        yield steps.blocking(rebuild, uid, client=client.sync_client)
+    # fan out on read for the celebrities (a timeline just built may not be on
+    # the replicas yet)
+    timelines = [keys.timeline(uid)]
+    timelines += [keys.user_tweets(celebrity) for celebrity in celebrities]
+    return (
+        yield pagination.get_merged_page_steps(
+            timelines, cursor, count, client, primary=not built
+        )
+    )
+
+
+# the versions of the feeds of the given uids ("*" for all the tweets) and, if
+# celebrities_of is given, of the celebrities followed by that user, a page
+# showing them is unchanged as long as they are
+def get_feed_versions(uids, celebrities_of=None, client=None):
+    client = client or redis.get_redis_client()
+    return steps.run(get_feed_versions_steps(uids, celebrities_of, client))
+
+
+# the steps of get_feed_versions, with the sync or the async client
+def get_feed_versions_steps(uids, celebrities_of, client):
+    return (
+        yield steps.call(
+            client.run_script,
+            scripts.FEED_VERSIONS,
+            args=[celebrities_of or ""] + [str(uid) for uid in uids],
+            read_only=True,
+        )
+    )
+
+
+#
+# Internal helper function
+#
+
+
+def _push(pipe, uid, tweets):
+    pipe.zadd(keys.timeline(uid), tweets)
+    # only keep the latest TIMELINE_MAX_LENGTH tweets
+    pipe.zremrangebyrank(keys.timeline(uid), 0, -TIMELINE_MAX_LENGTH - 1)
+
+
+# tid --> timestamp of the latest tweets of the given users
+def _get_tweets_timestamps(uids, client):
+    pipe = client.conn.pipeline(transaction=False)
+    for uid in uids:
+        pipe.zrevrange(
+            keys.user_tweets(uid), 0, TIMELINE_MAX_LENGTH - 1, withscores=True
+        )
+    tweets = dict(tweet for user_tweets in pipe.execute() for tweet in user_tweets)
+    latest = sorted(tweets, key=tweets.get, reverse=True)[:TIMELINE_MAX_LENGTH]
+    return {tid: tweets[tid] for tid in latest}
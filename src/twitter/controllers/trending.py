@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import steps
+from twitter.controllers import scripts
+from twitter.controllers import tags
+from twitter.controllers import search
+
+# number of trending tags shown
+TRENDING_SIZE = int(os.environ.get("TRENDING_SIZE", 10))
+# minutes of tweets counted, the weight of a minute is multiplied by
+# TRENDING_DECAY for each minute of its age
+TRENDING_WINDOW = int(os.environ.get("TRENDING_WINDOW", 60))
+TRENDING_DECAY = float(os.environ.get("TRENDING_DECAY", 0.95))
+# seconds the trending tags are fresh, they are refreshed in the background by
+# the next page showing them
+TRENDING_REFRESH = int(os.environ.get("TRENDING_REFRESH", 30))
+# 1 to count the words of the tweets as well as their #tags
+TRENDING_TERMS = os.environ.get("TRENDING_TERMS", "0") == "1"
+
+#
+# trending.py: the trending #tags (and words), over a sliding window of the
+# last TRENDING_WINDOW minutes
+#
+# {trending}:<minute> --> sorted set of the tags ("#tag", or the word) of the
+#   tweets posted or updated in the minute (timestamp // 60), scored by their
+#   count; it expires at the end of the window, so the counters are bounded by
+#   the tags of the last TRENDING_WINDOW minutes
+# {trending}:top --> the union of the buckets of the window, each weighted by
+#   its decay, trimmed to the TRENDING_SIZE top tags
+# {trending}:refreshed --> set while {trending}:top is fresh
+#
+# the pages read {trending}:top (a bounded list, whatever the number of tweets)
+# and the first one finding it stale refreshes it in the refresh thread of its
+# process; the keys are in one hash slot so that the union runs on the server
+# even on a redis cluster
+#
+
+
+# queue the counts of the tags of the posted or updated tweet (those it did not
+# have before the update) on the pipeline (or count them)
+def count_tweet(conn, timestamp, text, previous_text=None):
+    bucket = keys.trending_bucket(int(float(timestamp) // 60))
+    tags_of_tweet = get_counted_tags(text, previous_text)
+    for tag in tags_of_tweet:
+        conn.zincrby(bucket, 1, tag)
+    if tags_of_tweet:
+        conn.expire(bucket, (TRENDING_WINDOW + 1) * 60)
+
+
+# the tags of the posted or updated tweet that are counted, those it did not have
+# before the update ("#tag", and the words with TRENDING_TERMS)
+def get_counted_tags(text, previous_text=None):
+    counted = set(_get_tags(previous_text))
+    return [tag for tag in _get_tags(text) if tag not in counted]
+
+
+# the trending tags, [(tag, score)] from the most to the least trending
+def get_trending(client=None):
+    client = client or redis.get_redis_client()
+    return steps.run(get_trending_steps(client))
+
+
+# the steps of get_trending, with the sync or the async client (see steps.py),
+# the trending tags are refreshed by the sync client
+def get_trending_steps(client):
+    pipe = client.read_conn.pipeline(transaction=False)
+    pipe.zrevrange(keys.TRENDING, 0, TRENDING_SIZE - 1, withscores=True)
+    pipe.exists(keys.TRENDING_REFRESHED)
+    trending, fresh = yield steps.call(pipe.execute)
+    if not fresh:
+        refresh_in_background(client=client.sync_client)
+    return trending
+
+
+# recompute the trending tags at the time (now by default), returns their number
+def refresh(client=None, now=None):
+    client = client or redis.get_redis_client()
+    minute = int((time.time() if now is None else now) // 60)
+    ages = range(TRENDING_WINDOW)
+    return client.run_script(
+        scripts.REFRESH_TRENDING,
+        keys=[keys.TRENDING, keys.TRENDING_REFRESHED]
+        + [keys.trending_bucket(minute - age) for age in ages],
+        args=[TRENDING_SIZE, TRENDING_WINDOW * 60, TRENDING_REFRESH]
+        + [TRENDING_DECAY**age for age in ages],
+    )
+
+
+# refresh the trending tags in the refresh thread of the process (once at a time)
+def refresh_in_background(client=None):
+    global _executor, _pid, _pending
+    client = client or redis.get_redis_client()
+    with _lock:
+        if _executor is None or _pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1)
+            _pid = os.getpid()
+            _pending = False
+        if _pending:
+            return
+        _pending = True
+        _executor.submit(_refresh, client)
+
+
+# one refresh thread per process
+_lock = threading.Lock()
+_executor = None
+_pid = None
+_pending = False
+
+
+#
+# Internal helper function
+#
+
+
+# the counted tags of the text, "#tag" (and the words with TRENDING_TERMS)
+def _get_tags(text):
+    counted = [f"#{tag}" for tag in tags.get_tags(text)]
+    if TRENDING_TERMS:
+        counted += search.get_terms(text)
+    return counted
+
+
+def _refresh(client):
+    global _pending
+    try:
+        refresh(client=client)
+    finally:
+        with _lock:
+            _pending = False
@@ -3,17 +3,24 @@ import imghdr
 from werkzeug.utils import secure_filename
 
 from twitter.controllers import s3
+from twitter.controllers import keys
 from twitter.controllers import redis
+from twitter.controllers import records
+from twitter.controllers import pagination
+from twitter.controllers import scripts
+from twitter.controllers import steps
+from twitter.controllers import storage
 
 # allow file extension
 ALLOWED_UPLOAD_EXTENSIONS = (".jpg", ".png", ".gif", ".jpeg")
 
 
 class Tweet(object):
-    def __init__(self, tid, s3_client=None, redis_client=None):
-        self._tid = tid
-        self._s3_client = s3_client or s3.S3Client()
-        self._redis_client = redis_client or redis.RedisClient()
+    def __init__(self, tid, s3_client=None, redis_client=None, store=None):
+        self._tid = str(tid)
+        self._s3_client = s3_client or s3.get_s3_client()
+        # the redis storage of the client, or the storage of the app
+        self._store = store or storage.get_storage(redis_client)
 
     # uid of the user that post the tweet
     @property
@@ -25,25 +32,22 @@ class Tweet(object):
     def tid(self):
         return self._tid
 
-    # the content of the tweet
+    # the content of the tweet ({} if it no longer exists)
     @property
     def tweet(self):
-        tweet = self._redis_client.conn.hgetall(f"tweets:{self.tid}")
-        tweet.update(
-            {
-                "timestamp": float(tweet["timestamp"]),
-                "tid": self.tid,
-            }
-        )
-        # if the tweet contains image, then also grab that as presigned_url
-        if "image" in tweet:
-            tweet.update(
-                {"image": self._s3_client.create_presigned_url(tweet["image"])}
-            )
-        return tweet
+        tweets = self._store.get_tweets([self.tid])
+        return augment_tweets(tweets, self._s3_client)[0] if tweets else {}
+
+    # the content of several tweets, fetched in one pipelined round trip
+    # (tweets that no longer exist are skipped)
+    @classmethod
+    def load_many(cls, tids, s3_client=None, redis_client=None, store=None):
+        s3_client = s3_client or s3.get_s3_client()
+        store = store or storage.get_storage(redis_client)
+        return augment_tweets(store.get_tweets(tids), s3_client)
 
     def is_exist(self):
-        return self._redis_client.conn.sismember("tids", self.tid)
+        return self._store.tweet_exists(self.tid)
 
 
 #
@@ -51,9 +55,63 @@ class Tweet(object):
 #
 
 
+# from the newest to the oldest
 def get_all_tweets_ids():
-    client = redis.RedisClient()
-    return list(client.conn.smembers("tids"))
+    client = redis.get_redis_client()
+    pipe = client.read_conn.pipeline(transaction=False)
+    for shard in keys.all_shards(keys.TIDS, client.shards):
+        pipe.zrevrange(shard, 0, -1, withscores=True)
+    tweets = [tweet for shard_tweets in pipe.execute() for tweet in shard_tweets]
+    tweets.sort(key=lambda x: (x[1], x[0]), reverse=True)
+    return [tid for tid, _ in tweets]
+
+
+# a page of all the tids after the cursor, and the cursor of the next page
+def get_tweets_ids_page(cursor=None, count=pagination.PAGE_SIZE, client=None):
+    return storage.get_storage(client).get_tweets_page(cursor, count=count)
+
+
+# a page of the tids of the tweets with an image after the cursor, and the
+# cursor of the next page
+def get_images_ids_page(cursor=None, count=pagination.PAGE_SIZE, client=None):
+    return storage.get_storage(client).get_images_page(cursor, count=count)
+
+
+# add the tweets posted before the images index to it, returns the number of
+# tweets added
+def index_images(client=None, batch_size=1000):
+    client = client or redis.get_redis_client()
+    tids = [
+        tid
+        for shard in keys.all_shards(keys.TIDS, client.shards)
+        for tid, _ in client.conn.zscan_iter(shard, count=batch_size)
+    ]
+    return sum(
+        client.run_script(scripts.INDEX_IMAGES, args=tids[start : start + batch_size])
+        for start in range(0, len(tids), batch_size)
+    )
+
+
+# convert the tids and user:tweets:<uid> sets created before pagination into
+# sorted sets scored by the tweets' timestamps, returns the number of keys
+# converted (in the layout before keys.py, see migrations.py)
+def migrate_indexes(client=None):
+    client = client or redis.get_redis_client()
+    indexes = ["tids"] + list(client.conn.scan_iter(match="user:tweets:*"))
+    return sum(client.run_script(scripts.MIGRATE_INDEX, keys=[key]) for key in indexes)
+
+
+# the loaded tweets (see Storage.get_tweets) with their presigned urls
+def augment_tweets(tweets, s3_client):
+    return [_augment_tweet(tweet, s3_client) for tweet in tweets]
+
+
+# augment_tweets as a step (see steps.py), presigning is local (botocore signs
+# the urls without any request), only a presigned url cache in redis blocks
+def augment_tweets_step(tweets, s3_client):
+    if isinstance(s3_client.url_cache, s3.RedisPresignedUrlCache):
+        return steps.blocking(augment_tweets, tweets, s3_client)
+    return steps.call(augment_tweets, tweets, s3_client)
 
 
 def is_valid_file(file):
@@ -69,3 +127,20 @@ def is_valid_file(file):
     ):
         return False
     return True
+
+
+#
+# Internal helper function
+#
+
+
+def _augment_tweet(tweet, s3_client):
+    # an image still being uploaded has no url yet (see image_status)
+    if "image_status" in tweet:
+        tweet.pop("image", None)
+    # if the tweet contains image (and its derivatives), then also grab them as
+    # presigned_url
+    for field in records.IMAGE_FIELDS:
+        if field in tweet:
+            tweet.update({field: s3_client.create_presigned_url(tweet[field])})
+    return tweet
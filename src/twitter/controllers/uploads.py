@@ -0,0 +1,219 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+
+from twitter.controllers import s3
+from twitter.controllers import keys
+from twitter.controllers import redis
+from twitter.controllers import records
+from twitter.controllers import storage
+
+# upload the images in the background (set to 0 to upload them in the request)
+UPLOAD_ASYNC = os.environ.get("UPLOAD_ASYNC", "1") == "1"
+# where the images wait for the worker, it must be shared by the app and the worker
+UPLOAD_SPOOL_DIR = os.environ.get(
+    "UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "twitter-uploads")
+)
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+UPLOAD_MAX_ATTEMPTS = int(os.environ.get("UPLOAD_MAX_ATTEMPTS", 5))
+# seconds before the first retry, doubled after each failed attempt
+UPLOAD_RETRY_DELAY = float(os.environ.get("UPLOAD_RETRY_DELAY", 1))
+# longest side (in pixels) of the derivatives of the images
+IMAGE_THUMB_SIZE = int(os.environ.get("IMAGE_THUMB_SIZE", 320))
+IMAGE_MEDIUM_SIZE = int(os.environ.get("IMAGE_MEDIUM_SIZE", 1024))
+
+#
+# uploads.py: background upload of the tweets' images
+#
+# uploads --> queue of "<tid>:<iid>" jobs, the image is spooled at
+#   UPLOAD_SPOOL_DIR/<iid> and the tweet has image_status "pending" (images
+#   uploaded in the request are queued too, only for their derivatives)
+# uploads:processing --> the jobs taken by a worker, they are put back in the
+#   queue if the worker dies before finishing them
+#
+# (the queues of the redis storage, the sqlite storage keeps the jobs in its
+# uploads table, see Storage.take_upload)
+#
+# once the image is in s3, image_status is removed from the tweet (or set to
+# "failed" after UPLOAD_MAX_ATTEMPTS), either way the spooled file is removed,
+# and the keys of its downscaled
+# derivatives are set as image_<name> (see DERIVATIVES)
+#
+
+logger = logging.getLogger("twitter.uploads")
+
+# name --> longest side of the derivative, stored as the image_<name> field
+DERIVATIVES = {"thumb": IMAGE_THUMB_SIZE, "medium": IMAGE_MEDIUM_SIZE}
+DERIVATIVE_FIELDS = tuple(f"image_{name}" for name in DERIVATIVES)
+
+
+# save the uploaded file where the worker will pick it up
+def spool(file, iid, spool_dir=UPLOAD_SPOOL_DIR):
+    os.makedirs(spool_dir, exist_ok=True)
+    file.save(_path(spool_dir, iid))
+
+
+# remove a spooled file that will not be uploaded
+def discard(iid, spool_dir=UPLOAD_SPOOL_DIR):
+    try:
+        os.remove(_path(spool_dir, iid))
+    except FileNotFoundError:
+        pass
+
+
+# queue the images posted before the derivatives, returns the number of jobs
+def backfill(client=None, batch_size=1000):
+    client = client or redis.get_redis_client()
+    queued = 0
+    tids = [
+        tid
+        for shard in keys.all_shards(keys.TIDS, client.shards)
+        for tid, _ in client.conn.zscan_iter(shard, count=batch_size)
+    ]
+    buckets = client.tweet_buckets
+    for start in range(0, len(tids), batch_size):
+        batch = tids[start : start + batch_size]
+        pipe = client.conn.pipeline(transaction=False)
+        for tid in batch:
+            records.read(pipe, tid, buckets)
+        tweets = [records.parse(tweet, buckets) for tweet in pipe.execute()]
+        jobs = [
+            f"{tid}:{tweet['image']}"
+            for tid, tweet in zip(batch, tweets)
+            if tweet.get("image")
+            and not tweet.get("image_status")
+            and not all(tweet.get(field) for field in DERIVATIVE_FIELDS)
+        ]
+        if jobs:
+            client.conn.lpush(keys.UPLOADS, *jobs)
+            queued += len(jobs)
+    return queued
+
+
+class UploadWorker(object):
+    def __init__(
+        self, s3_client=None, redis_client=None, spool_dir=UPLOAD_SPOOL_DIR, store=None
+    ):
+        self._s3_client = s3_client or s3.get_s3_client()
+        # the redis storage of the client, or the storage of the app
+        self._store = store or storage.get_storage(redis_client)
+        self._spool_dir = spool_dir
+        self._stopped = threading.Event()
+
+    # put back the jobs of the workers that died while processing them, the
+    # upload is idempotent so a job processed twice does no harm
+    def requeue(self):
+        self._store.requeue_uploads()
+
+    # process one job, waiting up to timeout seconds for it (0 does not wait),
+    # returns whether a job was processed
+    def run_once(self, timeout=0):
+        job = self._store.take_upload(timeout)
+        if job is None:
+            return False
+        self._process(*job)
+        return True
+
+    # process the queue with a pool of threads until stop() is called
+    def run(self, num_of_threads=UPLOAD_WORKERS):
+        self.requeue()
+        threads = [
+            threading.Thread(target=self._loop, daemon=True)
+            for _ in range(num_of_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        # the tweets were just written, the threads read them from the primary
+        redis.read_from_primary()
+        while not self._stopped.is_set():
+            self.run_once(timeout=1)
+
+    def _process(self, job, tid, iid):
+        path = _path(self._spool_dir, iid)
+        spooled = os.path.exists(path)
+        # an image that is not spooled is already in s3
+        status = "failed" if spooled else "ready"
+        derivatives = {}
+        # the tweet may have been deleted or its image replaced in the meantime
+        tweets = self._store.get_tweets([tid])
+        if tweets and tweets[0].get("image") == iid:
+            if spooled and _retry(self._s3_client.upload_file, path, iid):
+                status = "ready"
+            if status == "ready":
+                derivatives = self._upload_derivatives(path, iid, spooled)
+        current = self._store.finish_upload(job, tid, iid, status, derivatives)
+        # the image is not used by the tweet anymore
+        if not current:
+            uploaded = list(derivatives.values())
+            if spooled and status == "ready":
+                uploaded.append(iid)
+            for key in uploaded:
+                self._s3_client.delete_file(key)
+        # a failed tweet is not retried, its image is lost
+        discard(iid, self._spool_dir)
+
+    # field --> key of the derivatives uploaded to s3, an image that Pillow
+    # cannot read is only shown in its original size
+    def _upload_derivatives(self, path, iid, spooled):
+        # Pillow is only needed by the worker
+        from PIL import UnidentifiedImageError
+        from twitter.controllers import images
+
+        derivatives = {}
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                if not spooled:
+                    path = os.path.join(directory, "original")
+                    self._s3_client.download_file(iid, path)
+                for name, size in DERIVATIVES.items():
+                    derivative = images.make_derivative(path, name, size, directory)
+                    key = f"{iid}_{os.path.basename(derivative)}"
+                    if _retry(self._s3_client.upload_file, derivative, key):
+                        derivatives[f"image_{name}"] = key
+            except (UnidentifiedImageError, OSError) as e:
+                logger.warning("no derivatives of %s: %s", iid, e)
+            except Exception:
+                logger.exception("no derivatives of %s", iid)
+        return derivatives
+
+
+#
+# Internal helper function
+#
+
+
+def _path(spool_dir, iid):
+    return os.path.join(spool_dir, str(iid))
+
+
+# call func(path, key) until it succeeds, at most UPLOAD_MAX_ATTEMPTS times,
+# returns whether it succeeded
+def _retry(func, path, key):
+    for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+        try:
+            func(path, key)
+            return True
+        except Exception as e:
+            if attempt == UPLOAD_MAX_ATTEMPTS:
+                logger.exception(
+                    "upload of %s failed after %d attempts", key, UPLOAD_MAX_ATTEMPTS
+                )
+            else:
+                logger.warning(
+                    "upload of %s failed (attempt %d of %d): %s",
+                    key,
+                    attempt,
+                    UPLOAD_MAX_ATTEMPTS,
+                    e,
+                )
+                time.sleep(UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+    return False
@@ -2,11 +2,22 @@ from datetime import datetime
 from werkzeug.utils import secure_filename
 
 from twitter.controllers import s3
+from twitter.controllers import keys
 from twitter.controllers import redis
+from twitter.controllers import timelines
+from twitter.controllers import pagination
+from twitter.controllers import scripts
+from twitter.controllers import storage
+from twitter.controllers import uploads
+from twitter.controllers import fragments
 from twitter.controllers.tweets import is_valid_file
 
+# the user's tweets are read this many at a time (see User.tweets)
+TWEETS_BATCH_SIZE = 1000
+
 #
-# users.py: module's entry point
+# users.py: module's entry point, the users read and write through the storage
+# of the app (see storage.py)
 #
 
 
@@ -15,12 +26,14 @@ class InvalidSessionError(Exception):
 
 
 class User(object):
-    def __init__(self, uid, client=None):
-        # create redis client
-        self._redis_client = client or redis.RedisClient()
-        # get user profile
-        self._uid = uid
-        self._profile = self._redis_client.conn.hgetall(f"users:{self._uid}")
+    def __init__(self, uid, client=None, profile=None, store=None):
+        # the redis storage of the client, or the storage of the app
+        self._store = store or storage.get_storage(client)
+        # get user profile (unless it is already known)
+        self._uid = str(uid)
+        if profile is None:
+            profile = self._store.get_users([self._uid])[self._uid]
+        self._profile = profile
 
     # user id
     @property
@@ -35,127 +48,173 @@ class User(object):
     # followers uids
     @property
     def followers(self):
-        return list(self._redis_client.conn.smembers(f"followers:{self.uid}"))
+        return self._store.get_followers(self.uid)
 
     # following users' uids
     @property
     def following(self):
-        return list(self._redis_client.conn.smembers(f"following:{self.uid}"))
+        return self._store.get_following(self.uid)
+
+    # number of followers / following users / tweets
+    @property
+    def counts(self):
+        return self._store.get_counts(self.uid)
+
+    @property
+    def num_of_followers(self):
+        return self.counts["num_of_followers"]
+
+    @property
+    def num_of_following(self):
+        return self.counts["num_of_following"]
+
+    @property
+    def num_of_tweets(self):
+        return self.counts["num_of_tweets"]
 
-    # user's tweets' tids
+    # a random sample of (at most count) followers' / following users' uids
+    def followers_sample(self, count=pagination.PAGE_SIZE):
+        return self._store.sample_followers(self.uid, count)
+
+    def following_sample(self, count=pagination.PAGE_SIZE):
+        return self._store.sample_following(self.uid, count)
+
+    # the uids (among the given ones) followed by the user, in one round trip
+    def is_following_many(self, uids):
+        return self._store.is_following_many(self.uid, uids)
+
+    # user's tweets' tids, from the newest to the oldest
     @property
     def tweets(self):
-        return list(self._redis_client.conn.smembers(f"user:tweets:{self.uid}"))
+        tids, cursor = self.tweets_page(count=TWEETS_BATCH_SIZE)
+        while cursor:
+            page, cursor = self.tweets_page(cursor, count=TWEETS_BATCH_SIZE)
+            tids += page
+        return tids
+
+    # tids of the personal timeline (yourself and following users' tweets),
+    # from the newest to the oldest
+    @property
+    def timeline(self):
+        tids, _ = self.timeline_page(count=timelines.TIMELINE_MAX_LENGTH)
+        return tids
+
+    # a page of the user's tweets' tids after the cursor, and the next cursor
+    def tweets_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return self._store.get_user_tweets_page(self.uid, cursor, count=count)
+
+    # a page of the tweets mentioning the user after the cursor, and the next
+    # cursor
+    def mentions_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return self._store.get_mentions_page(self.uid, cursor, count=count)
+
+    # a page of the personal timeline after the cursor, and the next cursor
+    def timeline_page(self, cursor=None, count=pagination.PAGE_SIZE):
+        return self._store.get_timeline_page(self.uid, cursor, count=count)
 
     def is_exist(self):
-        return self._redis_client.validate_user_id(self.uid)
+        return self._store.user_exists(self.uid)
+
+    # the profiles of several users (uid --> profile), fetched in one pipelined
+    # round trip, duplicated uids are only fetched once
+    @classmethod
+    def load_many(cls, uids, client=None, store=None):
+        return (store or storage.get_storage(client)).get_users(uids)
 
 
 class LoggedInUser(User):
-    def __init__(self, sid, redis_client=None, s3_client=None):
-        # get uid
-        self._s3_client = s3_client or s3.S3Client()
-        self._redis_client = redis_client or redis.RedisClient()
-        self._uid = self._redis_client.get_user_id(sid)
-        if not self._uid["success"]:
+    # session is the resolved sid (see Storage.resolve_session), if it is
+    # already known
+    def __init__(
+        self, sid, redis_client=None, s3_client=None, session=None, store=None
+    ):
+        # get uid and user profile
+        self._s3_client = s3_client or s3.get_s3_client()
+        store = store or storage.get_storage(redis_client)
+        session = session or store.resolve_session(sid)
+        if session is None:
             raise InvalidSessionError("Your session is invalid!")
-        self._uid = self._uid["payload"]
-        super().__init__(self._uid, client=self._redis_client)
-        # get user profile
-        self._profile = self._redis_client.conn.hgetall(f"users:{self._uid}")
+        # the pages add their own fields to the profile, the session may be cached
+        super().__init__(session["uid"], profile=dict(session["profile"]), store=store)
 
     # follow another user
     def follow(self, uid):
-        if uid == self.uid:
-            return False
-        self._redis_client.conn.sadd(f"following:{self.uid}", uid)
-        self._redis_client.conn.sadd(f"followers:{uid}", self.uid)
-        return True
+        return self._store.follow(self.uid, uid)
 
     # unfollow another user
     def unfollow(self, uid):
-        if uid == self.uid:
-            return False
-        self._redis_client.conn.srem(f"following:{self.uid}", uid)
-        self._redis_client.conn.srem(f"followers:{uid}", self.uid)
-        return True
+        return self._store.unfollow(self.uid, uid)
 
     # update the tweet content
     def update_tweet(self, tid, **kwargs):
-        if not self._redis_client.conn.sismember(f"user:tweets:{self.uid}", tid):
-            return False
-        image = kwargs["image"].get("tweet_image")
+        image = kwargs.pop("image").get("tweet_image")
         filename = secure_filename(image.filename)
         # have the image file but not valid
         if filename != "" and not is_valid_file(image):
             return False
         # have the image file and valid
+        iid = ""
         if filename != "":
-            # get the image id if it exists, otherwise create one
-            # get the iid if it exists (update image), otherwise create a new one (upload new image)
-            iid = self._redis_client.conn.hget(f"tweets:{tid}", "image")
-            if not iid:
-                iid = f"{self._redis_client.conn.incr('iid')}_{filename}"
-            # upload image with the key iid
-            self._s3_client.upload_fileobj(image, iid)
-            # store the image id in redis
-            kwargs.update({"image": iid})
-        # user did not upload an image
-        else:
-            # remove unwant kwarg
-            kwargs.pop("image")
-            # get the iid if it exists (update image), otherwise do nothing
-            iid = self._redis_client.conn.hget(f"tweets:{tid}", "image")
+            # always create a new image id, so that an image id always refers to
+            # the same content and its (cached) presigned url can be reused
+            iid = f"{self._store.next_image_id()}_{filename}"
+            self._store_image(image, iid, kwargs)
+        # an empty iid removes the image, as the user did not upload one
+        previous_images = self._store.update_tweet(
+            self.uid, tid, kwargs, image=iid, timestamp=datetime.now().timestamp()
+        )
+        if previous_images is None:
+            # not the user's tweet, drop the image we just stored
             if iid:
-                self._s3_client.delete_file(iid)
-                self._redis_client.conn.hdel(f"tweets:{tid}", "image")
-        # update timestamp
-        kwargs.update({"timestamp": datetime.now().timestamp()})
-        # update the tweet
-        self._redis_client.conn.hset(f"tweets:{tid}", mapping=kwargs)
+                self._drop_image(iid)
+            return False
+        # the other workers render the new version of the tweet
+        fragments.get_fragment_cache().invalidate(tid)
+        for key in previous_images:
+            self._s3_client.delete_file(key)
         return True
 
     def post_tweet(self, **kwargs):
-        image = kwargs["image"].get("tweet_image")
+        image = kwargs.pop("image").get("tweet_image")
         filename = secure_filename(image.filename)
         # have the image file but not valid
         if filename != "" and not is_valid_file(image):
             return False
-        # update users's tweets
-        tid = self._redis_client.conn.incr("tid")
-        self._redis_client.conn.sadd("tids", tid)
-        self._redis_client.conn.sadd(f"user:tweets:{self.uid}", tid)
         # create a id for image so that it can be refered by s3
         if filename != "":
-            iid = f"{self._redis_client.conn.incr('iid')}_{filename}"
-            # upload image with the key iid
-            self._s3_client.upload_fileobj(image, iid)
+            iid = f"{self._store.next_image_id()}_{filename}"
+            self._store_image(image, iid, kwargs)
             kwargs.update({"image": iid})
-        else:
-            # remove unwant kwarg
-            kwargs.pop("image")
-        # add auxiliary information
-        kwargs.update({"timestamp": datetime.now().timestamp(), "uid": self.uid})
-        # set tweet
-        self._redis_client.conn.hset(f"tweets:{tid}", mapping=kwargs)
+        # (the image is queued for the upload worker)
+        self._store.post_tweet(self.uid, kwargs, timestamp=datetime.now().timestamp())
         return True
 
     def del_tweet(self, tid):
-        if not self._redis_client.conn.sismember(f"user:tweets:{self.uid}", tid):
+        images = self._store.delete_tweet(self.uid, tid)
+        if images is None:
             return False
-        # delete file if the tweets:{tid} has 'image'
-        iid = self._redis_client.conn.hget(f"tweets:{tid}", "image")
-        if iid:
-            self._s3_client.delete_file(iid)
-        # remove tid from all tids
-        self._redis_client.conn.srem("tids", tid)
-        # remove tid from the user's tids
-        self._redis_client.conn.srem(f"user:tweets:{self.uid}", tid)
-        # remove the tweet from the database
-        for k in self._redis_client.conn.hgetall(f"tweets:{tid}").keys():
-            self._redis_client.conn.hdel(f"tweets:{tid}", k)
+        fragments.get_fragment_cache().invalidate(tid)
+        # delete the files if the tweet had 'image' (and its derivatives)
+        for key in images:
+            self._s3_client.delete_file(key)
         return True
 
+    # upload the image with the key iid, or spool it for the upload worker (the
+    # tweet is then marked as pending), either way the storage queues the image
+    # for the worker which uploads it and its derivatives
+    def _store_image(self, image, iid, kwargs):
+        if uploads.UPLOAD_ASYNC:
+            uploads.spool(image, iid)
+            kwargs.update({"image_status": "pending"})
+        else:
+            self._s3_client.upload_fileobj(image, iid)
+
+    def _drop_image(self, iid):
+        if uploads.UPLOAD_ASYNC:
+            uploads.discard(iid)
+        else:
+            self._s3_client.delete_file(iid)
+
 
 #
 # helper functions
@@ -163,5 +222,27 @@ class LoggedInUser(User):
 
 
 def get_all_users_ids():
-    client = redis.RedisClient()  # use default
-    return [user_id for user_id in client.conn.hgetall("users").values()]
+    client = redis.get_redis_client()  # use default
+    return [
+        user_id
+        for shard in keys.all_shards(keys.EMAILS, client.shards)
+        for user_id in client.read_conn.hvals(shard)
+    ]
+
+
+# recompute the counters of the user from the sets, returns the counts
+# (followers, following, tweets)
+def repair_counts(uid, client=None):
+    client = client or redis.get_redis_client()
+    return client.run_script(scripts.REPAIR_COUNTS, keys=[keys.counts(uid)], args=[uid])
+
+
+# recompute the counters of every user, returns the number of users
+def repair_all_counts(client=None):
+    client = client or redis.get_redis_client()
+    repaired = 0
+    for shard in keys.all_shards(keys.UIDS, client.shards):
+        for uid in client.conn.sscan_iter(shard, count=1000):
+            repair_counts(uid, client=client)
+            repaired += 1
+    return repaired
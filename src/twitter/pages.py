@@ -0,0 +1,245 @@
+import time
+import flask
+import hashlib
+from markupsafe import Markup
+from markupsafe import escape
+
+from twitter.controllers import s3
+from twitter.controllers import fragments
+from twitter.controllers import tags
+from twitter.controllers import tweets as controllers_tweets
+
+# the etags change at least this often (in seconds), so that a page is never
+# revalidated past the validity of its presigned urls (see fragments.py)
+ETAG_PERIOD = max(1, s3.PRESIGNED_URL_MIN_TTL - fragments.FRAGMENT_CACHE_TTL)
+
+#
+# pages.py: helpers of the pages shared by the sync (app.py) and the async
+# (asgi.py) apps, they run in the request context of the page
+#
+# the timeline pages (home, profile, guest_profile) are written once as the steps
+# of their reads (see steps.py), given the reads of the storage (see
+# Storage.reads) and the resolved session of the logged in user: the sync app
+# runs them one after the other, the async app with the independent ones in
+# flight at the same time
+#
+
+
+# personal home page
+def home(reads, session, s3_client):
+    uid = session["uid"]
+    # the latest tweets of everyone, and the user's own info
+    page_etag = etag(uid, (yield reads.get_feed_versions(["*", uid])))
+    if page_etag in flask.request.if_none_match:
+        return not_modified(page_etag)
+    # who to follow and the trending tags are bounded lists, whatever the number
+    # of users and of tweets
+    (tids, next_cursor), counts, suggested, trending = yield [
+        reads.get_tweets_page(flask.request.args.get("cursor")),
+        reads.get_counts(uid),
+        reads.get_suggestions(uid),
+        reads.get_trending(),
+    ]
+    # tweets, already sorted
+    tweets = yield load_tweets(reads, tids, s3_client)
+    authors, following, users = yield [
+        reads.get_users([tweet["uid"] for tweet in tweets]),
+        reads.is_following_many(uid, [tweet["uid"] for tweet in tweets]),
+        reads.get_users(suggested),
+    ]
+    add_authors(tweets, authors)
+    yield render_tweets(reads, tweets)
+    logged_in_user = dict(session["profile"])
+    logged_in_user.update({"following_uids": following})
+    logged_in_user.update(counts)
+    page = flask.render_template(
+        "home.html",
+        logged_in_user=logged_in_user,
+        user=logged_in_user,
+        users=list(users.values()),
+        trending=trending,
+        tweets=tweets,
+        next_cursor=next_cursor,
+    )
+    return with_etag(page, page_etag)
+
+
+# personal profile page
+def profile(reads, session, s3_client):
+    uid = session["uid"]
+    versions = yield reads.get_feed_versions([uid], celebrities_of=uid)
+    page_etag = etag(uid, versions)
+    if page_etag in flask.request.if_none_match:
+        return not_modified(page_etag)
+    # personal tweets (yourself and following uids), already sorted, and a
+    # sample of the user's followers and following
+    (tids, next_cursor), counts, followers, following_sample = yield [
+        reads.get_timeline_page(uid, flask.request.args.get("cursor")),
+        reads.get_counts(uid),
+        reads.sample_followers(uid),
+        reads.sample_following(uid),
+    ]
+    tweets = yield load_tweets(reads, tids, s3_client)
+    authors, following, followers_users, following_users = yield [
+        reads.get_users([tweet["uid"] for tweet in tweets]),
+        reads.is_following_many(uid, followers + [tweet["uid"] for tweet in tweets]),
+        reads.get_users(followers),
+        reads.get_users(following_sample),
+    ]
+    add_authors(tweets, authors)
+    yield render_tweets(reads, tweets)
+    for follower, user in followers_users.items():
+        user.update({"is_following": follower in following})
+    logged_in_user = dict(session["profile"])
+    logged_in_user.update({"following_uids": following})
+    logged_in_user.update(counts)
+    page = flask.render_template(
+        "profile.html",
+        logged_in_user=logged_in_user,
+        user=logged_in_user,
+        following_users=list(following_users.values()),
+        followers=list(followers_users.values()),
+        tweets=tweets,
+        next_cursor=next_cursor,
+    )
+    return with_etag(page, page_etag)
+
+
+# get users' profile page
+def guest_profile(reads, session, s3_client, uid):
+    viewer = session["uid"]
+    versions, exists = yield [
+        reads.get_feed_versions([uid, viewer]),
+        reads.user_exists(uid),
+    ]
+    if not exists:
+        return flask.make_response(flask.render_template("error/404.html"), 404)
+    page_etag = etag(viewer, versions)
+    if page_etag in flask.request.if_none_match:
+        return not_modified(page_etag)
+    # get visiting user's info and tweets, already sorted
+    (tids, next_cursor), counts, users = yield [
+        reads.get_user_tweets_page(uid, flask.request.args.get("cursor")),
+        reads.get_counts(uid),
+        reads.get_users([uid]),
+    ]
+    tweets = yield load_tweets(reads, tids, s3_client)
+    authors, following = yield [
+        reads.get_users([tweet["uid"] for tweet in tweets]),
+        reads.is_following_many(viewer, [uid] + [tweet["uid"] for tweet in tweets]),
+    ]
+    add_authors(tweets, authors)
+    yield render_tweets(reads, tweets)
+    user = users[str(uid)]
+    user.update(counts)
+    logged_in_user = dict(session["profile"])
+    logged_in_user.update({"following": str(uid) in following})
+    logged_in_user.update({"following_uids": following})
+    page = flask.render_template(
+        "profile.html",
+        logged_in_user=logged_in_user,
+        user=user,
+        tweets=tweets,
+        next_cursor=next_cursor,
+    )
+    return with_etag(page, page_etag)
+
+
+# the tweets of the tids (those that still exist) with their presigned urls,
+# in one round trip
+def load_tweets(reads, tids, s3_client):
+    tweets = yield reads.get_tweets(tids)
+    return (yield controllers_tweets.augment_tweets_step(tweets, s3_client))
+
+
+# hydrate the tweets with their authors (uid --> profile)
+def add_authors(tweets, authors):
+    for tweet in tweets:
+        tweet.update({"user": authors[tweet["uid"]]})
+
+
+# add the tweets' html shared by all the viewers (cached, see fragments.py) to
+# the hydrated tweets
+def render_tweets(reads, tweets):
+    tweets_by_tid = by_tid(tweets)
+
+    def render(tid):
+        return render_tweet(tweets_by_tid[tid])
+
+    if fragments.FRAGMENT_CACHE:
+        html = yield fragments.get_fragment_cache().get_many_steps(
+            fragment_versions(tweets_by_tid), render, reads
+        )
+    else:
+        html = {tid: render(tid) for tid in tweets_by_tid}
+    add_fragments(tweets_by_tid, html)
+    return tweets
+
+
+# the etag of the page showing the feeds of the given versions (see
+# timelines.get_feed_versions) to the user, in this version of the templates
+# (see assets.py) and period
+def etag(uid, versions):
+    parts = [
+        flask.current_app.config["ASSETS_VERSION"],
+        str(int(time.time() // ETAG_PERIOD)),
+        str(uid),
+        flask.request.full_path,
+    ]
+    return hashlib.sha1("\n".join(parts + list(versions)).encode()).hexdigest()
+
+
+# the browser's copy of the page is still valid
+def not_modified(etag):
+    return with_etag(flask.Response(status=304), etag)
+
+
+# the page is private to the user and revalidated on every request
+def with_etag(page, etag):
+    response = flask.make_response(page)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# tid --> the tweets (hydrated with their authors)
+def by_tid(tweets):
+    return {str(tweet["tid"]): tweet for tweet in tweets}
+
+
+# the (tid, version) of the tweets, as cached by the fragment cache
+def fragment_versions(tweets_by_tid):
+    return [(tid, tweet.get("version", "0")) for tid, tweet in tweets_by_tid.items()]
+
+
+# the tweet's html shared by all the viewers
+def render_tweet(tweet):
+    return flask.render_template("components/tweet.html", tweet=tweet)
+
+
+# add the tweets' html, split where components/timeline.html adds the viewer's
+# header, to the tweets
+def add_fragments(tweets_by_tid, fragments):
+    for tid, tweet in tweets_by_tid.items():
+        before, after = fragments[tid].split("<!--viewer-->", 1)
+        tweet.update({"fragment": (Markup(before), Markup(after))})
+
+
+# the text (escaped) with its #tags linked to their page and its @mentions to
+# the profile of the user
+def linkify(text):
+    parts, end = [], 0
+    for match in tags.TOKENS.finditer(text or ""):
+        sign, word = match.groups()
+        if sign == "#":
+            url = flask.url_for("tag", tag=word.lower())
+        elif word.isdigit():
+            url = flask.url_for("guest_profile", uid=int(word))
+        else:
+            continue
+        parts.append(escape(text[end : match.start()]))
+        parts.append(Markup('<a href="{}">{}</a>').format(url, match.group(0)))
+        end = match.end()
+    parts.append(escape((text or "")[end:]))
+    return Markup("").join(parts)
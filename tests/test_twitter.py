@@ -1,11 +1,17 @@
+import os
+import time
 import pytest
 import uuid
+import flask
 from werkzeug.datastructures import FileStorage
 
 from twitter.controllers.tweets import Tweet
 from twitter.controllers.s3 import S3Client
 from twitter.controllers.redis import RedisClient
-from twitter.controllers.users import LoggedInUser
+from twitter.controllers import keys
+from twitter.controllers.users import User, LoggedInUser
+from twitter.controllers import uploads
+from twitter.controllers.uploads import UploadWorker
 
 
 class ConnectionError(Exception):
@@ -77,11 +83,13 @@ def s3_client(redis_client):
 @pytest.fixture(scope="module")
 def signup(redis_client, sid_1, sid_2, fake_user_1, fake_user_2):
     for sid, fake_user in zip([sid_1, sid_2], [fake_user_1, fake_user_2]):
-        redis_client.conn.sadd("emails", fake_user["email"])
-        redis_client.conn.sadd("uids", fake_user["uid"])
-        # users:<uid> --> user info
+        shards = redis_client.shards
+        redis_client.conn.sadd(
+            keys.shard(keys.UIDS, fake_user["uid"], shards), fake_user["uid"]
+        )
+        # users:{<uid>} --> user info
         redis_client.conn.hset(
-            f"users:{fake_user['uid']}",
+            keys.user(fake_user["uid"]),
             mapping={
                 "uid": fake_user["uid"],
                 "email": fake_user["email"],  # email should always exists
@@ -92,8 +100,12 @@ def signup(redis_client, sid_1, sid_2, fake_user_1, fake_user_2):
                 "picture": fake_user["picture"],
             },
         )
-        # [users] email--> uid
-        redis_client.conn.hset("users", fake_user["email"], fake_user["uid"])
+        # email --> uid
+        redis_client.conn.hset(
+            keys.email_shard(fake_user["email"], shards),
+            fake_user["email"],
+            fake_user["uid"],
+        )
 
         # save the email and access token to the database: sid --> {email, access token}
         # use sid as access token
@@ -132,6 +144,7 @@ def test_post_and_get_tweet_without_image(logged_in_user_1, redis_client, s3_cli
     augmented_tweet.pop("timestamp")
     augmented_tweet.pop("tid")
     augmented_tweet.pop("uid")
+    augmented_tweet.pop("version")
     assert kwargs == augmented_tweet
 
 
@@ -154,6 +167,7 @@ def test_update_tweet_without_iamge(logged_in_user_1, redis_client, s3_client):
     augmented_tweet.pop("timestamp")
     augmented_tweet.pop("tid")
     augmented_tweet.pop("uid")
+    augmented_tweet.pop("version")
     assert kwargs == augmented_tweet
 
 
@@ -199,6 +213,10 @@ def test_tweet_with_supported_image(logged_in_user_1, redis_client, s3_client):
     kwargs = {"image": image, "tweet_text": "Hello World"}
     # (post)
     assert logged_in_user_1.post_tweet(**kwargs)
+    # the image is uploaded in the background
+    if uploads.UPLOAD_ASYNC:
+        worker = UploadWorker(s3_client=s3_client, redis_client=redis_client)
+        assert worker.run_once()
 
     # (get)
     assert len(logged_in_user_1.tweets) == 1
@@ -209,6 +227,10 @@ def test_tweet_with_supported_image(logged_in_user_1, redis_client, s3_client):
     augmented_tweet.pop("timestamp")
     augmented_tweet.pop("tid")
     augmented_tweet.pop("uid")
+    augmented_tweet.pop("version")
+    # the derivatives made by the upload worker
+    for field in uploads.DERIVATIVE_FIELDS:
+        assert augmented_tweet.pop(field)
     # we can't test the image value as they are being replaced by presigned url
     assert (
         kwargs["tweet_text"] == augmented_tweet["tweet_text"]
@@ -221,6 +243,35 @@ def test_tweet_with_supported_image(logged_in_user_1, redis_client, s3_client):
     f.close()
 
 
+def test_load_many_tweets(logged_in_user_1, logged_in_user_2, redis_client, s3_client):
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=image, tweet_text="Hello")
+    logged_in_user_2.post_tweet(image=image, tweet_text="World")
+    tids = logged_in_user_1.tweets + logged_in_user_2.tweets
+    # tweets that do not exist are skipped
+    tweets = Tweet.load_many(
+        tids + ["-1"], s3_client=s3_client, redis_client=redis_client
+    )
+    assert [tweet["tid"] for tweet in tweets] == tids
+    assert [tweet["tweet_text"] for tweet in tweets] == ["Hello", "World"]
+    assert (
+        tweets[0]
+        == Tweet(tids[0], s3_client=s3_client, redis_client=redis_client).tweet
+    )
+    # clean up
+    logged_in_user_1.del_tweet(tids[0])
+    logged_in_user_2.del_tweet(tids[1])
+
+
+def test_load_many_users(logged_in_user_1, logged_in_user_2, redis_client):
+    uids = [logged_in_user_1.uid, logged_in_user_2.uid, logged_in_user_1.uid]
+    profiles = User.load_many(uids, client=redis_client)
+    # duplicated uids are only fetched once
+    assert list(profiles) == [logged_in_user_1.uid, logged_in_user_2.uid]
+    assert profiles[logged_in_user_1.uid] == logged_in_user_1.profile
+    assert profiles[logged_in_user_2.uid] == logged_in_user_2.profile
+
+
 def test_follow(logged_in_user_1, logged_in_user_2):
     assert logged_in_user_1.follow(logged_in_user_2.uid)
     assert len(logged_in_user_2.followers) == 1
@@ -234,3 +285,1481 @@ def test_unfollow(logged_in_user_1, logged_in_user_2):
 def test_follow_or_unfollow_self(logged_in_user_1):
     assert not logged_in_user_1.follow(logged_in_user_1.uid)
     assert not logged_in_user_1.unfollow(logged_in_user_1.uid)
+
+
+def test_shared_clients():
+    from twitter.controllers.s3 import get_s3_client
+    from twitter.controllers.redis import get_redis_client, get_connection_pool
+    from twitter.controllers.storage import get_storage
+
+    # one client (and one pool) per process
+    assert get_redis_client() is get_redis_client()
+    assert get_redis_client().conn.connection_pool is get_connection_pool()
+    assert get_s3_client() is get_s3_client()
+    # models fall back to the shared clients
+    tweet = Tweet("1")
+    assert tweet._store is get_storage()
+    assert tweet._s3_client is get_s3_client()
+
+
+def test_shared_clients_after_fork(monkeypatch):
+    import os
+    from twitter.controllers.redis import get_redis_client, get_connection_pool
+
+    pool = get_connection_pool()
+    client = get_redis_client()
+    # a forked worker sees a different pid and must not reuse the parent's sockets
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    assert get_connection_pool() is not pool
+    assert get_redis_client() is not client
+
+
+def test_timeline_fan_out(logged_in_user_1, logged_in_user_2):
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_2.post_tweet(image=image, tweet_text="before following")
+    (old_tid,) = logged_in_user_2.tweets
+    # following backfills the timeline
+    assert logged_in_user_1.follow(logged_in_user_2.uid)
+    assert logged_in_user_1.timeline == [old_tid]
+    # new tweets are pushed to the followers' timelines, newest first
+    logged_in_user_1.post_tweet(image=image, tweet_text="mine")
+    logged_in_user_2.post_tweet(image=image, tweet_text="after following")
+    (tid_1,) = logged_in_user_1.tweets
+    (new_tid,) = set(logged_in_user_2.tweets) - {old_tid}
+    assert logged_in_user_1.timeline == [new_tid, tid_1, old_tid]
+    assert logged_in_user_2.timeline == [new_tid, old_tid]
+    # updating a tweet moves it to the top
+    logged_in_user_2.update_tweet(old_tid, image=image, tweet_text="edited")
+    assert logged_in_user_1.timeline == [old_tid, new_tid, tid_1]
+    # deleting removes it
+    logged_in_user_2.del_tweet(old_tid)
+    assert logged_in_user_1.timeline == [new_tid, tid_1]
+    # unfollowing prunes the timeline
+    assert logged_in_user_1.unfollow(logged_in_user_2.uid)
+    assert logged_in_user_1.timeline == [tid_1]
+    # clean up
+    logged_in_user_1.del_tweet(tid_1)
+    logged_in_user_2.del_tweet(new_tid)
+    assert logged_in_user_1.timeline == []
+
+
+def test_timeline_fan_out_on_read(
+    logged_in_user_1, logged_in_user_2, redis_client, monkeypatch
+):
+    from twitter.controllers import timelines
+
+    # every followed user becomes a celebrity
+    monkeypatch.setattr(timelines, "FANOUT_MAX_FOLLOWERS", 0)
+    image = {"tweet_image": FileStorage(filename="")}
+    assert logged_in_user_1.follow(logged_in_user_2.uid)
+    logged_in_user_2.post_tweet(image=image, tweet_text="famous")
+    (tid,) = logged_in_user_2.tweets
+    # the tweet is not pushed, but merged when the timeline is read
+    assert not redis_client.conn.exists(keys.timeline(logged_in_user_1.uid))
+    assert logged_in_user_1.timeline == [tid]
+    # clean up
+    logged_in_user_2.del_tweet(tid)
+    assert logged_in_user_1.unfollow(logged_in_user_2.uid)
+    redis_client.conn.srem(keys.CELEBRITIES, logged_in_user_2.uid)
+
+
+def test_timeline_trim(logged_in_user_1, monkeypatch):
+    from twitter.controllers import timelines
+
+    monkeypatch.setattr(timelines, "TIMELINE_MAX_LENGTH", 2)
+    image = {"tweet_image": FileStorage(filename="")}
+    for text in ("one", "two", "three"):
+        logged_in_user_1.post_tweet(image=image, tweet_text=text)
+    timeline = logged_in_user_1.timeline
+    assert len(timeline) == 2
+    assert timeline == sorted(logged_in_user_1.tweets, key=int, reverse=True)[:2]
+    # clean up
+    for tid in logged_in_user_1.tweets:
+        logged_in_user_1.del_tweet(tid)
+
+
+def test_unfollow_trimmed_timeline(logged_in_user_1, logged_in_user_2, monkeypatch):
+    from twitter.controllers import timelines
+
+    monkeypatch.setattr(timelines, "TIMELINE_MAX_LENGTH", 2)
+    image = {"tweet_image": FileStorage(filename="")}
+    for text in ("one", "two", "three"):
+        logged_in_user_2.post_tweet(image=image, tweet_text=text)
+    assert logged_in_user_1.follow(logged_in_user_2.uid)
+    assert len(logged_in_user_1.timeline) == 2
+    # only the latest tweets of the unfollowed user can be in the timeline
+    assert logged_in_user_1.unfollow(logged_in_user_2.uid)
+    assert logged_in_user_1.timeline == []
+    # clean up
+    for tid in logged_in_user_2.tweets:
+        logged_in_user_2.del_tweet(tid)
+
+
+def test_pagination(logged_in_user_1, redis_client):
+    from twitter.controllers import pagination
+    from twitter.controllers.tweets import get_tweets_ids_page
+
+    image = {"tweet_image": FileStorage(filename="")}
+    for i in range(5):
+        logged_in_user_1.post_tweet(image=image, tweet_text=f"tweet {i}")
+    # two tweets with the same timestamp must not be skipped nor repeated
+    tids = logged_in_user_1.tweets
+    index = keys.shard(keys.TIDS, 0, redis_client.shards)
+    timestamp = redis_client.conn.zscore(index, tids[1])
+    redis_client.conn.zadd(index, {tids[2]: timestamp})
+    expected = redis_client.conn.zrevrange(index, 0, -1)
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = get_tweets_ids_page(cursor, count=2)
+        pages.append(page)
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [tid for page in pages for tid in page] == expected
+    # the user's tweets and the timeline are paginated the same way
+    page, cursor = logged_in_user_1.tweets_page(count=3)
+    assert page == logged_in_user_1.tweets[:3]
+    page, cursor = logged_in_user_1.timeline_page(cursor, count=3)
+    assert page == logged_in_user_1.tweets[3:] and cursor is None
+    with pytest.raises(pagination.InvalidCursor):
+        get_tweets_ids_page("not a cursor")
+    # clean up
+    for tid in tids:
+        logged_in_user_1.del_tweet(tid)
+
+
+def test_migrate_indexes(logged_in_user_1, redis_client):
+    from twitter.controllers.tweets import migrate_indexes
+
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=image, tweet_text="old")
+    (tid,) = logged_in_user_1.tweets
+    # the layout before the indexes were sorted sets
+    legacy = ("tids", f"user:tweets:{logged_in_user_1.uid}")
+    for key in legacy:
+        redis_client.conn.sadd(key, tid)
+    assert migrate_indexes(client=redis_client) == 2
+    assert migrate_indexes(client=redis_client) == 0
+    for key in legacy:
+        assert redis_client.conn.zrange(key, 0, -1) == [tid]
+    # clean up
+    redis_client.conn.delete(*legacy)
+    logged_in_user_1.del_tweet(tid)
+
+
+def test_timeline_built_on_first_read(logged_in_user_1, logged_in_user_2, redis_client):
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=image, tweet_text="mine")
+    (tid_1,) = logged_in_user_1.tweets
+    # a user whose timeline was never built (e.g. signed up before timelines)
+    redis_client.conn.delete(
+        keys.timeline(logged_in_user_1.uid), keys.timeline_built(logged_in_user_1.uid)
+    )
+    assert logged_in_user_1.follow(logged_in_user_2.uid)
+    logged_in_user_2.post_tweet(image=image, tweet_text="theirs")
+    (tid_2,) = logged_in_user_2.tweets
+    # nothing is written to the timeline until it is built
+    assert not redis_client.conn.exists(keys.timeline(logged_in_user_1.uid))
+    assert logged_in_user_1.timeline == [tid_2, tid_1]
+    # clean up
+    logged_in_user_1.del_tweet(tid_1)
+    logged_in_user_2.del_tweet(tid_2)
+    assert logged_in_user_1.unfollow(logged_in_user_2.uid)
+
+
+def test_empty_timeline_is_not_rebuilt(logged_in_user_1, monkeypatch):
+    from twitter.controllers import timelines
+
+    assert logged_in_user_1.timeline == []
+
+    def rebuild(*args, **kwargs):
+        raise AssertionError("an empty timeline should not be rebuilt")
+
+    monkeypatch.setattr(timelines, "rebuild", rebuild)
+    assert logged_in_user_1.timeline == []
+
+
+def test_invalid_cursor():
+    from twitter.controllers import pagination
+
+    for cursor in ("nan:1", "inf:1", "-inf:1", "1.5", "x:1"):
+        with pytest.raises(pagination.InvalidCursor):
+            pagination.decode_cursor(cursor)
+    assert pagination.decode_cursor("1.5:1") == (1.5, "1")
+
+
+def test_presigned_url_cache(s3_client, monkeypatch):
+    import time
+    from twitter.controllers.s3 import PresignedUrlCache
+
+    cache = PresignedUrlCache(max_size=2, min_ttl=600)
+    monkeypatch.setattr(s3_client, "_url_cache", cache)
+    url = s3_client.create_presigned_url("1_image.jpg")
+    # reused while enough of its validity remains
+    assert s3_client.create_presigned_url("1_image.jpg") == url
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+    # reissued when less than min_ttl seconds remain
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 3600 - 599)
+    assert cache.get("1_image.jpg", 3600) is None
+    monkeypatch.setattr(time, "time", lambda: now)
+    # the least recently used urls are evicted
+    s3_client.create_presigned_url("2_image.jpg")
+    s3_client.create_presigned_url("3_image.jpg")
+    assert cache.get("1_image.jpg", 3600) is None
+    assert cache.get("3_image.jpg", 3600)
+    # uploading or deleting the image invalidates its url
+    s3_client.delete_file("3_image.jpg")
+    assert cache.get("3_image.jpg", 3600) is None
+
+
+def test_redis_presigned_url_cache(s3_client, redis_client, monkeypatch):
+    import time
+    from twitter.controllers.s3 import RedisPresignedUrlCache
+
+    cache = RedisPresignedUrlCache(min_ttl=600, client=redis_client)
+    monkeypatch.setattr(s3_client, "_url_cache", cache)
+    url = s3_client.create_presigned_url("1_image.jpg")
+    assert s3_client.create_presigned_url("1_image.jpg") == url
+    assert cache.stats() == {"hits": 1, "misses": 1}
+    assert redis_client.conn.ttl("presigned:1_image.jpg") > 0
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 3600 - 599)
+    assert cache.get("1_image.jpg", 3600) is None
+    monkeypatch.setattr(time, "time", lambda: now)
+    s3_client.delete_file("1_image.jpg")
+    assert not redis_client.conn.exists("presigned:1_image.jpg")
+
+
+def test_write_scripts(logged_in_user_1, logged_in_user_2, redis_client):
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="mine")
+    (tid,) = logged_in_user_1.tweets
+    # nobody else can update or delete the tweet
+    assert not logged_in_user_2.update_tweet(tid, image=dict(image), tweet_text="x")
+    assert not logged_in_user_2.del_tweet(tid)
+    assert redis_client.conn.hget(f"tweets:{tid}", "tweet_text") == "mine"
+    # the tweet hash is removed with a single DEL
+    assert logged_in_user_1.del_tweet(tid)
+    assert not redis_client.conn.exists(f"tweets:{tid}")
+    assert redis_client.conn.zscore(keys.shard(keys.TIDS, tid, 1), tid) is None
+    assert not logged_in_user_1.del_tweet(tid)
+
+
+def test_upload_worker(logged_in_user_1, redis_client, s3_client, monkeypatch, caplog):
+    from pathlib import Path
+
+    monkeypatch.setattr(uploads, "UPLOAD_ASYNC", True)
+    monkeypatch.setattr(uploads, "UPLOAD_RETRY_DELAY", 0)
+    worker = UploadWorker(s3_client=s3_client, redis_client=redis_client)
+    filename = str(Path(__file__).parent / "test_image_supported.jpg")
+
+    def post():
+        with open(filename, "rb") as f:
+            image = {"tweet_image": FileStorage(f)}
+            logged_in_user_1.post_tweet(image=image, tweet_text="image")
+        return logged_in_user_1.tweets[0]
+
+    # pending until the worker has uploaded it
+    tid = post()
+    tweet = Tweet(tid, redis_client=redis_client, s3_client=s3_client).tweet
+    assert tweet["image_status"] == "pending" and "image" not in tweet
+    assert worker.run_once()
+    tweet = Tweet(tid, redis_client=redis_client, s3_client=s3_client).tweet
+    assert "image_status" not in tweet and tweet["image"]
+    assert not worker.run_once()
+
+    # retried, then marked as failed
+    calls = []
+
+    def upload_file(path, key):
+        calls.append(key)
+        raise Exception("S3 is down")
+
+    monkeypatch.setattr(s3_client, "upload_file", upload_file)
+    tid = post()
+    iid = redis_client.conn.lindex(keys.UPLOADS, -1).split(":")[1]
+    assert os.path.exists(os.path.join(uploads.UPLOAD_SPOOL_DIR, iid))
+    with caplog.at_level("WARNING", logger="twitter.uploads"):
+        assert worker.run_once()
+    assert len(calls) == uploads.UPLOAD_MAX_ATTEMPTS
+    tweet = Tweet(tid, redis_client=redis_client, s3_client=s3_client).tweet
+    assert tweet["image_status"] == "failed"
+    # each attempt is logged, the last one with its traceback
+    assert [record.levelname for record in caplog.records] == ["WARNING"] * (
+        uploads.UPLOAD_MAX_ATTEMPTS - 1
+    ) + ["ERROR"]
+    assert all(iid in record.getMessage() for record in caplog.records)
+    # the spooled file of a failed tweet is removed
+    assert not os.path.exists(os.path.join(uploads.UPLOAD_SPOOL_DIR, iid))
+
+    # the image of a deleted tweet is not uploaded
+    calls.clear()
+    tid = post()
+    logged_in_user_1.del_tweet(tid)
+    assert worker.run_once()
+    assert not calls
+    assert not redis_client.conn.llen(keys.UPLOADS_PROCESSING)
+
+
+def test_image_derivatives(logged_in_user_1, redis_client, s3_client, monkeypatch):
+    pytest.importorskip("PIL")
+    from pathlib import Path
+
+    monkeypatch.setattr(uploads, "UPLOAD_ASYNC", False)
+    worker = UploadWorker(s3_client=s3_client, redis_client=redis_client)
+    filename = str(Path(__file__).parent / "test_image_supported.jpg")
+    with open(filename, "rb") as f:
+        image = {"tweet_image": FileStorage(f)}
+        logged_in_user_1.post_tweet(image=image, tweet_text="image")
+    tid = logged_in_user_1.tweets[0]
+    # generated by the worker, even for the images uploaded in the request
+    assert worker.run_once()
+    tweet = redis_client.conn.hgetall(f"tweets:{tid}")
+    for field in uploads.DERIVATIVE_FIELDS:
+        assert tweet[field].startswith(tweet["image"])
+    # they are deleted with the tweet
+    deleted = []
+    monkeypatch.setattr(s3_client, "delete_file", deleted.append)
+    logged_in_user_1.del_tweet(tid)
+    assert sorted(deleted) == sorted(
+        tweet[field] for field in ("image", *uploads.DERIVATIVE_FIELDS)
+    )
+
+
+def test_image_derivatives_errors(redis_client, s3_client, monkeypatch, caplog):
+    pytest.importorskip("PIL")
+    from pathlib import Path
+    from twitter.controllers import images
+
+    worker = UploadWorker(s3_client=s3_client, redis_client=redis_client)
+    # an image Pillow cannot read only has its original size
+    filename = str(Path(__file__).parent / "test_image_unsupported.svg")
+    with caplog.at_level("WARNING", logger="twitter.uploads"):
+        assert worker._upload_derivatives(filename, "1_image.svg", True) == {}
+    assert [record.levelname for record in caplog.records] == ["WARNING"]
+    # anything else is a bug, logged with its traceback
+    caplog.clear()
+
+    def make_derivative(path, name, size, directory):
+        raise ValueError("bug")
+
+    monkeypatch.setattr(images, "make_derivative", make_derivative)
+    filename = str(Path(__file__).parent / "test_image_supported.jpg")
+    with caplog.at_level("WARNING", logger="twitter.uploads"):
+        assert worker._upload_derivatives(filename, "1_image.jpg", True) == {}
+    assert [record.levelname for record in caplog.records] == ["ERROR"]
+    assert caplog.records[0].exc_info[0] is ValueError
+
+
+def test_backfill_derivatives(redis_client):
+    redis_client.conn.hset("tweets:1001", mapping={"image": "1_old.jpg"})
+    redis_client.conn.hset("tweets:1002", mapping={"image": "2_new.jpg"})
+    for field in uploads.DERIVATIVE_FIELDS:
+        redis_client.conn.hset("tweets:1002", field, f"2_new.jpg_{field}.jpg")
+    redis_client.conn.hset("tweets:1003", mapping={"tweet_text": "no image"})
+    redis_client.conn.zadd(
+        keys.shard(keys.TIDS, 0, 1), {"1001": 1, "1002": 2, "1003": 3}
+    )
+    redis_client.conn.delete(keys.UPLOADS)
+    queued = uploads.backfill(client=redis_client)
+    jobs = redis_client.conn.lrange(keys.UPLOADS, 0, -1)
+    assert queued == len(jobs)
+    assert "1001:1_old.jpg" in jobs
+    assert not [job for job in jobs if job.split(":")[0] in ("1002", "1003")]
+    # clean up
+    redis_client.conn.delete(keys.UPLOADS, "tweets:1001", "tweets:1002", "tweets:1003")
+    redis_client.conn.zrem(keys.shard(keys.TIDS, 0, 1), "1001", "1002", "1003")
+
+
+def test_resolve_session(logged_in_user_1, redis_client, sid_1, fake_user_1):
+    from twitter.controllers import sessions
+
+    cache = sessions.SessionCache(ttl=60)
+    session = sessions.resolve(sid_1, client=redis_client, cache=cache)
+    assert session["uid"] == fake_user_1["uid"]
+    assert session["profile"]["email"] == fake_user_1["email"]
+    assert sessions.resolve("unknown sid", client=redis_client, cache=cache) is None
+    # cached for the ttl, the pages cannot change the cached profile
+    redis_client.conn.hset(sid_1, "email", "changed@fakeemail.com")
+    assert sessions.resolve(sid_1, client=redis_client, cache=cache) == session
+    user = LoggedInUser(sid_1, redis_client=redis_client, session=session)
+    user.profile.update({"following_uids": set()})
+    assert "following_uids" not in session["profile"]
+    # until it is invalidated
+    cache.invalidate(sid_1)
+    assert sessions.resolve(sid_1, client=redis_client, cache=cache) is None
+    redis_client.conn.hset(sid_1, "email", fake_user_1["email"])
+
+
+def test_metrics(redis_client, s3_client):
+    from twitter.controllers import metrics
+
+    metrics.reset()
+    metrics.start_request("home")
+    redis_client.conn.get("uid")
+    pipe = redis_client.conn.pipeline(transaction=False)
+    pipe.get("uid")
+    pipe.get("tid")
+    pipe.execute()
+    s3_client.upload_file(__file__, "metrics.py")
+    totals = metrics.end_request()
+    assert totals["redis"][0] == 2 and totals["s3"][0] == 1
+    rendered = metrics.render()
+    assert 'twitter_requests_total{route="home"} 1' in rendered
+    assert (
+        'twitter_backend_calls_total{route="home",backend="redis",command="PIPELINE"} 1'
+        in rendered
+    )
+    assert 'backend="s3",command="PutObject"' in rendered
+    # outside of a request
+    redis_client.conn.get("uid")
+    assert 'twitter_backend_calls_total{route="",backend="redis",command="GET"} 1' in (
+        metrics.render()
+    )
+    s3_client.delete_file("metrics.py")
+
+
+def test_counters(logged_in_user_1, logged_in_user_2, redis_client):
+    from twitter.controllers.users import repair_all_counts
+
+    image = {"tweet_image": FileStorage(filename="")}
+    before_1, before_2 = logged_in_user_1.counts, logged_in_user_2.counts
+    logged_in_user_1.follow(logged_in_user_2.uid)
+    # following twice is counted once
+    logged_in_user_1.follow(logged_in_user_2.uid)
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="counted")
+    counts_1, counts_2 = logged_in_user_1.counts, logged_in_user_2.counts
+    assert counts_1["num_of_following"] == before_1["num_of_following"] + 1
+    assert counts_2["num_of_followers"] == before_2["num_of_followers"] + 1
+    assert counts_1["num_of_tweets"] == before_1["num_of_tweets"] + 1
+    assert counts_1["num_of_tweets"] == len(logged_in_user_1.tweets)
+    logged_in_user_1.del_tweet(logged_in_user_1.tweets[0])
+    logged_in_user_1.unfollow(logged_in_user_2.uid)
+    logged_in_user_1.unfollow(logged_in_user_2.uid)
+    assert logged_in_user_1.counts == before_1
+    assert logged_in_user_2.counts == before_2
+    # recomputed from the sets
+    redis_client.conn.hset(keys.counts(logged_in_user_1.uid), "tweets", 42)
+    redis_client.conn.delete(keys.counts(logged_in_user_2.uid))
+    assert repair_all_counts(client=redis_client) >= 2
+    assert logged_in_user_1.counts == before_1
+    assert logged_in_user_2.counts == before_2
+
+
+def test_suggestions(redis_client, monkeypatch):
+    from twitter.controllers import scripts
+    from twitter.controllers import suggestions
+
+    monkeypatch.setattr(suggestions, "SUGGESTIONS_SIZE", 3)
+    monkeypatch.setattr(suggestions, "SUGGESTIONS_RANDOM", 1)
+    # 100 follows 101 and 102, who both follow 103, 102 also follows 104
+    uids = [str(uid) for uid in range(100, 110)]
+    redis_client.conn.sadd(keys.shard(keys.UIDS, 0, 1), *uids)
+    redis_client.conn.sadd(keys.following("100"), "101", "102")
+    redis_client.conn.sadd(keys.following("101"), "103")
+    redis_client.conn.sadd(keys.following("102"), "103", "104", "100")
+    suggested = suggestions.get_suggestions("100", client=redis_client)
+    # ranked by mutual follows, then random users
+    assert suggested[:2] == ["103", "104"]
+    assert len(suggested) == 3
+    assert not {"100", "101", "102"} & set(suggested)
+    # cached until they are stale, a followed user is removed from them
+    assert suggestions.get_suggestions("100", client=redis_client) == suggested
+    redis_client.run_script(scripts.FOLLOW, args=["100", "104", 5000, 800])
+    assert suggestions.get_suggestions("100", client=redis_client) == suggested[:1] + (
+        suggested[2:]
+    )
+    redis_client.conn.delete(*[keys.following(uid) for uid in uids])
+    redis_client.conn.delete(
+        keys.followers("104"), keys.counts("100"), keys.counts("104")
+    )
+    redis_client.conn.srem(keys.shard(keys.UIDS, 0, 1), *uids)
+    # no suggestions are cached too, they are not recomputed on every page
+    monkeypatch.setattr(suggestions, "SUGGESTIONS_SIZE", 0)
+    assert suggestions.get_suggestions("105", client=redis_client) == []
+    assert redis_client.conn.ttl(keys.suggestions_fresh("105")) > 0
+    monkeypatch.setattr(suggestions, "refresh", None)
+    assert suggestions.get_suggestions("105", client=redis_client) == []
+
+
+def test_images_index(logged_in_user_1, redis_client, s3_client):
+    from pathlib import Path
+    from twitter.controllers.tweets import index_images
+
+    filename = str(Path(__file__).parent / "test_image_supported.jpg")
+    no_image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=dict(no_image), tweet_text="text")
+    text_tid = logged_in_user_1.tweets[0]
+    with open(filename, "rb") as f:
+        image = {"tweet_image": FileStorage(f)}
+        logged_in_user_1.post_tweet(image=image, tweet_text="image")
+    image_tid = logged_in_user_1.tweets[0]
+    images = keys.shard(keys.IMAGES, 0, 1)
+    assert redis_client.conn.zscore(images, image_tid) is not None
+    assert redis_client.conn.zscore(images, text_tid) is None
+    # an image added / removed by an update
+    with open(filename, "rb") as f:
+        image = {"tweet_image": FileStorage(f)}
+        logged_in_user_1.update_tweet(text_tid, image=image, tweet_text="image")
+    logged_in_user_1.update_tweet(image_tid, image=dict(no_image), tweet_text="text")
+    assert redis_client.conn.zscore(images, text_tid) is not None
+    assert redis_client.conn.zscore(images, image_tid) is None
+    # backfilled
+    redis_client.conn.delete(images)
+    assert index_images(client=redis_client) == redis_client.conn.zcard(images)
+    assert redis_client.conn.zscore(images, text_tid) is not None
+    assert redis_client.conn.zscore(images, image_tid) is None
+    logged_in_user_1.del_tweet(text_tid)
+    logged_in_user_1.del_tweet(image_tid)
+    assert redis_client.conn.zscore(images, text_tid) is None
+
+
+def test_fragment_cache(logged_in_user_1, redis_client):
+    from twitter.controllers import storage
+    from twitter.controllers.fragments import FragmentCache
+
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="cached")
+    tid = logged_in_user_1.tweets[0]
+    rendered = []
+
+    def render(tid):
+        rendered.append(tid)
+        return f"<li>{tid}</li>"
+
+    def get(cache):
+        version = redis_client.conn.hget(f"tweets:{tid}", "version")
+        store = storage.RedisStorage(redis_client)
+        return cache.get_many([(tid, version)], render, store=store)[tid]
+
+    cache, other_worker = FragmentCache(), FragmentCache()
+    assert get(cache) == f"<li>{tid}</li>"
+    # in memory, then shared through redis
+    assert get(cache) == get(other_worker) == f"<li>{tid}</li>"
+    assert rendered == [tid]
+    # a new version is rendered again by every worker
+    logged_in_user_1.update_tweet(tid, image=dict(image), tweet_text="edited")
+    get(cache)
+    get(other_worker)
+    assert rendered == [tid, tid]
+    assert cache.stats()["hits"] == 1
+    logged_in_user_1.del_tweet(tid)
+
+
+def test_feed_versions(logged_in_user_1, logged_in_user_2, redis_client):
+    from twitter.controllers.timelines import get_feed_versions
+
+    def versions():
+        return get_feed_versions(
+            [logged_in_user_1.uid], celebrities_of=logged_in_user_1.uid
+        )
+
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.timeline_page()
+    before = versions()
+    # following changes the follower's feed (and the followed user's counters)
+    logged_in_user_1.follow(logged_in_user_2.uid)
+    followed = versions()
+    assert followed != before
+    assert versions() == followed
+    # a tweet of a followed user changes it
+    logged_in_user_2.post_tweet(image=dict(image), tweet_text="versioned")
+    posted = versions()
+    assert posted != followed
+    # so do the tweets of the followed celebrities, merged on read
+    redis_client.conn.sadd(keys.CELEBRITIES, logged_in_user_2.uid)
+    redis_client.conn.sadd(
+        keys.following_celebrities(logged_in_user_1.uid), logged_in_user_2.uid
+    )
+    assert versions() != posted
+    celebrity = versions()
+    (tid,) = logged_in_user_2.tweets
+    logged_in_user_2.del_tweet(tid)
+    assert versions() != celebrity
+    # clean up
+    redis_client.conn.srem(keys.CELEBRITIES, logged_in_user_2.uid)
+    logged_in_user_1.unfollow(logged_in_user_2.uid)
+
+
+def test_fingerprinted_static_files():
+    from twitter import assets
+
+    app = flask.Flask("twitter.app")
+    version = assets.init_app(app)
+    assert version == assets.init_app(flask.Flask("twitter.app"))
+    client = app.test_client()
+    with app.test_request_context():
+        url = flask.url_for("static", filename="style.css")
+    assert url != "/static/style.css"
+    assert url.startswith("/static/style.") and url.endswith(".css")
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age > 24 * 3600
+    response.close()
+    # the plain name is still served, without the long-lived headers
+    response = client.get("/static/style.css")
+    assert response.status_code == 200
+    assert not response.cache_control.immutable
+    response.close()
+
+
+def test_async_reads(
+    logged_in_user_1, logged_in_user_2, redis_client, s3_client, sid_1
+):
+    import asyncio
+    from twitter import pages
+    from twitter.controllers import aio
+    from twitter.controllers import steps
+    from twitter.controllers import storage
+    from twitter.controllers import pagination
+
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.follow(logged_in_user_2.uid)
+    logged_in_user_2.post_tweet(image=dict(image), tweet_text="read async")
+    uid = logged_in_user_1.uid
+    store = storage.RedisStorage(redis_client)
+
+    async def read():
+        reads = store.reads(aio.get_async_redis_client())
+        (tids, cursor), counts, following = await steps.run_async(
+            [
+                reads.get_timeline_page(uid),
+                reads.get_counts(uid),
+                reads.is_following_many(uid, [logged_in_user_2.uid, uid]),
+            ]
+        )
+        tweets = await steps.run_async(pages.load_tweets(reads, tids, s3_client))
+        session = await steps.run_async(reads.resolve_session(sid_1))
+        return tids, cursor, counts, following, tweets, session
+
+    # the same reads as the sync storage
+    tids, cursor, counts, following, tweets, session = asyncio.run(read())
+    assert (tids, cursor) == logged_in_user_1.timeline_page()
+    assert counts == logged_in_user_1.counts
+    assert following == {str(logged_in_user_2.uid)}
+    assert tweets == Tweet.load_many(tids, s3_client=s3_client)
+    assert session["uid"] == str(uid)
+    # a new event loop gets its own client
+    assert asyncio.run(read())[0] == tids
+    # the errors of a step reach the read
+    reads = store.reads()
+    with pytest.raises(pagination.InvalidCursor):
+        asyncio.run(steps.run_async(reads.get_user_tweets_page(uid, "x")))
+    with pytest.raises(pagination.InvalidCursor):
+        steps.run(reads.get_user_tweets_page(uid, "x"))
+    # clean up
+    logged_in_user_2.del_tweet(logged_in_user_2.tweets[0])
+    logged_in_user_1.unfollow(logged_in_user_2.uid)
+
+
+def test_asgi_pages(logged_in_user_1, logged_in_user_2, sid_1, monkeypatch):
+    import asyncio
+    from twitter import asgi
+    from twitter.app import app
+
+    # every page is served on the event loop
+    monkeypatch.setattr(asgi, "fallback", None)
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie = f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'sid': sid_1})}"
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_2.post_tweet(image=image, tweet_text="served async")
+
+    def get(path, *headers):
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [(b"cookie", cookie.encode()), *headers],
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(asgi.app(scope, receive, send))
+        return messages[0]["status"], dict(messages[0]["headers"]), messages[1]
+
+    # the same page as the sync app
+    client = app.test_client()
+    client.set_cookie(*cookie.split("=", 1))
+    guest = f"/users/{logged_in_user_2.uid}/profile"
+    status, headers, body = get(guest)
+    assert status == 200
+    assert body["body"] == client.get(guest).data
+    # with the hooks of the sync app: the metrics of the request
+    assert b"redis;dur=" in headers[b"server-timing"]
+    assert get(f"{guest}", (b"if-none-match", headers[b"etag"]))[0] == 304
+    assert get("/", (b"if-none-match", headers[b"etag"]))[0] == 200
+    assert get("/profile")[0] == 200
+    assert get("/?cursor=x")[0] == 400
+    assert get("/users/999999/profile")[0] == 404
+    logged_in_user_2.del_tweet(logged_in_user_2.tweets[0])
+
+
+def test_read_replicas(logged_in_user_1, redis_client, sid_1, tmp_path):
+    import time
+    import shutil
+    import socket
+    import subprocess
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from twitter.controllers import redis as controllers_redis
+
+    if not shutil.which("redis-server"):
+        pytest.skip("needs a local redis-server to run a replica")
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    primary = redis_client.conn.connection_pool.connection_kwargs
+    replica = subprocess.Popen(
+        ["redis-server", "--port", str(port), "--dir", str(tmp_path), "--save", ""]
+        + ["--replicaof", primary.get("host", "localhost"), str(primary["port"])],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        pool = controllers_redis.redis.BlockingConnectionPool(
+            host="localhost", port=port, decode_responses=True
+        )
+        client = controllers_redis.RedisClient(replica_pools=[pool])
+        replica_conn = client.read_conn
+        assert replica_conn is not client.conn
+        for _ in range(100):
+            try:
+                replication = replica_conn.info("replication")
+                if replication.get("master_link_status") == "up":
+                    break
+            except RedisConnectionError:
+                pass
+            time.sleep(0.1)
+        client.conn.set("replicated", 1)
+        client.conn.wait(1, 5000)
+
+        def replica_calls(command):
+            stats = replica_conn.info("commandstats").get(f"cmdstat_{command}", {})
+            return stats.get("calls", 0)
+
+        # the reads (and the read only scripts) go to the replica
+        before = replica_calls("hgetall"), replica_calls("evalsha")
+        user = LoggedInUser(sid_1, redis_client=client)
+        assert User.load_many([user.uid], client=client)[user.uid] == user.profile
+        assert replica_calls("hgetall") > before[0]
+        assert replica_calls("evalsha") > before[1]
+        # the writes go to the primary, the user reads them from the primary
+        controllers_redis.read_from_primary()
+        assert client.read_conn is client.conn
+        before = replica_calls("hgetall")
+        User.load_many([user.uid], client=client)
+        assert replica_calls("hgetall") == before
+    finally:
+        controllers_redis.read_from_primary(False)
+        redis_client.conn.delete("replicated")
+        replica.terminate()
+        replica.wait()
+
+
+def test_cluster_steps(signup, sid_1, sid_2, redis_client, s3_client, monkeypatch):
+    from twitter.controllers import timelines
+    from twitter.controllers.tweets import get_tweets_ids_page
+
+    # the scripts run as their steps, as on a redis cluster
+    client = RedisClient(
+        connection_pool=redis_client.conn.connection_pool,
+        replica_pools=[],
+        cluster=True,
+    )
+    user_1 = LoggedInUser(sid_1, redis_client=client, s3_client=s3_client)
+    user_2 = LoggedInUser(sid_2, redis_client=client, s3_client=s3_client)
+    image = {"tweet_image": FileStorage(filename="")}
+    assert user_1.follow(user_2.uid)
+    user_2.post_tweet(image=dict(image), tweet_text="stepped")
+    tid = user_2.tweets[0]
+    assert user_1.timeline[0] == tid
+    assert get_tweets_ids_page(client=client)[0][0] == tid
+    assert user_2.counts["num_of_followers"] == 1
+    assert not user_1.update_tweet(tid, image=dict(image), tweet_text="x")
+    assert user_2.update_tweet(tid, image=dict(image), tweet_text="edited")
+    assert user_1.timeline[0] == tid
+    assert user_2.del_tweet(tid)
+    assert tid not in user_1.timeline
+    assert tid not in get_tweets_ids_page(client=client)[0]
+    assert user_1.unfollow(user_2.uid)
+    # a celebrity's tweets are merged on read
+    monkeypatch.setattr(timelines, "FANOUT_MAX_FOLLOWERS", 0)
+    assert user_1.follow(user_2.uid)
+    assert client.conn.smembers(keys.following_celebrities(user_1.uid)) == {user_2.uid}
+    user_2.post_tweet(image=dict(image), tweet_text="famous")
+    tid = user_2.tweets[0]
+    assert user_1.timeline[0] == tid
+    # clean up
+    user_2.del_tweet(tid)
+    assert user_1.unfollow(user_2.uid)
+    client.conn.srem(keys.CELEBRITIES, user_2.uid)
+
+
+def test_migrate_layout(redis_client):
+    from twitter.controllers.migrations import migrate_layout
+    from twitter.controllers.tweets import get_tweets_ids_page
+
+    def get_all_tweets_ids():
+        return set(get_tweets_ids_page(count=1000, client=redis_client)[0])
+
+    conn = redis_client.conn
+    before = get_all_tweets_ids()
+    conn.delete(keys.SHARDS)
+    # users 200 and 201 in the layout before keys.py
+    conn.hset("users:200", mapping={"uid": "200", "email": "old@fakeemail.com"})
+    conn.hset("users", "old@fakeemail.com", "200")
+    conn.sadd("emails", "old@fakeemail.com")
+    conn.sadd("uids", "200", "201")
+    conn.sadd("followers:201", "200")
+    conn.sadd("following:200", "201")
+    conn.zadd("tids", {"2001": 1, "2002": 2})
+    conn.sadd("timelines", "200")
+    conn.hset("feeds", mapping={"*": 5, "200": 3})
+    conn.sadd(keys.CELEBRITIES, "201")
+    converted, moved = migrate_layout(shards=4, client=redis_client)
+    assert converted == 6 and moved >= 6
+    assert redis_client.shards == 4
+    assert conn.hget(keys.user("200"), "email") == "old@fakeemail.com"
+    assert conn.smembers(keys.followers("201")) == {"200"}
+    assert conn.smembers(keys.following_celebrities("200")) == {"201"}
+    assert conn.exists(keys.timeline_built("200"))
+    assert conn.get(keys.feed("200")) == "3"
+    assert conn.zscore(keys.shard(keys.TIDS, 2001, 4), "2001") == 1
+    assert conn.sismember(keys.shard(keys.UIDS, 201, 4), "201")
+    assert not conn.exists("users:200", "users", "emails", "uids", "tids", "feeds")
+    assert redis_client.get_user_id("no session")["success"] is False
+    assert get_all_tweets_ids() == before | {"2001", "2002"}
+    # back to one shard
+    assert migrate_layout(shards=1, client=redis_client)[0] == 0
+    assert conn.zscore(keys.shard(keys.TIDS, 2001, 1), "2001") == 1
+    assert not conn.exists(*keys.all_shards(keys.TIDS, 4)[1:])
+    # clean up
+    conn.zrem(keys.shard(keys.TIDS, 0, 1), "2001", "2002")
+    conn.srem(keys.shard(keys.UIDS, 0, 1), "200", "201")
+    conn.hdel(keys.email_shard("old@fakeemail.com", 1), "old@fakeemail.com")
+    conn.srem(keys.CELEBRITIES, "201")
+    conn.delete(
+        keys.user("200"),
+        keys.followers("201"),
+        keys.following("200"),
+        keys.following_celebrities("200"),
+        keys.timeline_built("200"),
+        keys.feed("200"),
+    )
+
+
+def test_tweet_buckets(logged_in_user_1, logged_in_user_2, redis_client, s3_client):
+    from twitter.controllers import records
+    from twitter.controllers.migrations import repack_tweets
+
+    tweet = {"timestamp": 1.5, "uid": "1", "tweet_text": "héllo", "other": "x"}
+    assert records.unpack(records.pack(tweet)) == {
+        "timestamp": "1.5",
+        "uid": "1",
+        "tweet_text": "héllo",
+        "other": "x",
+    }
+    assert records.unpack(None) == {}
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="hashed")
+    hashed = logged_in_user_1.tweets[0]
+    expected = Tweet(hashed, redis_client=redis_client).tweet
+    assert repack_tweets(10, client=redis_client) >= 1
+    assert redis_client.tweet_buckets == 10
+    assert not redis_client.conn.exists(keys.tweet(hashed))
+    assert redis_client.conn.hexists(keys.tweet_bucket(hashed, 10), hashed)
+    assert Tweet(hashed, redis_client=redis_client).tweet == expected
+    # the scripts read and write the records
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="packed")
+    packed = logged_in_user_1.tweets[0]
+    assert not logged_in_user_2.update_tweet(packed, image=dict(image), tweet_text="x")
+    assert logged_in_user_1.update_tweet(packed, image=dict(image), tweet_text="é")
+    (loaded,) = Tweet.load_many(
+        [packed], s3_client=s3_client, redis_client=redis_client
+    )
+    assert loaded["tweet_text"] == "é" and loaded["version"] == "2"
+    assert logged_in_user_1.del_tweet(hashed)
+    assert not redis_client.conn.hexists(keys.tweet_bucket(hashed, 10), hashed)
+    # and back to a hash per tweet
+    assert repack_tweets(0, client=redis_client) >= 1
+    assert redis_client.tweet_buckets == 0
+    assert redis_client.conn.hget(keys.tweet(packed), "tweet_text") == "é"
+    assert not redis_client.conn.exists(keys.tweet_bucket(packed, 10))
+    logged_in_user_1.del_tweet(packed)
+
+
+def test_search(logged_in_user_1, logged_in_user_2, redis_client):
+    from twitter.controllers import search
+
+    assert search.get_terms("Hello, #World: a hello") == ["hello", "world"]
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="zebra yak one")
+    first = logged_in_user_1.tweets[0]
+    logged_in_user_2.post_tweet(image=dict(image), tweet_text="Zebra yak two")
+    second = logged_in_user_2.tweets[0]
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="zebra three")
+    third = logged_in_user_1.tweets[0]
+    assert search.search("zebra", client=redis_client)[0] == [third, second, first]
+    # the terms are intersected, a page at a time
+    tids, cursor = search.search("YAK zebra", count=1, client=redis_client)
+    assert tids == [second]
+    assert search.search("yak zebra", cursor, client=redis_client) == ([first], None)
+    assert search.search("yak unknownword", client=redis_client) == ([], None)
+    assert search.search("", client=redis_client) == ([], None)
+    # the updates and deletes are unindexed
+    assert logged_in_user_1.update_tweet(first, image=dict(image), tweet_text="okapi")
+    assert search.search("zebra", client=redis_client)[0] == [third, second]
+    assert search.search("okapi", client=redis_client)[0] == [first]
+    assert logged_in_user_2.del_tweet(second)
+    assert search.search("zebra", client=redis_client)[0] == [third]
+    # the index is rebuilt from the tweets
+    redis_client.conn.delete(
+        keys.search_term("okapi", int(first) % redis_client.shards)
+    )
+    assert search.reindex(client=redis_client) >= 2
+    assert search.search("okapi", client=redis_client)[0] == [first]
+    assert search.search("zebra", client=redis_client)[0] == [third]
+    logged_in_user_1.del_tweet(first)
+    logged_in_user_1.del_tweet(third)
+
+
+def test_tags_and_mentions(logged_in_user_1, logged_in_user_2, redis_client):
+    from twitter import pages
+    from twitter.app import app
+    from twitter.controllers import tags
+
+    text = "#Fox and #fox@x @2 @2 me@1.com @abc"
+    assert tags.get_tags(text) == ["fox"]
+    assert tags.get_mentions(text) == ["2"]
+    with app.test_request_context():
+        assert pages.linkify("<b> #Fox @2") == (
+            '&lt;b&gt; <a href="/tags/fox">#Fox</a> <a href="/users/2/profile">@2</a>'
+        )
+    image = {"tweet_image": FileStorage(filename="")}
+    uid_2 = logged_in_user_2.uid
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text=f"#Gnu hi @{uid_2}")
+    first = logged_in_user_1.tweets[0]
+    logged_in_user_1.post_tweet(image=dict(image), tweet_text="#gnu #emu")
+    second = logged_in_user_1.tweets[0]
+    assert tags.get_tag_page("GNU", client=redis_client) == ([second, first], None)
+    assert logged_in_user_2.mentions_page() == ([first], None)
+    # the update diffs the tags and mentions
+    assert logged_in_user_1.update_tweet(first, image=dict(image), tweet_text="#emu")
+    assert tags.get_tag_page("gnu", client=redis_client)[0] == [second]
+    assert tags.get_tag_page("emu", client=redis_client)[0] == [first, second]
+    assert logged_in_user_2.mentions_page() == ([], None)
+    # the delete removes the tweet from every index
+    assert logged_in_user_1.del_tweet(second)
+    assert tags.get_tag_page("gnu", client=redis_client) == ([], None)
+    assert tags.get_tag_page("emu", client=redis_client)[0] == [first]
+    logged_in_user_1.del_tweet(first)
+    assert not redis_client.conn.exists(keys.tag("emu"))
+
+
+def test_trending(logged_in_user_1, redis_client, monkeypatch):
+    from twitter.controllers import trending
+
+    monkeypatch.setattr(trending, "TRENDING_SIZE", 2)
+    minute = int(time.time() // 60)
+    # the tweets may be posted in the next minute too
+    buckets = [keys.trending_bucket(minute), keys.trending_bucket(minute + 1)]
+    redis_client.conn.delete(*buckets)
+    image = {"tweet_image": FileStorage(filename="")}
+    for text in ("#Koala #yeti", "#koala", "#koala #yeti #ibex"):
+        logged_in_user_1.post_tweet(image=dict(image), tweet_text=text)
+    tid = logged_in_user_1.tweets[0]
+    # an update only counts the tags it adds
+    logged_in_user_1.update_tweet(tid, image=dict(image), tweet_text="#ibex #ibex #gnu")
+
+    def count(tag):
+        return sum(redis_client.conn.zscore(bucket, tag) or 0 for bucket in buckets)
+
+    assert count("#koala") == 3 and count("#ibex") == 1 and count("#gnu") == 1
+    ttl = max(redis_client.conn.ttl(bucket) for bucket in buckets)
+    assert 0 < ttl <= (trending.TRENDING_WINDOW + 1) * 60
+    # the older minutes weigh less
+    redis_client.conn.zadd(keys.trending_bucket(minute - 30), {"#old": 4})
+    assert trending.refresh(client=redis_client, now=(minute + 1) * 60) == 2
+    tags = trending.get_trending(client=redis_client)
+    assert [tag for tag, _ in tags] == ["#koala", "#yeti"]
+    assert tags[0][1] == pytest.approx(3, abs=0.2)
+    assert redis_client.conn.zcard(keys.TRENDING) == 2
+    # out of the window
+    trending.refresh(client=redis_client, now=(minute + 62) * 60)
+    assert trending.get_trending(client=redis_client) == []
+    logged_in_user_1.del_tweet(tid)
+
+
+def test_export_import(logged_in_user_1, logged_in_user_2, redis_client):
+    import io
+    import json
+    import redis
+    from twitter.controllers import dataset, tags
+
+    image = {"tweet_image": FileStorage(filename="")}
+    logged_in_user_1.follow(logged_in_user_2.uid)
+    logged_in_user_2.post_tweet(image=dict(image), tweet_text="#moose @1 exported")
+    tid = logged_in_user_2.tweets[0]
+    # the users of the fixtures are not created by the counter
+    if int(redis_client.conn.get(keys.UID) or 0) < 2:
+        redis_client.conn.set(keys.UID, 2)
+    # in 2 parts, by ranges of ids
+    parts = [io.StringIO(), io.StringIO()]
+    written = sum(
+        dataset.export_dataset(out, part=part, parts=2, client=redis_client)
+        for part, out in enumerate(parts)
+    )
+    lines = [json.loads(line) for out in parts for line in out.getvalue().splitlines()]
+    assert len(lines) == written
+    assert [line["type"] for line in lines].count("counters") == 1
+    assert any(line["type"] == "tweet" and line["tid"] == tid for line in lines)
+    # into another database
+    pool = redis.ConnectionPool(
+        **{**redis_client.conn.connection_pool.connection_kwargs, "db": 1}
+    )
+    other = RedisClient(connection_pool=pool, replica_pools=[])
+    other.conn.flushdb()
+    try:
+        text = "".join(out.getvalue() for out in parts)
+        assert dataset.import_dataset(io.StringIO(text), client=other) == written
+        assert other.conn.get(keys.TID) == redis_client.conn.get(keys.TID)
+        expected = Tweet(tid, redis_client=redis_client).tweet
+        assert Tweet(tid, redis_client=other).tweet == expected
+        assert other.conn.zrange(keys.user_tweets(logged_in_user_2.uid), 0, -1) == (
+            redis_client.conn.zrange(keys.user_tweets(logged_in_user_2.uid), 0, -1)
+        )
+        assert logged_in_user_2.uid in other.conn.smembers(
+            keys.following(logged_in_user_1.uid)
+        )
+        assert tags.get_tag_page("moose", client=other)[0] == [tid]
+        imported = User(logged_in_user_1.uid, client=other)
+        assert imported.profile == User(logged_in_user_1.uid).profile
+        assert imported.num_of_following == logged_in_user_1.num_of_following
+    finally:
+        other.conn.flushdb()
+    logged_in_user_2.del_tweet(tid)
+    logged_in_user_1.unfollow(logged_in_user_2.uid)
+
+
+@pytest.fixture(params=["redis", "sqlite"])
+def store(request, tmp_path):
+    from twitter.controllers import storage
+
+    if request.param == "sqlite":
+        store = storage.SQLiteStorage(str(tmp_path / "twitter.db"))
+        yield store
+        store.close()
+        return
+    redis_client = request.getfixturevalue("redis_client")
+    # past the uids written by the signup fixture
+    if int(redis_client.conn.get(keys.UID) or 0) < 1000:
+        redis_client.conn.set(keys.UID, 1000)
+    yield storage.RedisStorage(redis_client)
+
+
+def test_storage_users_and_sessions(store):
+    email = f"{uuid.uuid4()}@fakeemail.com"
+    assert store.get_uid(email) is None
+    uid = store.create_user({"email": email, "name": "stored", "locale": None})
+    assert store.get_uid(email) == uid
+    profile = {"uid": uid, "email": email, "name": "stored"}
+    assert store.get_users([uid, "999999"]) == {uid: profile, "999999": {}}
+    sid = str(uuid.uuid4())
+    assert store.resolve_session(sid) is None
+    store.create_session(sid, email, "token")
+    assert store.resolve_session(sid) == {"uid": uid, "profile": profile}
+    assert store.delete_session(sid) == "token"
+    assert store.resolve_session(sid) is None
+    assert store.delete_session(sid) is None
+
+
+def test_storage_tweets_and_timelines(store):
+    from twitter.controllers import pagination
+
+    uids = [
+        store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"}) for _ in "abc"
+    ]
+    first, second, third = uids
+    assert store.follow(first, second) and store.follow(third, second)
+    assert not store.follow(first, first)
+    assert sorted(store.get_followers(second)) == sorted([first, third])
+    assert store.get_following(first) == [second]
+    assert store.is_following_many(first, [second, third]) == {second}
+    start = time.time()
+    tids = [
+        store.post_tweet(uid, {"tweet_text": f"stored {i}"}, timestamp=start + i)
+        for i, uid in enumerate([first, second, third, second, first])
+    ]
+    assert store.get_counts(second) == {
+        "num_of_followers": 2,
+        "num_of_following": 0,
+        "num_of_tweets": 2,
+    }
+    (tweet,) = store.get_tweets([tids[1]])
+    assert tweet["tid"] == tids[1] and tweet["uid"] == second
+    assert tweet["tweet_text"] == "stored 1" and tweet["timestamp"] == start + 1
+    # newest first, page by page
+    expected = [tids[4], tids[3], tids[1], tids[0]]
+    page, cursor = store.get_timeline_page(first, count=3)
+    assert page == expected[:3]
+    assert store.get_timeline_page(first, cursor, count=3) == (expected[3:], None)
+    assert store.get_user_tweets_page(second) == ([tids[3], tids[1]], None)
+    assert store.get_tweets_page(count=2)[0] == [tids[4], tids[3]]
+    with pytest.raises(pagination.InvalidCursor):
+        store.get_tweets_page("nan:1")
+    # an update moves the tweet to the top, a delete removes it
+    assert store.update_tweet(first, tids[1], {"tweet_text": "not mine"}) is None
+    assert (
+        store.update_tweet(
+            second, tids[1], {"tweet_text": "updated"}, timestamp=start + 9
+        )
+        is not None
+    )
+    assert store.get_timeline_page(first, count=1)[0] == [tids[1]]
+    (tweet,) = store.get_tweets([tids[1]])
+    assert tweet["tweet_text"] == "updated" and tweet["version"] == "2"
+    assert store.delete_tweet(first, tids[3]) is None
+    assert store.delete_tweet(second, tids[3]) == []
+    assert store.get_tweets([tids[3], tids[0]])[0]["tid"] == tids[0]
+    assert store.unfollow(first, second)
+    assert store.get_timeline_page(first)[0] == [tids[4], tids[0]]
+    for tid, uid in zip(tids, [first, second, third, second, first]):
+        store.delete_tweet(uid, tid)
+
+
+def test_storage_follows(store):
+    first, second, third = [
+        store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"}) for _ in "abc"
+    ]
+    # following twice is counted once
+    assert store.follow(first, second) and store.follow(first, second)
+    assert store.follow(first, third) and store.follow(second, third)
+    assert sorted(store.get_following(first)) == sorted([second, third])
+    assert sorted(store.get_followers(third)) == sorted([first, second])
+    assert store.is_following_many(first, [second, third, first, "999999"]) == {
+        second,
+        third,
+    }
+    assert store.get_counts(first)["num_of_following"] == 2
+    assert store.get_counts(third)["num_of_followers"] == 2
+    # unfollowing a user not followed changes nothing
+    assert store.unfollow(first, second) and store.unfollow(first, second)
+    assert store.unfollow(third, first)
+    assert store.get_following(first) == [third]
+    assert store.get_followers(second) == []
+    assert store.get_counts(first)["num_of_following"] == 1
+    assert store.get_counts(second)["num_of_followers"] == 0
+    assert store.get_counts(third)["num_of_followers"] == 2
+    assert not store.unfollow(first, first)
+
+
+def test_storage_pages(store):
+    from twitter.controllers import pagination
+
+    first, second, third = [
+        store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"}) for _ in "abc"
+    ]
+    store.follow(first, second)
+    store.follow(first, third)
+    start = time.time()
+    # the followed users post more tweets than a page, some at the same time
+    posted = []
+    for i in range(30):
+        uid = [first, second, third][i % 3]
+        timestamp = start + i // 2
+        posted.append((store.post_tweet(uid, {"tweet_text": f"{i}"}, timestamp), uid))
+
+    def pages(read, count):
+        tids, cursor = read(None, count)
+        while cursor is not None:
+            page, cursor = read(cursor, count)
+            assert page
+            tids += page
+        return tids
+
+    # newest first, the ties in the order of the backend
+    def newest_first(tweets):
+        tids = [tid for tid, _ in tweets]
+        loaded = {tweet["tid"]: tweet["timestamp"] for tweet in store.get_tweets(tids)}
+        timestamps = [loaded[tid] for tid in all_at_once(tids)]
+        assert timestamps == sorted(timestamps, reverse=True)
+        return all_at_once(tids)
+
+    # the tids in one page
+    def all_at_once(tids):
+        page, cursor = store.get_tweets_page(count=1000)
+        assert cursor is None
+        return [tid for tid in page if tid in set(tids)]
+
+    # every tweet once, newest first, the same page by page as in one page
+    expected = newest_first(posted)
+    assert sorted(expected) == sorted(tid for tid, _ in posted)
+    for count in (1, 4, 7):
+        timeline = pages(
+            lambda cursor, count: store.get_timeline_page(first, cursor, count), count
+        )
+        assert timeline == expected
+        mine = pages(
+            lambda cursor, count: store.get_user_tweets_page(second, cursor, count),
+            count,
+        )
+        assert mine == newest_first([tweet for tweet in posted if tweet[1] == second])
+    assert [tid for tid in pages(store.get_tweets_page, 4) if tid in expected] == (
+        expected
+    )
+    # the timeline of a follower only has the followed users' tweets and its own
+    timeline = pages(
+        lambda cursor, count: store.get_timeline_page(third, cursor, count), 5
+    )
+    assert timeline == newest_first([tweet for tweet in posted if tweet[1] == third])
+    for cursor in ("nan:1", "inf:1", "1.5", "x:1"):
+        with pytest.raises(pagination.InvalidCursor):
+            store.get_timeline_page(first, cursor)
+    for tid, uid in posted:
+        store.delete_tweet(uid, tid)
+    assert store.get_timeline_page(first) == ([], None)
+
+
+def test_storage_deletes(store):
+    uid, other = [
+        store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"}) for _ in "ab"
+    ]
+    store.follow(other, uid)
+    tid = store.post_tweet(uid, {"tweet_text": "deleted"})
+    kept = store.post_tweet(uid, {"tweet_text": "kept"})
+    assert store.get_timeline_page(other)[0] == [kept, tid]
+    # only by its author
+    assert store.delete_tweet(other, tid) is None
+    assert store.delete_tweet(uid, tid) == []
+    assert store.delete_tweet(uid, tid) is None
+    assert store.update_tweet(uid, tid, {"tweet_text": "gone"}) is None
+    assert store.get_tweets([tid, kept])[0]["tid"] == kept
+    assert store.get_tweets([tid]) == []
+    assert store.get_counts(uid)["num_of_tweets"] == 1
+    assert store.get_user_tweets_page(uid) == ([kept], None)
+    assert store.get_timeline_page(other) == ([kept], None)
+    assert tid not in store.get_tweets_page(count=1000)[0]
+    store.delete_tweet(uid, kept)
+    assert store.get_counts(uid)["num_of_tweets"] == 0
+    # a session is deleted once
+    email = store.get_users([uid])[uid]["email"]
+    sid = str(uuid.uuid4())
+    store.create_session(sid, email, "token")
+    assert store.resolve_session(sid)["uid"] == uid
+    assert store.delete_session(sid) == "token"
+    assert store.delete_session(sid) is None
+    assert store.resolve_session(sid) is None
+
+
+def test_storage_indexes(store):
+    from twitter.controllers import pagination
+
+    uid, other = [
+        store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"}) for _ in "ab"
+    ]
+    assert store.user_exists(uid) and not store.user_exists("999999")
+    tag = f"tag{uuid.uuid4().hex[:8]}"
+    word = f"word{uuid.uuid4().hex[:8]}"
+    tid = store.post_tweet(uid, {"tweet_text": f"#{tag} @{other} {word} indexed"})
+    untagged = store.post_tweet(uid, {"tweet_text": f"{word} alone"})
+    assert store.tweet_exists(tid) and not store.tweet_exists("999999")
+    assert store.get_tag_page(tag.upper()) == ([tid], None)
+    assert store.get_mentions_page(other) == ([tid], None)
+    assert store.search(f"{word} indexed") == ([tid], None)
+    assert store.search(word, count=1)[0] == [untagged]
+    assert store.search("") == ([], None)
+    # the indexes follow the updates and the deletes
+    store.update_tweet(uid, tid, {"tweet_text": f"{word} untagged"})
+    assert store.get_tag_page(tag) == ([], None)
+    assert store.get_mentions_page(other) == ([], None)
+    assert store.search(f"{word} indexed") == ([], None)
+    assert store.search(f"{word} untagged") == ([tid], None)
+    store.delete_tweet(uid, tid)
+    store.delete_tweet(uid, untagged)
+    assert store.search(word) == ([], None)
+    with pytest.raises(pagination.InvalidCursor):
+        store.get_tag_page(tag, "x:1")
+
+
+def test_storage_images_and_uploads(store):
+    uid = store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"})
+    iid = f"{store.next_image_id()}_image.jpg"
+    assert int(store.next_image_id()) > int(iid.split("_")[0])
+    tid = store.post_tweet(uid, {"tweet_text": "image", "image": iid})
+    assert tid in store.get_images_page(count=1000)[0]
+    # the jobs of the other tests are done first
+    job = store.take_upload()
+    while job[1] != tid:
+        store.finish_upload(*job, "failed", {})
+        job = store.take_upload()
+    assert job[2] == iid
+    # the job of a dead worker is taken again
+    store.requeue_uploads()
+    assert store.take_upload() == job
+    assert store.take_upload() is None
+    assert store.finish_upload(*job, "ready", {"image_thumb": f"{iid}_thumb"})
+    (tweet,) = store.get_tweets([tid])
+    assert tweet["image_thumb"] == f"{iid}_thumb" and tweet["version"] == "2"
+    # a new image replaces the previous one and its derivatives
+    new_iid = f"{store.next_image_id()}_new.jpg"
+    fields = {"tweet_text": "new image", "image_status": "pending"}
+    previous = store.update_tweet(uid, tid, fields, image=new_iid)
+    assert sorted(previous) == sorted([iid, f"{iid}_thumb"])
+    (tweet,) = store.get_tweets([tid])
+    assert tweet["image"] == new_iid and "image_thumb" not in tweet
+    new_job = store.take_upload()
+    assert new_job[1:] == (tid, new_iid)
+    # the image of a job is not the tweet's anymore
+    assert not store.finish_upload(new_job[0], tid, iid, "ready", {})
+    assert store.update_tweet(uid, tid, {"tweet_text": "no image"}) == [new_iid]
+    assert tid not in store.get_images_page(count=1000)[0]
+    assert "image_status" not in store.get_tweets([tid])[0]
+    assert store.delete_tweet(uid, tid) == []
+
+
+def test_storage_feeds_and_suggestions(store):
+    first, second, third = [
+        store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"}) for _ in "abc"
+    ]
+
+    def versions():
+        return store.get_feed_versions(["*", first], celebrities_of=first)
+
+    before = versions()
+    assert store.get_feed_versions([first]) == store.get_feed_versions([first])
+    # the follows, the tweets of the user and of the followed users change it
+    store.follow(first, second)
+    followed = versions()
+    assert followed != before
+    tid = store.post_tweet(second, {"tweet_text": "versioned"})
+    posted = versions()
+    assert posted != followed
+    store.post_tweet(third, {"tweet_text": "not followed"})
+    assert store.get_feed_versions([first], celebrities_of=first) == (
+        store.get_feed_versions([first], celebrities_of=first)
+    )
+    store.delete_tweet(second, tid)
+    assert versions() != posted
+    assert store.sample_following(first) == [second]
+    assert store.sample_followers(second, count=1) == [first]
+    # the users followed by the followed users come first
+    store.follow(second, third)
+    suggested = store.get_suggestions(first)
+    assert suggested[0] == third
+    assert not {first, second} & set(suggested)
+    # every user once, page by page
+    uids, cursor = store.get_users_page(count=2)
+    while cursor is not None:
+        page, cursor = store.get_users_page(cursor, count=2)
+        uids += page
+    assert {first, second, third} <= set(uids)
+    assert len(uids) == len(set(uids))
+
+
+def test_storage_trending(store, request, monkeypatch):
+    from twitter.controllers import trending
+
+    monkeypatch.setattr(trending, "TRENDING_SIZE", 100)
+    uid = store.create_user({"email": f"{uuid.uuid4()}@fakeemail.com"})
+    tag, other = f"#a{uuid.uuid4().hex[:8]}", f"#b{uuid.uuid4().hex[:8]}"
+    tids = [store.post_tweet(uid, {"tweet_text": f"{tag} {other}"})]
+    tids += [store.post_tweet(uid, {"tweet_text": tag}) for _ in range(2)]
+    # an update only counts the tags it adds
+    store.update_tweet(uid, tids[0], {"tweet_text": f"{tag} {other} {other}"})
+    if request.node.callspec.params["store"] == "redis":
+        trending.refresh(client=request.getfixturevalue("redis_client"))
+    scores = dict(store.get_trending())
+    assert scores[tag] == pytest.approx(3, abs=0.2)
+    assert scores[other] == pytest.approx(1, abs=0.1)
+    for tid in tids:
+        store.delete_tweet(uid, tid)
+
+
+def test_storage_shared_cache(store, request):
+    key, missing = f"cached:{uuid.uuid4()}", f"cached:{uuid.uuid4()}"
+    store.set_cached({key: "<li>cached</li>"}, 60)
+    # only redis is shared by the workers
+    if request.node.callspec.params["store"] == "redis":
+        assert store.get_cached([key, missing]) == ["<li>cached</li>", None]
+    else:
+        assert store.get_cached([key, missing]) == [None, None]
+
+
+def test_app_on_sqlite(tmp_path, monkeypatch):
+    from twitter import auth
+    from twitter import app as twitter_app
+    from twitter.controllers import storage
+
+    store = storage.SQLiteStorage(str(tmp_path / "twitter.db"))
+    monkeypatch.setattr(twitter_app, "store", store)
+    monkeypatch.setattr(auth, "store", store)
+    emails = [f"{uuid.uuid4()}@fakeemail.com" for _ in "ab"]
+    uid, other = [
+        store.create_user({"email": email, "name": email}) for email in emails
+    ]
+    store.create_session("sqlite-sid", emails[0], "token")
+    store.follow(uid, other)
+    tid = store.post_tweet(other, {"tweet_text": f"#sqlite hello @{uid}"})
+    mine = store.post_tweet(uid, {"tweet_text": "mine"})
+    client = twitter_app.app.test_client()
+    with client.session_transaction() as session:
+        session["sid"] = "sqlite-sid"
+    # the pages read the sqlite storage, no redis involved
+    for path in (
+        "/",
+        "/profile",
+        f"/users/{other}/profile",
+        "/search?q=hello",
+        "/tags/SQLite",
+        "/mentions",
+        f"/tweets/{tid}",
+    ):
+        response = client.get(path)
+        assert response.status_code == 200, path
+        assert b"sqlite" in response.data, path
+    assert client.get("/people").status_code == 200
+    assert client.get("/gallery").status_code == 200
+    assert client.get("/users/999999/profile").status_code == 404
+    # an etag is valid until the feed changes
+    etag = client.get("/profile").headers["ETag"]
+    assert client.get("/profile", headers={"If-None-Match": etag}).status_code == 304
+    form = {"_method": "unfollow", "_redirect": "/profile"}
+    assert client.post(f"/users/{other}/following", data=form).status_code == 302
+    assert store.get_following(uid) == []
+    assert client.get("/profile", headers={"If-None-Match": etag}).status_code == 200
+    form = {"_method": "DELETE", "_redirect": "/"}
+    assert client.post(f"/tweets/{mine}", data=form).status_code == 302
+    assert not store.tweet_exists(mine)
+    # the async app serves the same page, with the reads in the default executor
+    import asyncio
+    from twitter import asgi
+
+    monkeypatch.setattr(storage, "get_storage", lambda client=None: store)
+    monkeypatch.setattr(asgi, "fallback", None)
+    cookie = client.get_cookie("session")
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": f"/users/{other}/profile",
+        "query_string": b"",
+        "headers": [(b"cookie", f"{cookie.key}={cookie.value}".encode())],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    assert messages[1]["body"] == client.get(scope["path"]).data
+    store.close()